@@ -10,6 +10,8 @@ from threading import Thread
 from flask import current_app
 from blinker import Namespace
 
+from . import metrics
+
 
 signals = Namespace()
 
@@ -33,10 +35,14 @@ def on_signal(signal_name, *args, **kwargs):
             # This is a bit naive, a flood of actions might create a
             # ridiculous number of threads. Maybe better to use a worker
             # pool and a queue or something?
+            metrics.inc("elogy_actions_in_progress", action=signal_name)
+            metrics.inc("elogy_actions_total", action=signal_name)
             Thread(target=action, args=args, kwargs=kwargs).run()
         except Exception as e:
             logging.error("Caught exception in action for '%s': %s",
                           signal_name, e)
+        finally:
+            metrics.inc("elogy_actions_in_progress", -1, action=signal_name)
 
 
 for name, signal in signals.items():
@@ -6,15 +6,120 @@ useful to browse the database.
 Note that right now, writing will corrupt the item due to JSON
 fields not being understood. Therefore edit operations have been
 disabled.
-"""
 
-import flask_admin as admin
-from flask_admin.contrib.peewee import ModelView
+This module is only imported when the admin interface is first used,
+see make_admin_app() in app.py.
 
-from .db import Entry, EntryChange, Logbook, LogbookChange, EntryLock, Attachment
+The tables can get large (in particular the changes, which contain
+whole old entries) so the list views are careful about what they ask
+the database for, see ListView.
+"""
 
+from functools import reduce
+import operator
 
-class LogbookAdmin(ModelView):
+from flask import g, request
+import flask_admin as admin
+from flask_admin.contrib.peewee import ModelView
+from peewee import ForeignKeyField, fn
+
+from .db import (db, Entry, EntryChange, Logbook, LogbookChange, EntryLock,
+                 Attachment)
+
+
+class ListView(ModelView):
+
+    """Lists that stay fast on big tables:
+
+    - Only the listed columns are loaded, and related rows are shown
+      by id instead of being loaded one by one.
+    - The number of rows is not counted, but estimated from the
+      largest id. Filtered lists are not counted at all.
+    - By default the newest rows come first, and the next/previous
+      pages are found by seeking from the first/last id on the current
+      page ("keyset pagination"). Other pages are found by offset, but
+      only over the ids, and then the rows for those are loaded.
+    - Searching matches the start of the value (SQLite) or words
+      (PostgreSQL) so that it can use indexes, see prefix_search()
+      in dialects.py.
+    """
+
+    column_default_sort = ("id", True)
+    simple_list_pager = True  # we count ourselves
+
+    def get_query(self):
+        fields = self.model._meta.fields
+        columns = [fields[name] for name in self.column_list or []
+                   if name in fields]
+        return self.model.select(self.model._meta.primary_key, *columns)
+
+    def _get_field_value(self, model, name):
+        field = self.model._meta.fields.get(name)
+        if isinstance(field, ForeignKeyField):
+            return model._data.get(name)
+        return super()._get_field_value(model, name)
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        _, query = super().get_list(None, sort_column, sort_desc, None,
+                                    filters, execute=False, page_size=False)
+        search = (search or "").strip()
+        if self._search_supported and search:
+            query = query.where(reduce(operator.or_, (
+                db.dialect.prefix_search(field, search)
+                for field in self._search_fields)))
+
+        if search or filters:
+            count = None
+        else:
+            count = self.model.select(
+                fn.MAX(self.model._meta.primary_key)).scalar() or 0
+
+        if page_size is None:
+            page_size = self.page_size
+        if not page_size or not execute:
+            if page_size:
+                query = query.limit(page_size).offset((page or 0) * page_size)
+            return count, (list(query) if execute else query)
+
+        pk = self.model._meta.primary_key
+        keyset = sort_column is None and page
+        after = request.args.get("after", type=int) if keyset else None
+        before = request.args.get("before", type=int) if keyset else None
+        if after is not None:
+            rows = list(query.where(pk < after).limit(page_size))
+        elif before is not None:
+            rows = list(query.where(pk > before).order_by(pk.asc())
+                        .limit(page_size))[::-1]
+        elif page:
+            ids = [id_ for id_, in query.select(pk).limit(page_size)
+                   .offset(page * page_size).tuples()]
+            found = {row._get_pk_value(): row
+                     for row in self.get_query().where(pk << ids)} if ids else {}
+            rows = [found[id_] for id_ in ids if id_ in found]
+        else:
+            rows = list(query.limit(page_size))
+
+        if sort_column is None and rows:
+            # remembered for the links to the next/previous pages
+            g.admin_list_keys = (page or 0, rows[0]._get_pk_value(),
+                                 rows[-1]._get_pk_value())
+        return count, rows
+
+    def _get_list_url(self, view_args):
+        keys = g.get("admin_list_keys")
+        if keys and view_args.sort is None and view_args.page:
+            page, first, last = keys
+            if view_args.page == page + 1:
+                view_args = view_args.clone(
+                    extra_args=dict(view_args.extra_args, after=last))
+            elif view_args.page == page - 1:
+                view_args = view_args.clone(
+                    extra_args=dict(view_args.extra_args, before=first))
+        return super()._get_list_url(view_args)
+
+
+class LogbookAdmin(ListView):
     inline_models = (Logbook,)
     column_list = ["id", "created_at", "last_changed_at", "name", "description", "attributes", "parent"]
     can_view_details = True
@@ -27,19 +132,20 @@ class LogbookAdmin(ModelView):
     }
 
 
-class LogbookChangeAdmin(ModelView):
+class LogbookChangeAdmin(ListView):
     # inline_models = (Entry, )
     can_view_details = True
     can_create = False
     can_delete = False
     can_edit = False
 
-    column_list = ['id', 'entry', 'timestamp', 'changed', 'change_authors', 'change_ip']
+    # 'changed' is only shown in the details, it can be big
+    column_list = ['id', 'logbook', 'timestamp', 'change_authors', 'change_ip']
     column_sortable_list = ('timestamp', )
 
 
 
-class EntryAdmin(ModelView):
+class EntryAdmin(ListView):
     inline_models = (Entry, )
     can_view_details = True
     can_create = False
@@ -55,28 +161,29 @@ class EntryAdmin(ModelView):
     }
 
 
-class EntryChangeAdmin(ModelView):
+class EntryChangeAdmin(ListView):
     # inline_models = (Entry, )
     can_view_details = True
     can_create = False
     can_delete = False
     can_edit = False
 
-    column_list = ['id', 'entry', 'timestamp', 'changed', 'change_authors', 'change_ip']
+    # 'changed' is only shown in the details, it contains the old content
+    column_list = ['id', 'entry', 'timestamp', 'change_authors', 'change_ip']
     column_sortable_list = ('entry', 'timestamp', )
 
 
-class EntryLockAdmin(ModelView):
+class EntryLockAdmin(ListView):
     can_view_details = True
     can_create = False
     can_delete = True
     can_edit = False
 
-    column_list = ['id', 'entry', 'created_at', 'exipires_at', 'owned_by_ip', 'cancelled_at', 'cancelled_by_ip']
+    column_list = ['id', 'entry', 'created_at', 'expires_at', 'owned_by_ip', 'cancelled_at', 'cancelled_by_ip']
     column_sortable_list = ('entry', 'created_at', 'expires_at', 'cancelled_at')
 
 
-class AttachmentAdmin(ModelView):
+class AttachmentAdmin(ListView):
     can_view_details = True
     can_create = False
     can_delete = True
@@ -86,8 +193,8 @@ class AttachmentAdmin(ModelView):
     column_sortable_list = ('entry', 'timestamp')
 
 
-def setup_admin(app):
-    adm = admin.Admin(app, name='Elogy')
+def setup_admin(app, url="/admin"):
+    adm = admin.Admin(app, name='Elogy', url=url)
     adm.add_view(LogbookAdmin(Logbook))
     adm.add_view(LogbookChangeAdmin(LogbookChange))
     adm.add_view(EntryAdmin(Entry))
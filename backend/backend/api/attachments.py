@@ -6,8 +6,12 @@ from flask_restful import Resource, reqparse
 from werkzeug import FileStorage
 from ..db import Attachment
 
-from ..attachments import save_attachment
+from ..attachments import (delete_attachment, discard_staged,
+                           remove_attachment_file, run_write_staged,
+                           save_attachment, save_staged)
+from ..images import schedule_thumbnail
 from ..utils import get_utc_datetime
+from ..writequeue import run_write
 
 
 attachments_parser = reqparse.RequestParser()
@@ -33,12 +37,18 @@ class AttachmentsResource(Resource):
             metadata = json.loads(args["metadata"])
         else:
             metadata = None
-        for attachment in args["attachment"]:
-            print(attachment)
-            attachment = save_attachment(attachment, timestamp,
-                                         entry_id, metadata,
-                                         embedded=args["embedded"])
-            attachment.save()
+        attachments = []
+        try:
+            for file_ in args["attachment"]:
+                attachments.append(save_attachment(
+                    file_, timestamp, entry_id, metadata,
+                    embedded=args["embedded"], staged=True))
+        except Exception:
+            discard_staged(attachments)
+            raise
+        run_write_staged(attachments, save_all_staged, attachments, entry_id)
+        for attachment in attachments:
+            schedule_thumbnail(attachment)
         return jsonify(id=attachment.id,
                        location=url_for("get_attachment",
                                         path=attachment.path),
@@ -49,5 +59,11 @@ class AttachmentsResource(Resource):
     def delete(self, logbook_id, entry_id, attachment_id):
         "Delete attachments to an entry"
         attachment = Attachment.get(Attachment.id == attachment_id)
-        res = attachment.delete_instance()
-        return res
+        result = run_write(delete_attachment, attachment)
+        remove_attachment_file(attachment)
+        return result
+
+
+def save_all_staged(attachments, entry_id):
+    for attachment in attachments:
+        save_staged(attachment, entry_id)
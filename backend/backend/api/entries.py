@@ -7,8 +7,13 @@ from webargs.fields import (Integer, Str, Boolean, Dict, List,
 from webargs.flaskparser import use_args
 
 from ..db import Entry, Logbook, EntryLock
-from ..attachments import handle_img_tags
+from ..archive import get_archived_entry
+from ..attachments import run_write_staged, save_staged
+from ..content import process_content
+from ..images import schedule_thumbnail
 from ..export import export_entries_as_pdf
+from ..locks import (acquire_lock, cancel_lock, get_lock, locks_changed,
+                     renew_lock)
 from ..actions import new_entry, edit_entry
 from . import fields, send_signal
 
@@ -36,18 +41,33 @@ entry_args = {
 }
 
 
+def get_entry(entry_id):
+    "An entry by id, also if it has been archived (see archive.py)"
+    try:
+        return Entry.get(Entry.id == entry_id)
+    except Entry.DoesNotExist:
+        return get_archived_entry(entry_id)
+
+
 class EntryResource(Resource):
 
     "Handle requests for a single entry"
 
-    @use_args({"thread": Boolean(missing=False)})
+    @use_args({"thread": Boolean(missing=False),
+               "ignore_children": Boolean(missing=False)})
     @marshal_with(fields.entry_full, envelope="entry")
     def get(self, args, entry_id, logbook_id=None, revision_n=None):
-        entry = Entry.get(Entry.id == entry_id)
+        entry = get_entry(entry_id)
         if revision_n is not None:
             return entry.get_revision(revision_n)
         if args["thread"]:
-            return entry._thread
+            entry = entry._thread
+        else:
+            # load the followups all at once
+            entry = entry.load_thread().get(entry.id, entry)
+        # next/previous as in the listing of the logbook we're in
+        logbook = Logbook.get(Logbook.id == logbook_id) if logbook_id else None
+        entry.navigation = (logbook, not args["ignore_children"])
         return entry
 
     @send_signal(new_entry)
@@ -60,16 +80,11 @@ class EntryResource(Resource):
         if entry_id is not None:
             # we're creating a followup to an existing entry
             args["follows"] = entry_id
-        if args.get("content"):
-            content_type = args["content_type"]
-            if content_type.startswith("text/html"):
-                # extract any inline images as attachments
-                args["content"], inline_attachments = handle_img_tags(
-                    args["content"], timestamp=args.get("created_at"))
-            else:
-                inline_attachments = []
-        else:
-            inline_attachments = []
+        follows_id = args.get("follows") or args.get("follows_id")
+        if follows_id and not Entry.select().where(
+                Entry.id == follows_id).exists():
+            get_entry(follows_id)  # 404, unless it's in the archives
+            abort_archived()
         args["logbook"] = logbook
         # make sure the attributes are of proper types
         try:
@@ -79,10 +94,21 @@ class EntryResource(Resource):
         if args.get("follows_id"):
             # don't allow pinning followups, that makes no sense
             args["pinned"] = False
-        entry = Entry.create(**args)
+        if args.get("content"):
+            # extract any inline images as attachments, etc
+            content = process_content(args["content"], args["content_type"],
+                                      timestamp=args.get("created_at"))
+            args["content"] = content.content
+            args["content_preview"] = content.preview
+            args["metadata"] = dict(args.get("metadata") or {},
+                                    **content.metadata)
+            inline_attachments = content.attachments
+        else:
+            inline_attachments = []
+        entry = run_write_staged(inline_attachments,
+                                 create_entry, args, inline_attachments)
         for attachment in inline_attachments:
-            attachment.entry = entry
-            attachment.save()
+            schedule_thumbnail(attachment)
         return entry
 
     @send_signal(edit_entry)
@@ -91,46 +117,81 @@ class EntryResource(Resource):
     def put(self, args, entry_id, logbook_id=None):
         "update entry"
         entry_id = entry_id or args["id"]
-        entry = Entry.get(Entry.id == entry_id)
-        # to prevent overwiting someone else's changes we require the
-        # client to supply the "revision_n" field of the entry they
-        # are editing. If this does not match the current entry in the
-        # db, it means someone has changed it inbetween and we abort.
         if "revision_n" not in args:
             abort(400, message="Missing 'revision_n' field!")
-        if args["revision_n"] != entry.revision_n:
-            abort(409, message=(
-                "Conflict: Entry {} has been edited since you last loaded it!"
-                .format(entry_id)))
-        # check for a lock on the entry
-        if entry.lock:
-            if entry.lock.owned_by_ip == request.remote_addr:
-                entry.lock.cancel(request.remote_addr)
-            else:
-                abort(409, message=(
-                    "Conflict: Entry {} is locked by IP {} since {}"
-                    .format(entry_id, entry.lock.owned_by_ip,
-                            entry.lock.created_at)))
         if args.get("content"):
-            content_type = args.get("content_type", entry.content_type)
-            if content_type.startswith("text/html"):
-                args["content"], inline_attachments = handle_img_tags(
-                    args["content"])
-            else:
-                inline_attachments = []
+            content = process_content(args["content"], args["content_type"])
+            args["content"] = content.content
+            inline_attachments = content.attachments
         else:
+            content = None
             inline_attachments = []
-
-        entry = Entry.get(Entry.id == entry_id)
-        change = entry.make_change(**args)
-        entry.save()
-        change.save()
+        entry, unlocked = run_write_staged(
+            inline_attachments, update_entry, entry_id, args, content,
+            inline_attachments, request.remote_addr)
+        if unlocked:
+            locks_changed()
         for attachment in inline_attachments:
-            attachment.entry = entry
-            attachment.save()
+            schedule_thumbnail(attachment)
         return entry
 
 
+def create_entry(args, inline_attachments):
+    follows_id = args.get("follows") or args.get("follows_id")
+    if follows_id and not Entry.select().where(
+            Entry.id == follows_id).exists():
+        abort_archived()  # meanwhile
+    entry = Entry.create(**args)
+    for attachment in inline_attachments:
+        save_staged(attachment, entry)
+    return entry
+
+
+def update_entry(entry_id, args, content, inline_attachments, ip):
+    """Returns the entry, and whether the editor's lock on it was
+    cancelled"""
+    entry = Entry.get(Entry.id == entry_id)
+    # to prevent overwiting someone else's changes we require the
+    # client to supply the "revision_n" field of the entry they
+    # are editing. If this does not match the current entry in the
+    # db, it means someone has changed it inbetween and we abort.
+    # The check is made again when saving, in the same statement.
+    if args["revision_n"] != entry.revision_n:
+        abort_conflict(entry_id)
+    # check for a lock on the entry (not cached, see locks.py)
+    lock = entry.get_lock()
+    if lock:
+        if lock.owned_by_ip == ip:
+            lock.cancel(ip)
+        else:
+            abort(409, message=(
+                "Conflict: Entry {} is locked by IP {} since {}"
+                .format(entry_id, lock.owned_by_ip, lock.created_at)))
+    change = entry.make_change(**args)
+    if content:
+        # derived from the content, no need to keep it in the history
+        entry.content_preview = content.preview
+        entry.metadata = dict(entry.metadata or {}, **content.metadata)
+    try:
+        entry.save(revision=args["revision_n"])
+    except Entry.Conflict:
+        abort_conflict(entry_id)
+    change.save()
+    for attachment in inline_attachments:
+        save_staged(attachment, entry)
+    return entry, lock is not None
+
+
+def abort_conflict(entry_id):
+    abort(409, message=(
+        "Conflict: Entry {} has been edited since you last loaded it!"
+        .format(entry_id)))
+
+
+def abort_archived():
+    abort(409, message="Archived entries can't be changed")
+
+
 entries_args = {
     "title": Str(),
     "content": Str(),
@@ -144,6 +205,7 @@ entries_args = {
     "offset": Integer(),
     "download": Str(),
     "sort_by_timestamp": Boolean(missing=True),
+    "archive": Boolean(missing=False),
 }
 
 
@@ -170,7 +232,8 @@ class EntriesResource(Resource):
                                attribute_filter=attributes,
                                metadata_filter=metadata,
                                n=args["n"], offset=args.get("offset"),
-                               sort_by_timestamp=args.get("sort_by_timestamp"))
+                               sort_by_timestamp=args.get("sort_by_timestamp"),
+                               include_archive=args["archive"])
             entries = logbook.get_entries(**search_args)
         else:
             # global search (all logbooks)
@@ -183,7 +246,8 @@ class EntriesResource(Resource):
                                attribute_filter=attributes,
                                metadata_filter=metadata,
                                n=args["n"], offset=args.get("offset"),
-                               sort_by_timestamp=args.get("sort_by_timestamp"))
+                               sort_by_timestamp=args.get("sort_by_timestamp"),
+                               include_archive=args["archive"])
             entries = Entry.search(**search_args)
 
         if args.get("download") == "pdf":
@@ -206,8 +270,7 @@ class EntryLockResource(Resource):
     @marshal_with(fields.entry_lock, envelope="lock")
     def get(self, entry_id, logbook_id=None):
         "Check for a lock"
-        entry = Entry.get(Entry.id == entry_id)
-        lock = entry.get_lock(request.environ["REMOTE_ADDR"])
+        lock = get_lock(entry_id)
         if lock:
             return lock
         raise EntryLock.DoesNotExist
@@ -217,9 +280,15 @@ class EntryLockResource(Resource):
     def post(self, args, entry_id, logbook_id=None):
         "Acquire (optionally stealing) a lock"
         entry = Entry.get(Entry.id == entry_id)
-        return entry.get_lock(ip=request.environ["REMOTE_ADDR"],
-                              acquire=True,
-                              steal=args["steal"])
+        return acquire_lock(entry, request.environ["REMOTE_ADDR"],
+                            steal=args["steal"])
+
+    @use_args({"lock_id": Integer(required=True)})
+    @marshal_with(fields.entry_lock, envelope="lock")
+    def put(self, args, entry_id, logbook_id=None):
+        "Heartbeat from the owner of a lock, to keep it"
+        return renew_lock(args["lock_id"], entry_id,
+                          request.environ["REMOTE_ADDR"])
 
     @use_args({"lock_id": Integer()})
     @marshal_with(fields.entry_lock, envelope="lock")
@@ -230,13 +299,12 @@ class EntryLockResource(Resource):
         else:
             entry = Entry.get(Entry.id == entry_id)
             lock = entry.get_lock()
-        lock.cancel(request.environ["REMOTE_ADDR"])
-        return lock
+        return cancel_lock(lock, request.environ["REMOTE_ADDR"])
 
 
 class EntryChangesResource(Resource):
 
     @marshal_with(fields.entry_changes)
     def get(self, entry_id, logbook_id=None):
-        entry = Entry.get(Entry.id == entry_id)
+        entry = get_entry(entry_id)
         return {"entry_changes": entry.changes}
@@ -25,5 +25,9 @@ errors = {
     "EntryRevisionDoesNotExist": dict(
         message="Entry revision does not exist!",
         status=404
+    ),
+    "UploadDoesNotExist": dict(
+        message="Upload does not exist!",
+        status=404
     )
 }
@@ -5,6 +5,8 @@ import json
 from flask_restful import fields, marshal, marshal_with_field
 import lxml
 
+from ..content import make_preview
+
 
 class NumberOf(fields.Raw):
     def format(self, value):
@@ -69,6 +71,15 @@ logbook = {
 }
 
 
+storage_usage = {
+    "logbook_id": fields.Integer,
+    "files": fields.Integer,
+    "bytes": fields.Integer,
+    "total_files": fields.Integer(default=None),
+    "total_bytes": fields.Integer(default=None),
+}
+
+
 authors = {
     "name": fields.String,
     "login": fields.String,
@@ -117,6 +128,16 @@ attachment = {
 }
 
 
+upload = {
+    "id": fields.String,
+    "filename": fields.String,
+    "content_type": fields.String,
+    "size": fields.Integer,
+    "offset": fields.Integer,
+    "created_at": fields.DateTime
+}
+
+
 class Followup(fields.Raw):
     "Since followups can contain followups, and so on, we need this"
     def format(self, value):
@@ -222,12 +243,18 @@ class FirstIfAny(fields.Raw):
 
 
 class ContentPreview(fields.Raw):
+    "Use the preview stored when the entry was written, if there is one"
+    def output(self, key, obj):
+        preview = fields.get_value("content_preview", obj)
+        if preview is not None:
+            return preview
+        return super().output(key, obj)
+
     def format(self, value):
         value = value.strip()
         if value:
             document = lxml.html.document_fromstring(value)
-            raw_text = document.text_content()
-            return raw_text[:200].strip().replace("\n", " ")
+            return make_preview(document.text_content())
 
 
 class DateTimeFromStringField(fields.DateTime):
@@ -1,8 +1,9 @@
 from flask_restful import Resource, marshal_with
+from peewee import fn
 from webargs.fields import Integer, Str, Boolean, Dict, List, Nested
 from webargs.flaskparser import use_args
 
-from ..db import Logbook
+from ..db import Logbook, StorageUsage
 from ..actions import new_logbook, edit_logbook
 from . import fields, send_signal
 
@@ -100,3 +101,29 @@ class LogbookChangesResource(Resource):
     def get(self, logbook_id):
         logbook = Logbook.get(Logbook.id == logbook_id)
         return {"logbook_changes": logbook.changes}
+
+
+class StorageUsageResource(Resource):
+
+    "The number and size of attachments in logbooks"
+
+    @marshal_with(fields.storage_usage, envelope="usage")
+    def get(self, logbook_id=None):
+        if logbook_id is None:
+            return list(StorageUsage.select()
+                        .order_by(StorageUsage.logbook))
+        logbook = Logbook.get(Logbook.id == logbook_id)
+        logbook_ids = [logbook.id] + [l.id for l in logbook.descendants]
+        files, size = (StorageUsage
+                       .select(fn.COALESCE(fn.SUM(StorageUsage.files), 0),
+                               fn.COALESCE(fn.SUM(StorageUsage.bytes), 0))
+                       .where(StorageUsage.logbook << logbook_ids)
+                       .tuples().get())
+        try:
+            usage = StorageUsage.get(StorageUsage.logbook == logbook.id)
+        except StorageUsage.DoesNotExist:
+            usage = StorageUsage(logbook=logbook.id)
+        # including the child logbooks
+        usage.total_files = files
+        usage.total_bytes = size
+        return usage
@@ -0,0 +1,141 @@
+"""
+Resumable uploads, for files too large to send in one request.
+
+The client first creates an upload, giving the file name and total
+size. The data is then sent in any number of PUT requests, each with a
+Content-Range header saying where the chunk belongs. Chunks must come
+in order; if a request fails, the client can ask how much data actually
+arrived (GET) and continue from there. Finally a POST turns the upload
+into an attachment.
+
+The data goes straight to disk, next to the attachment storage, and is
+hashed as it arrives, so finishing the upload does not need to read or
+copy the file again. (Unless the chunks were handled by different
+processes; then the file is read once when finishing.) Uploads that
+are abandoned are removed after UPLOAD_EXPIRY_DAYS, see reconcile.py.
+"""
+
+from datetime import datetime
+import mimetypes
+import uuid
+
+from flask import current_app, jsonify, request, url_for
+from flask_restful import Resource, abort, marshal_with
+from webargs.fields import Integer, Str, Boolean, Dict
+from webargs.flaskparser import use_args
+from werkzeug.http import parse_content_range_header
+
+from ..attachments import run_write_staged, save_staged
+from ..db import Attachment, Entry, Upload
+from ..images import schedule_thumbnail
+from ..storage import (UploadOffsetMismatch, finish_upload,
+                       get_attachment_path, remove_upload, start_upload,
+                       write_chunk)
+from . import fields
+
+
+upload_args = {
+    "filename": Str(required=True),
+    "size": Integer(required=True, validate=lambda s: s >= 0),
+    "content_type": Str(allow_none=True),
+    "entry_id": Integer(allow_none=True),
+    "embedded": Boolean(missing=False),
+    "metadata": Dict(allow_none=True),
+}
+
+
+class UploadsResource(Resource):
+
+    @use_args(upload_args)
+    @marshal_with(fields.upload, envelope="upload")
+    def post(self, args):
+        "Start a new upload"
+        if args.get("entry_id"):
+            Entry.get(Entry.id == args["entry_id"])  # check that it exists
+        content_type = (args.get("content_type") or
+                        mimetypes.guess_type(args["filename"])[0])
+        upload = Upload.create(id=uuid.uuid4().hex,
+                               filename=args["filename"],
+                               size=args["size"],
+                               content_type=content_type,
+                               entry=args.get("entry_id"),
+                               embedded=args["embedded"],
+                               metadata=args.get("metadata"))
+        start_upload(current_app.config["UPLOAD_FOLDER"], upload.id)
+        return upload
+
+
+class UploadResource(Resource):
+
+    @marshal_with(fields.upload, envelope="upload")
+    def get(self, upload_id):
+        "Check how far an upload has come"
+        return Upload.get(Upload.id == upload_id)
+
+    @marshal_with(fields.upload, envelope="upload")
+    def put(self, upload_id):
+        "Add a chunk of data to the upload"
+        upload = Upload.get(Upload.id == upload_id)
+        content_range = parse_content_range_header(
+            request.headers.get("Content-Range"))
+        if content_range is None:
+            abort(400, message="A valid Content-Range header is required.")
+        if content_range.length not in (None, upload.size):
+            abort(400, message="Content-Range does not match upload size.")
+        try:
+            # note that we read the body straight from the stream, so
+            # it's never held in memory as a whole.
+            offset = write_chunk(current_app.config["UPLOAD_FOLDER"],
+                                 upload.id, content_range.start, request.stream,
+                                 max_size=min(content_range.stop, upload.size))
+        except UploadOffsetMismatch as e:
+            abort(409, message="Chunk does not start at the current offset.",
+                  offset=e.offset)
+        except ValueError as e:
+            abort(400, message=str(e))
+        upload.offset = offset
+        upload.save(only=[Upload.offset])
+        return upload
+
+    def post(self, upload_id):
+        "Finish the upload, making it into an attachment"
+        upload = Upload.get(Upload.id == upload_id)
+        try:
+            staged = finish_upload(current_app.config["UPLOAD_FOLDER"],
+                                   upload.id, upload.size)
+        except UploadOffsetMismatch as e:
+            abort(409, message="Upload is not complete.", offset=e.offset)
+        attachment = Attachment(
+            path=get_attachment_path(staged.digest, upload.filename),
+            blob=staged.digest,
+            filename=upload.filename,
+            timestamp=datetime.utcnow(),
+            content_type=upload.content_type,
+            embedded=upload.embedded,
+            metadata=upload.metadata)
+        attachment.staged_blob = staged
+        # the upload stays if this fails, so that finishing can be
+        # tried again
+        run_write_staged([attachment], finish, upload.id, attachment)
+        remove_upload(current_app.config["UPLOAD_FOLDER"], upload.id)
+        schedule_thumbnail(attachment)
+        return jsonify(id=attachment.id,
+                       location=url_for("get_attachment",
+                                        path=attachment.path),
+                       content_type=attachment.content_type,
+                       filename=attachment.filename,
+                       metadata=attachment.metadata)
+
+    def delete(self, upload_id):
+        "Give up on the upload"
+        upload = Upload.get(Upload.id == upload_id)
+        remove_upload(current_app.config["UPLOAD_FOLDER"], upload.id)
+        return upload.delete_instance()
+
+
+def finish(upload_id, attachment):
+    # the upload may have been finished by someone else meanwhile
+    upload = Upload.get(Upload.id == upload_id)
+    if not Upload.delete().where(Upload.id == upload_id).execute():
+        abort(404, message="The upload is gone.")
+    save_staged(attachment, upload.entry_id)
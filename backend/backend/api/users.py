@@ -3,10 +3,6 @@ import grp
 
 from flask import current_app
 from flask_restful import Resource, marshal_with, reqparse
-try:
-    import ldap
-except ImportError:
-    ldap = None
 
 from . import fields
 
@@ -15,6 +11,9 @@ def search_ldap(server, basedn, search, max_results=20):
 
     "Search the ldap server for a user"
 
+    # imported here, since it's optional and only used if configured
+    import ldap
+
     l = ldap.initialize("ldap://" + server)
 
     # partial match against full name OR login
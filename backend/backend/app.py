@@ -2,20 +2,35 @@
 The main entrypoint of the Elogy web application
 """
 
+import mimetypes
+import os
+from threading import Lock
 from time import time
 
-from flask import Flask, current_app, send_from_directory, g, request
+import click
+from flask import (Flask, current_app, send_from_directory, g, request,
+                   safe_join)
 from flask_restful import Api
 import logging
+from werkzeug.wsgi import DispatcherMiddleware
 
 from .api.errors import errors as api_errors
-from .api.logbooks import LogbooksResource, LogbookChangesResource
+from .api.logbooks import (LogbooksResource, LogbookChangesResource,
+                           StorageUsageResource)
 from .api.entries import (EntryResource, EntriesResource,
                           EntryLockResource, EntryChangesResource)
 from .api.users import UsersResource
 from .api.attachments import AttachmentsResource
-from .db import setup_database
-from .admin import setup_admin
+from .api.uploads import UploadsResource, UploadResource
+from .db import db, setup_database
+from .attachments import send_attachment_file
+from .metrics import setup_metrics
+from .profiler import setup_profiler
+from .renditions import send_rendition
+from .storage import get_disk_path
+from .locks import setup_locks
+from .maintenance import TASKS, ensure_scheduler, setup_maintenance
+from .writequeue import setup_write_queue
 
 
 # Configure the main application object
@@ -30,16 +45,79 @@ app.secret_key = app.config["SECRET"]
 @app.before_request
 def before_request():
     g.start = time()
+    if request.method in ("GET", "HEAD"):
+        # reads can use the read only connections, see db.py
+        db.use_read_pool()
+    ensure_scheduler()
 
 
 @app.teardown_request
 def teardown_request(exception=None):
+    db.release_read_connection()
     duration = time() - g.start
     current_app.logger.debug("Request took %f s", duration)
 
 
-setup_database(app.config["DATABASE"]["name"])
-setup_admin(app)
+database = app.config["DATABASE"]
+setup_database(database["name"],
+               engine=database.get("engine"),
+               journal_mode=database.get("journal_mode"),
+               read_pool_size=app.config.get("READ_POOL_SIZE", 0),
+               busy_timeout=app.config.get("BUSY_TIMEOUT", 5.0),
+               archive_folder=app.config.get("ARCHIVE_FOLDER") or None,
+               wal_autocheckpoint=app.config.get("WAL_AUTOCHECKPOINT"),
+               **{key: database[key]
+                  for key in ("host", "port", "user", "password")
+                  if key in database})
+setup_metrics(app)
+setup_profiler(app)
+setup_write_queue(app)
+setup_locks(app)
+setup_maintenance(app)
+
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    pass  # not running in uWSGI
+else:
+    # with uWSGI, the app is normally loaded once and then forked
+    # into the workers, which must not share connections
+    postfork(db.after_fork)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=db.after_fork)
+
+
+class LazyApp:
+
+    "A WSGI app that is only created on its first request"
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._app = None
+        self._lock = Lock()
+
+    def __call__(self, environ, start_response):
+        if self._app is None:
+            with self._lock:
+                if self._app is None:
+                    self._app = self._factory()
+        return self._app(environ, start_response)
+
+
+def make_admin_app():
+    """The admin interface is a separate app, so that flask_admin only
+    gets loaded if someone actually uses it"""
+    from .admin import setup_admin
+    admin_app = Flask(__name__, static_folder=None)
+    admin_app.config.update(app.config)
+    admin_app.secret_key = app.secret_key
+    setup_admin(admin_app, url="/")
+    return admin_app
+
+
+app.wsgi_app = DispatcherMiddleware(app.wsgi_app,
+                                    {"/admin": LazyApp(make_admin_app)})
 
 
 # Allow CORS requests. Maybe we should only enable this in debug mode?
@@ -61,6 +139,10 @@ api.add_resource(LogbooksResource,
 api.add_resource(LogbookChangesResource,
                  "/logbooks/<int:logbook_id>/revisions/")
 
+api.add_resource(StorageUsageResource,
+                 "/logbooks/usage",
+                 "/logbooks/<int:logbook_id>/usage")
+
 api.add_resource(EntriesResource,
                  "/logbooks/<int:logbook_id>/entries/")  # GET
 
@@ -86,11 +168,39 @@ api.add_resource(AttachmentsResource,
                  "/logbooks/<int:logbook_id>/entries/<int:entry_id>/attachments/<int:attachment_id>",
                  "/attachments/")
 
+api.add_resource(UploadsResource,
+                 "/uploads/")
+
+api.add_resource(UploadResource,
+                 "/uploads/<upload_id>")
+
 
 # other routes
 @app.route('/attachments/<path:path>')
 def get_attachment(path):
-    return send_from_directory(current_app.config["UPLOAD_FOLDER"], path)
+    if "width" in request.args:
+        # a resized version of an image, e.g. ?width=400&format=webp
+        rendition = send_rendition(path, request.args.get("width", type=int),
+                                   request.args.get("format", "jpeg"))
+        if rendition:
+            return rendition
+    upload_folder = current_app.config["UPLOAD_FOLDER"]
+    immutable = True
+    if (path.endswith(".thumbnail") and not os.path.exists(
+            safe_join(upload_folder, get_disk_path(path)))):
+        # The thumbnail is not done yet (or could not be made), so
+        # we'll have to make do with the original. Should not be
+        # cached for long, though.
+        path = path[:-len(".thumbnail")]
+        immutable = False
+    disk_path = get_disk_path(path)
+    if disk_path == path:
+        # old style path, not content addressed
+        return send_attachment_file(path)
+    # The file name is only part of the URL, the file itself is
+    # named by its hash so we need to supply the type.
+    mimetype, _ = mimetypes.guess_type(path)
+    return send_attachment_file(disk_path, mimetype, immutable=immutable)
 
 
 @app.route("/")
@@ -105,6 +215,61 @@ def get_index(path=None):
     return send_from_directory("frontend/build", "index.html")
 
 
+@app.cli.command("collect-garbage")
+@click.option("--grace", default=86400,
+              help="Leave files changed in the last GRACE seconds alone")
+@click.option("--dry-run", is_flag=True,
+              help="Only report orphaned files, don't move them")
+def collect_garbage_command(grace, dry_run):
+    "Quarantine attachment files that nothing uses, see reconcile.py"
+    from .reconcile import collect_garbage
+    stats = collect_garbage(app.config["UPLOAD_FOLDER"], grace=grace,
+                            purge_days=app.config.get("QUARANTINE_DAYS"),
+                            upload_expiry_days=app.config.get(
+                                "UPLOAD_EXPIRY_DAYS"),
+                            dry_run=dry_run)
+    for key, value in stats.items():
+        click.echo("{}: {}".format(key, value))
+
+
+@app.cli.command("archive-entries")
+@click.option("--days", type=int, default=None,
+              help="Archive threads with no activity in DAYS days")
+@click.option("--dry-run", is_flag=True,
+              help="Only count the threads, don't move them")
+def archive_entries_command(days, dry_run):
+    "Move old entries to the archive databases, see archive.py"
+    from .archive import archive_entries
+    folder = app.config.get("ARCHIVE_FOLDER")
+    if not folder:
+        raise click.UsageError("ARCHIVE_FOLDER is not configured")
+    if days is None:
+        days = app.config.get("ARCHIVE_AFTER_DAYS")
+    threads, entries = archive_entries(folder, days=days, dry_run=dry_run)
+    click.echo("threads: {}".format(threads))
+    click.echo("entries: {}".format(entries))
+
+
+@app.cli.command("maintenance")
+@click.option("--task", "tasks", multiple=True, type=click.Choice(TASKS),
+              help="Only run the given task (may be repeated)")
+@click.option("--checkpoint-mode", default="TRUNCATE",
+              type=click.Choice(["PASSIVE", "FULL", "RESTART", "TRUNCATE"]))
+@click.option("--enable-incremental-vacuum", is_flag=True,
+              help="First switch the database to incremental auto_vacuum "
+                   "(rewrites the whole file)")
+def maintenance_command(tasks, checkpoint_mode, enable_incremental_vacuum):
+    "Analyze, vacuum and checkpoint the database, see maintenance.py"
+    from .maintenance import enable_incremental_vacuum as enable
+    from .maintenance import run_maintenance
+    if enable_incremental_vacuum:
+        enable()
+    stats = run_maintenance(tasks or TASKS, checkpoint_mode=checkpoint_mode,
+                            vacuum_step=app.config.get("VACUUM_STEP", 1000))
+    for key, value in stats.items():
+        click.echo("{}: {}".format(key, value))
+
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=8000, #debug=True,
             extra_files=["templates"])  # this makes sure templates are watched
@@ -0,0 +1,366 @@
+"""
+Moving old entries out of the main database.
+
+Most entries are never looked at again after a while, but they still
+take up space in the indexes, the page cache and the backups. Threads
+where nothing has happened for ARCHIVE_AFTER_DAYS days, and threads in
+archived logbooks, can be moved (with their changes) to a separate
+SQLite database per year, in the ARCHIVE_FOLDER:
+
+    <ARCHIVE_FOLDER>/elogy-archive-<year>.db
+
+The year is the one the thread was started. Attachments stay in the
+main database, so that the storage (see storage.py) does not need to
+know about the archives.
+
+The archives are ATTACHed to the database connections when needed,
+read only except when moving entries. Listings and searches only look
+in the main database, unless asked to include the archives, see
+Entry.search(). Entries that are asked for by id are also looked for
+in the archives (see get_archived_entry()). Archived entries can't be
+changed.
+
+Each batch of threads is first copied to the archive and then deleted
+from the main database, in separate transactions; in WAL mode a
+transaction involving several databases is not atomic as a whole. If
+interrupted, running it again copies the same entries again. Entries
+may also be changed in between; before deleting, each thread is
+checked to still be in the archive as it is in the main database (and
+to still be old enough). If not, its copy is removed from the archive
+instead, and it's left for the next time.
+
+Since entries are looked for in the archives by id, ids must never be
+given out again once archived; see db.AutoIncrementField.
+
+Run it from the command line, e.g. every night:
+
+$ FLASK_APP=backend.app ELOGY_CONFIG_FILE=../config.py flask archive-entries
+"""
+
+from datetime import datetime, timedelta
+import logging
+import os
+import re
+import sqlite3
+from urllib.request import pathname2url
+
+from .db import db, Entry, EntryChange, EntryLock, Logbook
+
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_NAME = re.compile(r"^elogy-archive-(\d{4})\.db$")
+
+# the tables that are archived
+ARCHIVED_MODELS = (Entry, EntryChange)
+
+
+def get_archive_path(folder, year):
+    return os.path.join(folder, "elogy-archive-{}.db".format(year))
+
+
+def list_archives(folder):
+    "The archive databases in the folder, by schema name"
+    try:
+        filenames = sorted(os.listdir(folder))
+    except FileNotFoundError:
+        return {}
+    archives = {}
+    for filename in filenames:
+        match = ARCHIVE_NAME.match(filename)
+        if match:
+            archives["archive_" + match.group(1)] = os.path.join(
+                folder, filename)
+    return archives
+
+
+def _table_columns(conn, schema):
+    return {model._meta.db_table: set(
+        row[1] for row in conn.execute("PRAGMA {}.table_info({})".format(
+            schema, model._meta.db_table)))
+        for model in ARCHIVED_MODELS}
+
+
+def attach_archives(conn, folder, read_only=False):
+    """Attach any archive databases in the folder that the connection
+    does not already have. A read only connection must have been
+    opened with uri=True. Returns the columns of the archived tables,
+    by schema name."""
+    attached = {row[1]: row[2]
+                for row in conn.execute("PRAGMA database_list")}
+    archives = {}
+    for schema, path in list_archives(folder).items():
+        if attached.get(schema) != os.path.abspath(path):
+            try:
+                if schema in attached:
+                    # the folder has changed
+                    conn.execute("DETACH DATABASE {}".format(schema))
+                if read_only:
+                    path = "file:{}?mode=ro".format(
+                        pathname2url(os.path.abspath(path)))
+                conn.execute("ATTACH DATABASE ? AS {}".format(schema),
+                             (path,))
+            except sqlite3.OperationalError as e:
+                # e.g. in a transaction, or too many archives
+                logger.warning("Could not attach %s: %s", path, e)
+                continue
+        archives[schema] = _table_columns(conn, schema)
+    return archives
+
+
+def _columns(model):
+    return [field.db_column for field in model._meta.sorted_fields]
+
+
+def _select_archived(model, schema, tables):
+    # columns that the archive does not have (e.g. added later) are NULL
+    present = tables[model._meta.db_table]
+    return "SELECT {} FROM {}.{}".format(
+        ", ".join('"{0}"'.format(column) if column in present
+                  else 'NULL AS "{0}"'.format(column)
+                  for column in _columns(model)),
+        schema, model._meta.db_table)
+
+
+def archive_source(model, archives):
+    """SQL for a subquery giving the rows of the model's table from the
+    main database as well as the archives."""
+    selects = ["SELECT {} FROM main.{}".format(
+        ", ".join('"{}"'.format(column) for column in _columns(model)),
+        model._meta.db_table)]
+    selects.extend(_select_archived(model, schema, tables)
+                   for schema, tables in sorted(archives.items()))
+    return "({})".format(" UNION ALL ".join(selects))
+
+
+def _archived(model, archives, where, *params):
+    "Rows of the model's table from the archives only"
+    query = "SELECT * FROM ({}) AS {} WHERE {}".format(
+        " UNION ALL ".join(_select_archived(model, schema, tables)
+                           for schema, tables in sorted(archives.items())),
+        model._meta.db_table, where)
+    return model.raw(query, *params)
+
+
+def get_archived_entry(entry_id):
+    """Look for an entry in the archives. Raises Entry.DoesNotExist if
+    it's not there either. Its changes are all loaded."""
+    archives = db.archive_schemas()
+    entry = None
+    if archives:
+        entry = next(iter(_archived(Entry, archives, "id = ?", entry_id)),
+                     None)
+    if entry is None:
+        raise Entry.DoesNotExist(
+            "Entry {} does not exist, not even in the archives"
+            .format(entry_id))
+    entry.archive = archives
+    # hides the relation, which would look in the main database
+    entry.changes = list(_archived(EntryChange, archives,
+                                   "entry_id = ? ORDER BY id", entry_id))
+    for change in entry.changes:
+        change._obj_cache["entry"] = entry
+    return entry
+
+
+def get_archived_thread(entry):
+    "The entries in the thread of an archived entry, see Entry.load_thread()"
+    entries = list(_archived(Entry, entry.archive, "thread_id = ? ORDER BY id",
+                             entry.thread_id or entry.id))
+    for other in entries:
+        other.archive = entry.archive
+        if other.id == entry.id:
+            other.changes = entry.changes
+    return entries
+
+
+def _create_tables(schema):
+    "Create the archived tables in the archive, or add any missing columns"
+    for model in ARCHIVED_MODELS:
+        table = model._meta.db_table
+        sql, = db.execute_sql(
+            "SELECT sql FROM main.sqlite_master WHERE type = 'table' "
+            "AND name = ?", (table,)).fetchone()
+        db.execute_sql(sql.replace(
+            "CREATE TABLE ", "CREATE TABLE IF NOT EXISTS {}.".format(schema),
+            1))
+        columns = set(row[1] for row in db.execute_sql(
+            "PRAGMA {}.table_info({})".format(schema, table)))
+        for row in db.execute_sql("PRAGMA main.table_info({})".format(table)):
+            if row[1] not in columns:
+                db.execute_sql('ALTER TABLE {}.{} ADD COLUMN "{}" {}'.format(
+                    schema, table, row[1], row[2]))
+    db.execute_sql("CREATE INDEX IF NOT EXISTS {0}.entry_thread_id "
+                   "ON entry (thread_id)".format(schema))
+    db.execute_sql("CREATE INDEX IF NOT EXISTS {0}.entrychange_entry_id "
+                   "ON entrychange (entry_id)".format(schema))
+
+
+def _attach_for_writing(folder, year):
+    schema = "archive_{}".format(year)
+    path = os.path.abspath(get_archive_path(folder, year))
+    attached = {row[1]: row[2]
+                for row in db.execute_sql("PRAGMA database_list")}
+    if attached.get(schema) != path:
+        if schema in attached:
+            db.execute_sql("DETACH DATABASE {}".format(schema))
+        db.execute_sql("ATTACH DATABASE ? AS {}".format(schema), (path,))
+    _create_tables(schema)
+    return schema
+
+
+def _copy_threads(schema, thread_ids):
+    """Copy the threads to the archive. Copies of the same rows left by
+    an earlier, interrupted run are replaced, but other rows with the
+    same ids are not; then this fails with an IntegrityError."""
+    threads = ", ".join("?" * len(thread_ids))
+    entry_ids = "SELECT id FROM main.entry WHERE thread_id IN ({})".format(
+        threads)
+    with db.atomic():
+        db.execute_sql(
+            "DELETE FROM {}.entrychange WHERE EXISTS ("
+            "SELECT 1 FROM main.entrychange AS change "
+            "WHERE change.id = entrychange.id "
+            "AND change.entry_id = entrychange.entry_id "
+            "AND change.entry_id IN ({}))".format(schema, entry_ids),
+            thread_ids)
+        db.execute_sql(
+            "DELETE FROM {}.entry WHERE EXISTS ("
+            "SELECT 1 FROM main.entry AS original "
+            "WHERE original.id = entry.id "
+            "AND original.created_at IS entry.created_at "
+            "AND original.thread_id IN ({}))".format(schema, threads),
+            thread_ids)
+        for model, where in [(Entry, "thread_id IN ({})".format(threads)),
+                             (EntryChange, "entry_id IN ({})".format(
+                                 entry_ids))]:
+            table = model._meta.db_table
+            columns = ", ".join('"{}"'.format(column)
+                                for column in _columns(model))
+            db.execute_sql(
+                "INSERT INTO {schema}.{table} ({columns}) "
+                "SELECT {columns} FROM main.{table} WHERE {where}".format(
+                    schema=schema, table=table, columns=columns,
+                    where=where),
+                thread_ids)
+
+
+def _changed_threads(schema, thread_ids):
+    """The threads whose entries are not in the archive the way they are
+    in the main database, e.g. since they were changed after copying"""
+    threads = ", ".join("?" * len(thread_ids))
+    # the revision changes along with the entry's changes
+    cursor = db.execute_sql(
+        "SELECT entry.thread_id FROM main.entry AS entry "
+        "LEFT JOIN {schema}.entry AS copy ON copy.id = entry.id "
+        "AND copy.revision IS entry.revision "
+        "AND copy.last_changed_at IS entry.last_changed_at "
+        "WHERE entry.thread_id IN ({threads}) AND copy.id IS NULL "
+        "UNION "
+        "SELECT copy.thread_id FROM {schema}.entry AS copy "
+        "LEFT JOIN main.entry AS entry ON entry.id = copy.id "
+        "WHERE copy.thread_id IN ({threads}) AND entry.id IS NULL".format(
+            schema=schema, threads=threads),
+        list(thread_ids) * 2)
+    return set(row[0] for row in cursor)
+
+
+def _delete_threads(schema, thread_ids):
+    "Delete the threads from the given database"
+    threads = ", ".join("?" * len(thread_ids))
+    entry_ids = "SELECT id FROM {}.entry WHERE thread_id IN ({})".format(
+        schema, threads)
+    tables = [EntryChange] + ([EntryLock] if schema == "main" else [])
+    for table in tables:
+        db.execute_sql(
+            "DELETE FROM {}.{} WHERE entry_id IN ({})".format(
+                schema, table._meta.db_table, entry_ids), thread_ids)
+    return db.execute_sql(
+        "DELETE FROM {}.entry WHERE thread_id IN ({})".format(
+            schema, threads), thread_ids).rowcount
+
+
+def move_threads(folder, year, thread_ids, condition=None):
+    """Move the given threads to the archive for the year, if they
+    (still) meet the condition on their first entry. Returns the number
+    of threads and entries moved."""
+    schema = _attach_for_writing(folder, year)
+    _copy_threads(schema, thread_ids)
+    with db.atomic():
+        if condition is None:
+            moved = set(thread_ids)
+        else:
+            moved = set(root.id for root in
+                        Entry.select(Entry.id)
+                        .join(Logbook)
+                        .where((Entry.id << thread_ids) & condition))
+        moved -= _changed_threads(schema, thread_ids)
+        skipped = [thread_id for thread_id in thread_ids
+                   if thread_id not in moved]
+        if skipped:
+            # copied again next time, if still to be archived
+            _delete_threads(schema, skipped)
+        n_entries = _delete_threads("main", sorted(moved)) if moved else 0
+    return len(moved), n_entries
+
+
+def reserve_archived_ids(folder):
+    """Make sure that the ids of the rows in the archives are not given
+    out again. The tables use AUTOINCREMENT (see db.AutoIncrementField),
+    so this is only needed for rows archived before they did."""
+    archives = attach_archives(db.get_conn(), folder)
+    if not archives:
+        return
+    with db.atomic():
+        for model in ARCHIVED_MODELS:
+            table = model._meta.db_table
+            highest = max(db.execute_sql("SELECT max(id) FROM {}.{}".format(
+                schema, table)).fetchone()[0] or 0 for schema in archives)
+            updated = db.execute_sql(
+                "UPDATE main.sqlite_sequence SET seq = max(seq, ?) "
+                "WHERE name = ?", (highest, table)).rowcount
+            if not updated:
+                db.execute_sql("INSERT INTO main.sqlite_sequence (name, seq) "
+                               "VALUES (?, ?)", (table, highest))
+
+
+def archive_entries(folder, days=None, batch_size=500, dry_run=False):
+    """Move threads with no activity in the last 'days' days, and
+    threads in archived logbooks, to the archives. Returns the number
+    of threads and entries moved."""
+    if db.dialect.name != "sqlite":
+        raise RuntimeError("Archiving is only supported for SQLite")
+    os.makedirs(folder, exist_ok=True)
+    if not dry_run:
+        reserve_archived_ids(folder)
+    condition = Logbook.archived
+    if days is not None:
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        condition |= Entry.sort_ts < cutoff
+    n_threads = n_entries = 0
+    last_id = 0
+    while True:
+        # thread roots, a batch at a time
+        roots = list(Entry.select(Entry.id, Entry.created_at)
+                     .join(Logbook)
+                     .where((Entry.id == Entry.thread_id) &
+                            (Entry.id > last_id) & condition)
+                     .order_by(Entry.id)
+                     .limit(batch_size))
+        if not roots:
+            break
+        last_id = roots[-1].id
+        by_year = {}
+        for root in roots:
+            by_year.setdefault(root.created_at.year, []).append(root.id)
+        for year, thread_ids in sorted(by_year.items()):
+            if dry_run:
+                n_threads += len(thread_ids)
+            else:
+                threads, entries = move_threads(folder, year, thread_ids,
+                                                condition)
+                n_threads += threads
+                n_entries += entries
+        logger.info("Archived %d threads (%d entries), up to id %d",
+                    n_threads, n_entries, last_id)
+    return n_threads, n_entries
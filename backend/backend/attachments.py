@@ -1,24 +1,20 @@
 """Utilities for dealing with attachments, e.g. arbitrary (well...)
 files that are uploaded as part of an entry. They are stored as
-original files, in a configurable location on disk.
+original files, in a configurable location on disk (see storage.py).
 """
 
 from base64 import decodestring
-import binascii
-from datetime import datetime
-from dateutil.parser import parse
-import io
 import mimetypes
 import os
+from urllib.parse import quote
 
-from flask import (Blueprint, abort, request, url_for, redirect,
-                   current_app, jsonify, send_from_directory)
-from lxml import html, etree
-from lxml.html.clean import Cleaner
-from PIL import Image
-from werkzeug import FileStorage
+from flask import abort, current_app, send_from_directory, safe_join
 
 from .db import Entry, Attachment
+from .storage import (store_blob, stage_blob, reference_blob, commit_blob,
+                      discard_blob, unreference_blob, remove_blob,
+                      get_attachment_path)
+from .writequeue import run_write
 
 
 def allowed_file(filename):
@@ -39,54 +35,22 @@ def get_content_type(file_):
     return type_
 
 
-def save_attachment(file_, timestamp, entry_id, metadata=None, embedded=False):
-    "Store an attachment in the proper place"
-    # make up a path and unique filename using the timestamp
-    # TODO: make this smarter, somehow
-    today = timestamp.strftime("%Y/%m/%d")
-    epoch = timestamp.strftime("%s")
-    upload_dir = os.path.join(current_app.config["UPLOAD_FOLDER"], today)
-    if not os.path.exists(upload_dir):
-        os.makedirs(upload_dir)
+def save_attachment(file_, timestamp, entry_id, metadata=None, embedded=False,
+                    staged=False):
+    """Store an attachment in the proper place. If 'staged' is given,
+    the file is only staged, and the attachment must be saved with
+    save_staged() and then stored with store_staged()."""
     # make sure there's no path part in the filename
     sanitized_filename = os.path.basename(file_.filename)
-    prefixed_filename = "{}-{}".format(epoch, sanitized_filename)
-    path = os.path.join(upload_dir, prefixed_filename)
-    # store the attachment at the unique path
-    file_.save(path)
-    try:
-        # If it's an image file we create a thumbnail version for preview
-        image = Image.open(file_)
-        width, height = image.size
-        new_metadata = dict(size={"width": width, "height": height})
-        if metadata:
-            new_metadata.update(**metadata)
-        if width > 100 or height > 100:
-            # create a tiny version of the image
-            image.convert("RGB")
-            image.thumbnail((100, 100))
-            if ((image.mode in ("RGBA", "LA")) or
-                (image.mode == 'P' and "transparency" in image.info)):
-                # image has transparency. Since JPEG does not support alpha
-                # channel, we'll superimpose it on a white background.
-                alpha = image.convert("RGBA").split()[-1]
-                bg = Image.new("RGB", image.size, (255, 255, 255, 255))
-                bg.paste(image, mask=alpha)
-                image = bg
-            try:
-                image.save(path + ".thumbnail", "JPEG")
-                width, height = image.size
-                new_metadata["thumbnail_size"] = {"width": width,
-                                                  "height": height}
-            except IOError as e:
-                print("Error making thumbnail", e)
-        else:
-            # small image, re-use it as its own thumbnail
-            os.link(path, path + ".thumbnail")
-    except IOError as e:
-        # Not a recognized image, no thumbnail
-        # TODO: thumbnails of PDF:s and maybe some other formats might be nice
-        new_metadata = metadata
+    # Files are stored by their contents, so that identical files are
+    # only stored once. Any image processing (thumbnails etc) is done
+    # later, see images.schedule_thumbnail().
+    if staged:
+        staged_blob = stage_blob(current_app.config["UPLOAD_FOLDER"], file_)
+        digest = staged_blob.digest
+    else:
+        staged_blob = None
+        digest = store_blob(current_app.config["UPLOAD_FOLDER"], file_)
 
     if entry_id:
         entry = Entry.get(Entry.id == entry_id)
@@ -95,17 +59,129 @@ def save_attachment(file_, timestamp, entry_id, metadata=None, embedded=False):
 
     content_type = get_content_type(file_)
 
-    attachment = Attachment(path="{}/{}".format(today, prefixed_filename),
+    attachment = Attachment(path=get_attachment_path(digest,
+                                                     sanitized_filename),
+                            blob=digest,
                             filename=sanitized_filename,
                             timestamp=timestamp,
                             content_type=content_type,
                             entry=entry, embedded=embedded,
-                            metadata=new_metadata)
+                            metadata=metadata)
+    attachment.staged_blob = staged_blob
     return attachment
 
 
-html_clean = Cleaner(style=True, inline_style=False,
-                     safe_attrs=html.defs.safe_attrs | set(['style']))
+# Attachments found in entry content are staged, so that the entry and
+# its attachments can be written in a single transaction. The files are
+# only put in storage once that has been committed, and removed if it
+# failed, so there are no files left over without an attachment. If
+# elogy stops in between, the attachment is committed but its file is
+# still staged, until the next garbage collection (see reconcile.py).
+
+def save_staged(attachment, entry):
+    "Save a staged attachment to the entry. Call in the write transaction."
+    staged = attachment.staged_blob
+    reference_blob(staged.digest, staged.size)
+    attachment.entry = entry
+    attachment.save()
+
+
+def store_staged(attachments):
+    "Put the files of saved attachments in storage, after commit"
+    for attachment in attachments:
+        commit_blob(current_app.config["UPLOAD_FOLDER"],
+                    attachment.staged_blob)
+        attachment.staged_blob = None
+
+
+def discard_staged(attachments):
+    "Throw away staged attachments, e.g. if the transaction failed"
+    for attachment in attachments:
+        if attachment.staged_blob is not None:
+            discard_blob(attachment.staged_blob)
+            attachment.staged_blob = None
+
+
+def run_write_staged(attachments, function, *args):
+    """Like run_write(), also putting the staged attachments in storage
+    once the write has been committed (or throwing them away if it
+    failed)."""
+    try:
+        result = run_write(function, *args)
+    except Exception:
+        discard_staged(attachments)
+        raise
+    store_staged(attachments)
+    return result
+
+
+def delete_attachment(attachment):
+    """Remove the attachment, dropping its reference to the blob. Call
+    in the write transaction, so that the blob references always match
+    the attachments (see reconcile.py), and then remove_attachment_file()
+    after commit."""
+    result = attachment.delete_instance()
+    if attachment.blob_id:
+        unreference_blob(attachment.blob_id)
+    return result
+
+
+def remove_attachment_file(attachment):
+    "Remove the file of a deleted attachment, unless someone else uses it"
+    upload_folder = current_app.config["UPLOAD_FOLDER"]
+    if attachment.blob_id:
+        remove_blob(upload_folder, attachment.blob_id)
+    elif not (Attachment.select()
+              .where(Attachment.path == attachment.path).exists()):
+        # an old style attachment, with a file of its own
+        path = safe_join(upload_folder, attachment.path)
+        for filename in (path, path + ".thumbnail"):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+
+# Content addressed files never change, so they can be cached "forever"
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def send_attachment_file(disk_path, mimetype=None, immutable=False):
+    """Respond with a file from the upload folder.
+
+    Depending on the ATTACHMENT_OFFLOAD setting, the work of actually
+    sending the file can be left to the web server in front of us, which
+    is much more efficient for large files than streaming them through
+    python. The web server then also takes care of range requests."""
+    upload_folder = current_app.config["UPLOAD_FOLDER"]
+    offload = current_app.config.get("ATTACHMENT_OFFLOAD")
+    if offload:
+        full_path = safe_join(upload_folder, disk_path)
+        if not os.path.isfile(full_path):
+            abort(404)
+        response = current_app.response_class(
+            mimetype=(mimetype or mimetypes.guess_type(disk_path)[0] or
+                      "application/octet-stream"))
+        if offload == "x-accel-redirect":
+            # nginx; the prefix should be an "internal" location
+            prefix = current_app.config.get("ATTACHMENT_OFFLOAD_PREFIX",
+                                            "/protected-attachments/")
+            response.headers["X-Accel-Redirect"] = quote(
+                prefix.rstrip("/") + "/" + disk_path)
+        elif offload == "x-sendfile":
+            # e.g. apache with mod_xsendfile, or lighttpd
+            response.headers["X-Sendfile"] = full_path
+        else:
+            raise ValueError("Unknown ATTACHMENT_OFFLOAD setting: {}"
+                             .format(offload))
+    else:
+        response = send_from_directory(
+            upload_folder, disk_path, mimetype=mimetype,
+            cache_timeout=IMMUTABLE_MAX_AGE if immutable else None)
+    if immutable:
+        response.headers["Cache-Control"] = (
+            "public, max-age={}, immutable".format(IMMUTABLE_MAX_AGE))
+    return response
 
 
 def decode_base64(data):
@@ -119,72 +195,3 @@ def decode_base64(data):
     if missing_padding != 0:
         data += b'=' * (4 - missing_padding)
     return decodestring(data)
-
-
-def handle_img_tags(text, entry_id=None, timestamp=None):
-    """Get image tags from the text. Extract embedded images and save
-    them as attachments"""
-    attachments = []
-    timestamp = timestamp or datetime.now()
-    try:
-        doc = html.document_fromstring(text)
-    except etree.ParserError:
-        return text, attachments
-
-    for i, element in enumerate(doc.xpath("//*[@src]")):
-        src = element.attrib['src'].split("?", 1)[0]
-        if src.startswith("data:"):
-            header, data = src[5:].split(",", 1)  # TODO: find a safer way
-            filetype, encoding = header.split(";")
-            try:
-                raw_image = decode_base64(data.encode("ascii"))
-            except binascii.Error as e:
-                print("failed to decode image!", e)
-                continue
-            try:
-                # TODO: possible to be more clever about the filename?
-                filename = "inline-{}-{}.{}".format(
-                    len(raw_image), i, filetype.split("/")[1].lower())
-            except IndexError:
-                print("weird filetype!?", filetype)
-                continue
-            file_ = FileStorage(io.BytesIO(raw_image),
-                                filename=filename, content_type=filetype)
-            attachment = save_attachment(file_, timestamp, entry_id,
-                                         embedded=True)
-            # TODO: maybe it would be a better idea to use a URL like
-            # "/attachments/<id>" here, and then just have a redirect
-            # to the real URI? That way we could change the way the files
-            # are stored under the hood without bothering about having
-            # to keep URLs unchanged...
-            src = element.attrib["src"] = url_for("get_attachment",
-                                                  path=attachment.path)
-            if element.getparent().tag == "a":
-                element.getparent().attrib["href"] = src
-            else:
-                parent = element.getparent()
-
-                wrapper = etree.Element('a')
-                wrapper.attrib['href'] = src
-
-                loc = parent.index(element)
-                parent.insert(loc, wrapper)
-
-                parent.remove(element)
-                wrapper.append(element)
-
-            attachments.append(attachment)
-
-    # throw in a cleanup here since we've already parsed the HTML
-    html_clean(doc)  # remove some evil tags
-    content = '\n'.join(
-        (etree
-         .tostring(stree, pretty_print=True, method="xml")
-         .decode("utf-8")
-         .strip())
-        for stree in doc[0].iterchildren()
-    )
-
-    return content, attachments
-
-
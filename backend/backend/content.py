@@ -0,0 +1,196 @@
+"""
+Processing of entry content, done once when an entry is written.
+
+The HTML is parsed into a tree a single time, and then a number of
+"stages" are run over the same tree, in order. Each stage is a function
+taking a ProcessedContent object, which it may modify. The stages that
+come with elogy:
+
+- extract_inline_images: save embedded (base64) images as attachments
+  (staged, see attachments.save_staged())
+- sanitize: remove unsafe tags and attributes
+- extract_links: the targets of all links (e.g. for fixing imported ones)
+- extract_text: plain text, and a short preview for entry lists
+- count_words: number of words in the text
+
+The links and the word count are stored in the entry metadata (see
+ProcessedContent.metadata) and the preview in the entry itself.
+
+Only what is stored with the entry is worth doing here, since this is
+done in every request that writes an entry. More stages can be added
+(e.g. by passing 'stages' to process_content()) when needed.
+
+Content without any markup is not parsed at all. Each stage is timed,
+and the times are available on the result (and logged at debug level).
+To try it on large documents, see benchmark/content.py.
+"""
+
+from binascii import Error as Base64Error
+from datetime import datetime
+import io
+import logging
+from time import perf_counter
+
+from flask import url_for
+from lxml import html, etree
+from lxml.html.clean import Cleaner
+from werkzeug import FileStorage
+
+from .attachments import save_attachment, decode_base64, discard_staged
+
+
+PREVIEW_LENGTH = 200
+
+
+class ProcessedContent:
+
+    "The content of an entry, and things found in it"
+
+    def __init__(self, content, content_type="text/html",
+                 entry_id=None, timestamp=None):
+        self.content = content
+        self.content_type = content_type
+        self.entry_id = entry_id
+        self.timestamp = timestamp or datetime.now()
+        self.tree = None  # the parsed HTML, if any
+        self.attachments = []
+        self.links = []
+        self.text = None
+        self.preview = None
+        self.word_count = None
+        self.timings = {}
+
+    @property
+    def is_html(self):
+        return self.content_type.startswith("text/html")
+
+    @property
+    def metadata(self):
+        "What is worth storing in the entry metadata"
+        return {"links": self.links, "word_count": self.word_count}
+
+    def serialize(self):
+        "Turn the tree back into HTML"
+        return '\n'.join(
+            (etree
+             .tostring(stree, pretty_print=True, method="xml")
+             .decode("utf-8")
+             .strip())
+            for stree in self.tree[0].iterchildren()
+        )
+
+
+def has_markup(content):
+    return "<" in content or "&" in content
+
+
+def make_preview(text):
+    return text[:PREVIEW_LENGTH].strip().replace("\n", " ")
+
+
+def extract_inline_images(result):
+    """Get image tags from the content. Extract embedded images and
+    save them as attachments"""
+    for i, element in enumerate(result.tree.xpath("//*[@src]")):
+        src = element.attrib['src'].split("?", 1)[0]
+        if not src.startswith("data:"):
+            continue
+        header, data = src[5:].split(",", 1)  # TODO: find a safer way
+        filetype, encoding = header.split(";")
+        try:
+            raw_image = decode_base64(data.encode("ascii"))
+        except Base64Error as e:
+            logging.warning("Failed to decode inline image: %s", e)
+            continue
+        try:
+            # TODO: possible to be more clever about the filename?
+            filename = "inline-{}-{}.{}".format(
+                len(raw_image), i, filetype.split("/")[1].lower())
+        except IndexError:
+            logging.warning("Strange inline image type: %s", filetype)
+            continue
+        file_ = FileStorage(io.BytesIO(raw_image),
+                            filename=filename, content_type=filetype)
+        attachment = save_attachment(file_, result.timestamp,
+                                     result.entry_id, embedded=True,
+                                     staged=True)
+        src = element.attrib["src"] = url_for("get_attachment",
+                                              path=attachment.path)
+        parent = element.getparent()
+        if parent.tag == "a":
+            parent.attrib["href"] = src
+        else:
+            wrapper = etree.Element('a')
+            wrapper.attrib['href'] = src
+            parent.insert(parent.index(element), wrapper)
+            parent.remove(element)
+            wrapper.append(element)
+        result.attachments.append(attachment)
+
+
+html_clean = Cleaner(style=True, inline_style=False,
+                     safe_attrs=html.defs.safe_attrs | set(['style']))
+
+
+def sanitize(result):
+    html_clean(result.tree)  # remove some evil tags
+
+
+def extract_links(result):
+    result.links = [link for _, _, link, _ in result.tree.iterlinks()]
+
+
+def extract_text(result):
+    result.text = result.tree.text_content()
+    result.preview = make_preview(result.text)
+
+
+def count_words(result):
+    result.word_count = len(result.text.split())
+
+
+STAGES = [
+    extract_inline_images,
+    sanitize,
+    extract_links,
+    extract_text,
+    count_words,
+]
+
+
+def _timed(result, name, function, *args):
+    start = perf_counter()
+    value = function(*args)
+    result.timings[name] = perf_counter() - start
+    return value
+
+
+def process_content(content, content_type="text/html", entry_id=None,
+                    timestamp=None, stages=STAGES):
+    """Run the given stages over the content, parsing it only once.
+    Returns a ProcessedContent, where .content is the resulting HTML."""
+    result = ProcessedContent(content, content_type, entry_id, timestamp)
+    if not content:
+        return result
+    if not (result.is_html and has_markup(content)):
+        # nothing to parse, the content is already plain text
+        result.text = content
+        result.preview = make_preview(content)
+        result.word_count = len(content.split())
+        return result
+    try:
+        result.tree = _timed(result, "parse",
+                             html.document_fromstring, content)
+    except etree.ParserError:
+        return result
+    try:
+        for stage in stages:
+            _timed(result, stage.__name__, stage, result)
+    except Exception:
+        discard_staged(result.attachments)
+        raise
+    result.content = _timed(result, "serialize", result.serialize)
+    logging.debug("Processed %d bytes of content: %s", len(content),
+                  ", ".join("{} {:.4f} s".format(name, t)
+                            for name, t in result.timings.items()))
+    return result
@@ -1,20 +1,289 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from html.parser import HTMLParser
 import json
 import logging
+import os
 import sys
+import threading
+from time import perf_counter
+import zlib
 
 from flask import url_for
+from playhouse.migrate import PostgresqlMigrator, SqliteMigrator, migrate
 from playhouse.sqlite_ext import SqliteExtDatabase, JSONField, fn
 from peewee import (IntegerField, CharField, TextField, BooleanField,
-                    DateTimeField, ForeignKeyField, sqlite3)
-from peewee import Model, DoesNotExist, Entity
+                    DateTimeField, ForeignKeyField, PrimaryKeyField, SQL,
+                    sqlite3)
+from peewee import (Model, DoesNotExist, Entity, JOIN, OperationalError,
+                    PostgresqlDatabase, Proxy)
 
+from .dialects import PostgreSQLDialect, SQLiteDialect
+from .readpool import PoolExhausted, ReadConnectionPool, connect_read_only
 from .utils import CustomJSONEncoder
 
 
-# defer the actual db setup to later, when we have read the config
-db = SqliteExtDatabase(None)
+# Functions called as hook(sql, params, duration, cursor) after each
+# executed statement, e.g. to keep track of queries in metrics.py.
+# A hook may return a wrapper to be used instead of the cursor.
+query_hooks = []
+
+# Called as hook(sql, params, duration, exception) when a statement fails
+query_error_hooks = []
+
+# Called as hook(event, pool, wait) when a read connection is "acquire"d
+# (after waiting 'wait' seconds) or "release"d, or if the pool was
+# "exhausted" so that the writer connection had to be used instead.
+pool_hooks = []
+
+
+def _is_read(sql):
+    return sql.lstrip()[:6].upper() in ("SELECT", "WITH R")
+
+
+class HookedDatabase:
+
+    "Lets the query hooks know about every statement executed"
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        start = perf_counter()
+        try:
+            cursor = self._execute_sql(sql, params, require_commit)
+        except Exception as e:
+            for hook in query_error_hooks:
+                hook(sql, params, perf_counter() - start, e)
+            raise
+        duration = perf_counter() - start
+        for hook in query_hooks:
+            cursor = hook(sql, params, duration, cursor) or cursor
+        return cursor
+
+    def _execute_sql(self, sql, params, require_commit):
+        return super().execute_sql(sql, params, require_commit)
+
+    def after_fork(self):
+        """Forget any connection inherited from the parent process. It
+        must not be used, or even closed, in the child. Connections are
+        then opened as needed."""
+        self._local = type(self._local)()
+        self._conn_lock = threading.Lock()
+
+
+class ElogyDatabase(HookedDatabase, SqliteExtDatabase):
+
+    """The default, SQLite database.
+
+    Keeps writes apart from reads. There is one connection per
+    thread (the usual peewee way) used for writing, and write
+    transactions are serialized within the process, started with
+    BEGIN IMMEDIATE so that they wait for each other (up to
+    busy_timeout) instead of failing halfway through. If enabled with
+    use_read_pool(), standalone SELECTs instead go to a connection
+    from a pool of read only connections, so that in WAL mode they
+    never get in the way of the writer."""
+
+    dialect = SQLiteDialect()
+
+    def __init__(self, *args, **kwargs):
+        self.archive_folder = None
+        self._read_pool = None
+        self._read_pool_lock = threading.Lock()
+        self._reading = threading.local()
+        self._write_lock = threading.RLock()
+        self._writing = threading.local()
+        super().__init__(*args, **kwargs)
+
+    def init(self, database, read_pool_size=0, busy_timeout=5.0,
+             wal_autocheckpoint=None, **connect_kwargs):
+        self.close_read_pool()
+        self.read_pool_size = read_pool_size
+        self.busy_timeout = busy_timeout
+        # set on each new connection; see maintenance.py
+        self._pragmas = [(pragma, value) for pragma, value in self._pragmas
+                         if pragma != "wal_autocheckpoint"]
+        if wal_autocheckpoint is not None:
+            self._pragmas.append(("wal_autocheckpoint", wal_autocheckpoint))
+        super().init(database, timeout=busy_timeout, **connect_kwargs)
+
+    # --- Writing ---
+
+    def _acquire_write_lock(self):
+        if not self._write_lock.acquire(timeout=self.busy_timeout):
+            raise OperationalError("database is locked (waited {} s)"
+                                   .format(self.busy_timeout))
+
+    def begin(self, lock_type="IMMEDIATE"):
+        self._acquire_write_lock()
+        try:
+            super().begin(lock_type)
+        except Exception:
+            self._write_lock.release()
+            raise
+        self._writing.active = True
+
+    def _end_write(self):
+        if getattr(self._writing, "active", False):
+            self._writing.active = False
+            self._write_lock.release()
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self._end_write()
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self._end_write()
+
+    # --- Reading ---
+
+    def _get_read_pool(self):
+        with self._read_pool_lock:
+            if (self._read_pool is None or
+                    self._read_pool.pid != os.getpid()):
+                # connections can't be shared with a forked parent
+                self._read_pool = ReadConnectionPool(
+                    self._connect_read_only, self.read_pool_size,
+                    self.busy_timeout)
+            return self._read_pool
+
+    def _connect_read_only(self):
+        conn = connect_read_only(self.database, self.busy_timeout)
+        # the same functions as the normal connections, e.g. regexp
+        # (but not the pragmas; setting journal mode needs writing)
+        self._load_aggregates(conn)
+        self._load_collations(conn)
+        self._load_functions(conn)
+        if self._row_factory:
+            conn.row_factory = self._row_factory
+        return conn
+
+    def after_fork(self):
+        super().after_fork()
+        # the pool would be replaced anyway, but the locks may have
+        # been held by some other thread at the time of the fork
+        self._read_pool = None
+        self._read_pool_lock = threading.Lock()
+        self._reading = threading.local()
+        self._write_lock = threading.RLock()
+        self._writing = threading.local()
+
+    def close_read_pool(self):
+        if self._read_pool is not None:
+            self._read_pool.close()
+            self._read_pool = None
+
+    def use_read_pool(self):
+        """Let standalone reads in this thread use the read pool, until
+        release_read_connection() is called. Meant for requests that
+        should not be writing anything, e.g. GET."""
+        if (self.read_pool_size > 0 and self.database and
+                self.database != ":memory:"):
+            self._reading.enabled = True
+
+    def _get_read_conn(self):
+        conn = getattr(self._reading, "conn", None)
+        if conn is None:
+            pool = self._get_read_pool()
+            try:
+                conn, wait = pool.acquire()
+            except PoolExhausted:
+                # better to read from the writer than to fail
+                self._reading.enabled = False
+                for hook in pool_hooks:
+                    hook("exhausted", pool, pool.timeout)
+                return None
+            self._reading.conn = conn
+            self._reading.pool = pool
+            self._reading.cursors = []
+            for hook in pool_hooks:
+                hook("acquire", pool, wait)
+        return conn
+
+    def release_read_connection(self):
+        self._reading.enabled = False
+        conn = getattr(self._reading, "conn", None)
+        if conn is None:
+            return
+        # unfinished statements would keep a read transaction open,
+        # which holds back WAL checkpoints
+        for cursor in self._reading.cursors:
+            cursor.close()
+        pool = self._reading.pool
+        self._reading.conn = self._reading.pool = None
+        self._reading.cursors = []
+        pool.release(conn)
+        for hook in pool_hooks:
+            hook("release", pool, 0)
+
+    def _execute_read(self, sql, params):
+        conn = self._get_read_conn()
+        if conn is None:
+            return None
+        with self.exception_wrapper:
+            cursor = conn.cursor()
+            self._reading.cursors.append(cursor)
+            cursor.execute(sql, params or ())
+        return cursor
+
+    # --- Archives ---
+
+    def archive_schemas(self):
+        """Attach the archive databases (see archive.py) to the connection
+        that the next read will use, unless it already has them. Returns
+        the columns of the tables in each one, by schema name."""
+        if not self.archive_folder:
+            return {}
+        from .archive import attach_archives
+        conn = None
+        if (self.transaction_depth() == 0 and
+                getattr(self._reading, "enabled", False)):
+            conn = self._get_read_conn()
+        if conn is not None:
+            return attach_archives(conn, self.archive_folder, read_only=True)
+        return attach_archives(self.get_conn(), self.archive_folder)
+
+    def _execute_sql(self, sql, params, require_commit):
+        if self.transaction_depth() == 0:
+            if getattr(self._reading, "enabled", False) and _is_read(sql):
+                cursor = self._execute_read(sql, params)
+                if cursor is not None:
+                    return cursor
+            if not _is_read(sql):
+                # a write outside of any transaction
+                self._acquire_write_lock()
+                try:
+                    return super()._execute_sql(sql, params, require_commit)
+                finally:
+                    self._write_lock.release()
+        return super()._execute_sql(sql, params, require_commit)
+
+
+class ElogyPostgresqlDatabase(HookedDatabase, PostgresqlDatabase):
+
+    """Used instead, if configured for PostgreSQL. It handles concurrent
+    reading and writing by itself, so there is no read pool."""
+
+    dialect = PostgreSQLDialect()
+
+    def use_read_pool(self):
+        pass
+
+    def archive_schemas(self):
+        return {}  # archives are SQLite only
+
+    def release_read_connection(self):
+        pass
+
+
+# defer the actual db setup to later, when we have read the config.
+# The proxy lets us switch to another kind of database then.
+sqlite_db = ElogyDatabase(None)
+db = Proxy()
+db.initialize(sqlite_db)
 
 
 class CustomJSONField(JSONField):
@@ -24,28 +293,200 @@ class CustomJSONField(JSONField):
             return json.dumps(value, cls=CustomJSONEncoder)
 
 
-def setup_database(db_name, close=True):
-    "Configure the database and make sure all the tables exist"
-    # TODO: support further configuration options, see FlaskDB
-    db_dependencies_installed()
-    db.init(db_name)
-    Logbook.create_table(fail_silently=True)
-    LogbookChange.create_table(fail_silently=True)
-    Entry.create_table(fail_silently=True)
-    EntryChange.create_table(fail_silently=True)
-    EntryLock.create_table(fail_silently=True)
-    Attachment.create_table(fail_silently=True)
+class AutoIncrementField(PrimaryKeyField):
+
+    """An id that is never given out again, also after the row has been
+    deleted, e.g. moved to an archive (see archive.py). By default
+    SQLite uses one more than the largest id in the table."""
+
+    def __ddl__(self, column_type):
+        ddl = super().__ddl__(column_type)
+        if db.dialect.name == "sqlite":
+            ddl.append(SQL("AUTOINCREMENT"))
+        return ddl
+
+
+def setup_database(db_name, close=True, journal_mode=None,
+                   read_pool_size=0, busy_timeout=5.0, engine=None,
+                   archive_folder=None, wal_autocheckpoint=None,
+                   **connect_kwargs):
+    """Configure the database and make sure all the tables exist.
+    The engine can be e.g. "postgresql", otherwise SQLite is used and
+    db_name is the file name. Old entries may have been moved to
+    archive databases in the archive_folder (see archive.py). New
+    SQLite databases use incremental auto_vacuum, and WAL checkpoints
+    can be left to maintenance.py with wal_autocheckpoint. Any
+    connect_kwargs (e.g. host, user, password) are passed on when
+    connecting.
+
+    Creating and upgrading the tables is skipped if it has already
+    been done for the current schema, so this is cheap to run again
+    e.g. in each worker process."""
+    if engine and "postgres" in engine.lower():
+        db.initialize(ElogyPostgresqlDatabase(db_name, **connect_kwargs))
+    else:
+        sqlite_db.init(db_name, read_pool_size=read_pool_size,
+                       busy_timeout=busy_timeout,
+                       wal_autocheckpoint=wal_autocheckpoint,
+                       **connect_kwargs)
+        sqlite_db.archive_folder = archive_folder
+        db.initialize(sqlite_db)
+        if not db.get_tables():
+            # only possible to set before there are any tables, so
+            # that free pages can be given back (see maintenance.py)
+            db.execute_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        if journal_mode:
+            # this is stored in the database file, so only needs doing once
+            db.execute_sql("PRAGMA journal_mode = {}".format(journal_mode))
+    version = schema_version()
+    if db.dialect.get_schema_version(db) != version:
+        if db.dialect.name == "sqlite":
+            db_dependencies_installed()
+        for model in MODELS:
+            model.create_table(fail_silently=True)
+        upgrade_database()
+        if db.dialect.name == "sqlite":
+            use_autoincrement()
+        set_thread_ids()
+        set_sort_ts()
+        set_revisions()
+        set_storage_usage()
+        db.dialect.create_indexes(db)
+        db.dialect.set_schema_version(db, version)
     # print("\n".join(line[0] for line in db.execute_sql("pragma compile_options;")))
     if close:
         db.close()  # important
 
 
+def schema_version():
+    "A number that changes whenever the tables, columns or indexes do"
+    description = repr([(model._meta.db_table,
+                         type(model._meta.primary_key).__name__,
+                         [field.db_column
+                          for field in model._meta.sorted_fields])
+                        for model in MODELS] + db.dialect.indexes)
+    return zlib.crc32(description.encode("utf-8")) & 0x7fffffff
+
+
+def upgrade_database():
+    """Add any columns that are missing from the tables, e.g. in a
+    database created with an older version of elogy."""
+    if db.dialect.name == "postgresql":
+        migrator = PostgresqlMigrator(db.obj)
+    else:
+        migrator = SqliteMigrator(db.obj)
+    operations = []
+    for model in MODELS:
+        table = model._meta.db_table
+        columns = set(column.name for column in db.get_columns(table))
+        for field in model._meta.sorted_fields:
+            if field.db_column not in columns:
+                logging.info("Adding column %s.%s", table, field.db_column)
+                operations.append(
+                    migrator.add_column(table, field.db_column, field))
+    if operations:
+        with db.atomic():
+            migrate(*operations)
+
+
+def use_autoincrement():
+    """Rebuild the SQLite tables that should have AUTOINCREMENT ids (see
+    AutoIncrementField), if they were created without. Also makes sure
+    that the ids of any archived rows are not given out again."""
+    for model in MODELS:
+        if not isinstance(model._meta.primary_key, AutoIncrementField):
+            continue
+        table = model._meta.db_table
+        sql, = db.execute_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' "
+            "AND name = ?", (table,)).fetchone()
+        if "AUTOINCREMENT" in sql.upper():
+            continue
+        logging.info("Rebuilding table %s, with AUTOINCREMENT ids", table)
+        new_sql = sql.replace(
+            'CREATE TABLE "{}"'.format(table),
+            'CREATE TABLE "{}_new"'.format(table), 1).replace(
+                '"id" INTEGER NOT NULL PRIMARY KEY',
+                '"id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT', 1)
+        indexes = [row[0] for row in db.execute_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name = ? AND sql IS NOT NULL", (table,))]
+        with db.atomic():
+            db.execute_sql(new_sql)
+            db.execute_sql('INSERT INTO "{0}_new" SELECT * FROM "{0}"'
+                           .format(table))
+            # other tables' foreign keys refer to it by name, and are
+            # not checked (foreign_keys is off)
+            db.execute_sql('DROP TABLE "{}"'.format(table))
+            db.execute_sql('ALTER TABLE "{0}_new" RENAME TO "{0}"'
+                           .format(table))
+            for index in indexes:
+                db.execute_sql(index)
+    if db.archive_folder:
+        from .archive import reserve_archived_ids
+        reserve_archived_ids(db.archive_folder)
+
+
+def set_thread_ids():
+    """Fill in Entry.thread_id where it's missing, e.g. after upgrading
+    from a version without it. One level of followups at a time."""
+    with db.atomic():
+        (Entry.update(thread_id=Entry.id)
+         .where(Entry.thread_id.is_null() & Entry.follows.is_null())
+         .execute())
+        while db.execute_sql("""
+            UPDATE entry SET thread_id = (
+                SELECT parent.thread_id FROM entry AS parent
+                WHERE parent.id = entry.follows_id)
+            WHERE thread_id IS NULL AND follows_id IN (
+                SELECT id FROM entry WHERE thread_id IS NOT NULL)
+        """).rowcount:
+            pass
+        # followups to entries that don't exist (anymore)
+        Entry.update(thread_id=Entry.id).where(
+            Entry.thread_id.is_null()).execute()
+
+
+def update_sort_ts(thread_id):
+    "Recalculate Entry.sort_ts of the entry starting a thread"
+    latest = (Entry.select(fn.MAX(fn.coalesce(Entry.last_changed_at,
+                                              Entry.created_at)))
+              .where(Entry.thread_id == thread_id))
+    Entry.update(sort_ts=latest).where(Entry.id == thread_id).execute()
+
+
+def set_sort_ts():
+    "Fill in Entry.sort_ts where it's missing, e.g. after upgrading"
+    with db.atomic():
+        (Entry.update(sort_ts=fn.coalesce(Entry.last_changed_at,
+                                          Entry.created_at))
+         .where(Entry.sort_ts.is_null() & Entry.follows.is_null(False))
+         .execute())
+        db.execute_sql("""
+            UPDATE entry SET sort_ts = (
+                SELECT max(coalesce(thread.last_changed_at, thread.created_at))
+                FROM entry AS thread WHERE thread.thread_id = entry.id)
+            WHERE sort_ts IS NULL AND follows_id IS NULL
+        """)
+
+
+def set_revisions():
+    "Fill in Entry.revision where it's missing, e.g. after upgrading"
+    db.execute_sql("""
+        UPDATE entry SET revision = (
+            SELECT count(*) FROM entrychange
+            WHERE entrychange.entry_id = entry.id)
+        WHERE revision IS NULL
+    """)
+
+
 def db_dependencies_installed(type='SQLite'):
     "Check that the sqlite library has the necessary features."
     if type == 'SQLite':
-        # Check that version is high enough to have JSON1
-        if sqlite3.sqlite_version_info[:3] < (3, 9, 0):
-            sys.exit('Sqlite version too low, 3.9.0 or later required')
+        # Check that version is high enough to have JSON1, and row
+        # values (used when paging, see dialects.py)
+        if sqlite3.sqlite_version_info[:3] < (3, 15, 0):
+            sys.exit('Sqlite version too low, 3.15.0 or later required')
         tmp_db = sqlite3.connect(':memory:')
         setup_test_table = 'create table temp(attrib1,attrib2)'
         tmp_db.execute(setup_test_table)
@@ -73,11 +514,16 @@ class UTCDateTimeField(DateTimeField):
     def db_value(self, value):
         if value is None:
             return
-        # Note: There are probably neater ways to do this
-        utc_offset = value.utcoffset()
-        if utc_offset:
-            value -= utc_offset
-        return super().db_value(value.replace(tzinfo=None))
+        return super().db_value(naive_utc(value))
+
+
+def naive_utc(value):
+    "The datetime in UTC, without timezone info (see UTCDateTimeField)"
+    # Note: There are probably neater ways to do this
+    utc_offset = value.utcoffset()
+    if utc_offset:
+        value -= utc_offset
+    return value.replace(tzinfo=None)
 
 
 class Logbook(Model):
@@ -125,37 +571,14 @@ class Logbook(Model):
     @property
     def ancestors(self):
         "Return parent, grandparent, ..."
-        query = "\n".join([
-            "WITH RECURSIVE child(id,parent_id) AS (",
-            "    SELECT id, parent_id from logbook WHERE id = ?",
-            "    UNION ALL",
-            "    SELECT logbook.id, logbook.parent_id FROM logbook,child",
-            "    WHERE child.parent_id=logbook.id",
-            ")",
-            "SELECT child_logbook.*",
-            "FROM child",
-            "JOIN logbook as child_logbook ON child_logbook.id = child.id",
-            "WHERE child_logbook.id != ?"
-        ])
-        return self.raw(query, self.id, self.id)
+        query, params = db.dialect.ancestors_query(self.id)
+        return self.raw(query, *params)
 
     @property
     def descendants(self):
         "Return all children, grandchildren, etc of the logbook"
-        query = "\n".join([
-            "WITH RECURSIVE parent(id,parent_id) AS (",
-            "    values(?, NULL)",
-            "    UNION ALL",
-            "    SELECT logbook.id, logbook.parent_id FROM logbook,parent",
-            "    WHERE logbook.parent_id=parent.id",
-            ")",
-            "SELECT parent_logbook.*",
-            "FROM parent",
-            "JOIN logbook as parent_logbook ON parent_logbook.id = parent.id",
-            "GROUP BY parent.id",
-            "HAVING parent_logbook.id != ?"
-        ])
-        return self.raw(query, self.id, self.id)
+        query, params = db.dialect.descendants_query(self.id)
+        return self.raw(query, *params)
 
     def make_change(self, **values):
         "Change the logbook, storing the old values as a revision"
@@ -299,7 +722,8 @@ class LogbookChange(Model):
         try:
             change = (LogbookChange.select()
                       .where((LogbookChange.logbook == self.logbook) &
-                             (LogbookChange.changed.extract(attr) != None) &
+                             (db.dialect.json_extract(
+                                 LogbookChange.changed, attr) != None) &
                              (LogbookChange.id > self.id))
                       .order_by(LogbookChange.id)
                       .get())
@@ -320,7 +744,8 @@ class LogbookChange(Model):
         try:
             change = (LogbookChange.select()
                       .where((LogbookChange.logbook == self.logbook) &
-                             (LogbookChange.changed.extract(attr) != None) &
+                             (db.dialect.json_extract(
+                                 LogbookChange.changed, attr) != None) &
                              (LogbookChange.id > self.id))
                       .order_by(LogbookChange.id)
                       .get())
@@ -390,21 +815,20 @@ def convert_attributes(logbook, attributes):
     return converted
 
 
-def escape_string(s):
-    "Double single quotes for sqlite"
-    return s.replace("'", "''")
-
-
 class Entry(Model):
 
     class Meta:
         database = db
 
+    # not reused, since entries can be archived
+    id = AutoIncrementField()
     logbook = ForeignKeyField(Logbook, related_name="entries")
     title = CharField(null=True)
     authors = JSONField(default=[])
     content = TextField(null=True)
     content_type = CharField(default="text/html; charset=UTF-8")
+    # plain text beginning of the content, see content.py
+    content_preview = TextField(null=True)
     metadata = JSONField(default={})  # general
     attributes = JSONField(default={})
     priority = IntegerField(default=0)  # used for sorting
@@ -417,62 +841,189 @@ class Entry(Model):
     created_at = UTCDateTimeField(default=datetime.utcnow)
     last_changed_at = UTCDateTimeField(null=True)
     follows = ForeignKeyField("self", null=True, related_name="followups")
+    # The first entry of the thread, i.e. at the top of the "follows"
+    # chain (the entry itself if it's not a followup). Kept up to date
+    # by save(), and used to load whole threads at once.
+    thread_id = IntegerField(null=True, index=True)
+    # When anything last happened in the thread; the latest creation or
+    # change of the entry or (if it starts a thread) any followup.
+    # Entries are listed by this, newest first.
+    sort_ts = UTCDateTimeField(null=True)
+    # The number of changes (EntryChange) made to the entry, i.e. the
+    # current "revision_n". Used to check that nobody else has changed
+    # the entry since it was loaded, see save().
+    revision = IntegerField(null=True, default=0)
     archived = BooleanField(default=False)
 
+    # The logbook (and whether to include its child logbooks) that
+    # 'next' and 'previous' are relative to, like in the listing.
+    # By default the logbook of the entry.
+    navigation = (None, False)
+
+    # For entries loaded from the archive databases (see archive.py),
+    # the tables in them. Such entries can't be changed.
+    archive = None
+
     def __str__(self):
         return "[{}] {}".format(self.id, self.title)
 
     class Locked(Exception):
         pass
 
+    class Conflict(Exception):
+        "Someone else changed the entry"
+
+    def save(self, *args, revision=None, **kwargs):
+        """If a revision is given, the changes are only saved if the
+        entry is still at that revision in the database; otherwise
+        Conflict is raised. See make_change()."""
+        if self.archive:
+            raise ValueError("Entry {} is archived".format(self.id))
+        old_thread_id = self.thread_id
+        update_thread = old_thread_id is None or "follows" in self._dirty
+        if self.id is not None and "logbook" in self._dirty:
+            old_logbook_id = (Entry.select(Entry.logbook)
+                              .where(Entry.id == self.id).scalar())
+        else:
+            old_logbook_id = None
+        if update_thread:
+            if self.follows_id:
+                self.thread_id = (Entry.select(Entry.thread_id)
+                                  .where(Entry.id == self.follows_id)
+                                  .scalar()) or self.follows_id
+            else:
+                self.thread_id = self.id  # None for new entries
+        timestamp = naive_utc(self.last_changed_at or self.created_at)
+        if self.sort_ts is None or self.follows_id:
+            self.sort_ts = timestamp
+        else:
+            self.sort_ts = max(self.sort_ts, timestamp)
+        if revision is None:
+            result = super().save(*args, **kwargs)
+        else:
+            result = self._save_revision(revision)
+        if self.thread_id is None:
+            # a new entry starting a thread; now we know the id
+            self.thread_id = self.id
+            (Entry.update(thread_id=self.id)
+             .where(Entry.id == self.id).execute())
+        elif update_thread and old_thread_id not in (None, self.thread_id):
+            self._move_followups(old_thread_id)
+            if old_thread_id != self.id:
+                update_sort_ts(old_thread_id)
+        if old_logbook_id not in (None, self.logbook_id):
+            # the attachments go along to the new logbook
+            files, size = (Attachment
+                           .select(fn.COUNT(Attachment.id),
+                                   fn.COALESCE(fn.SUM(Blob.size), 0))
+                           .join(Blob, JOIN.LEFT_OUTER)
+                           .where(Attachment.entry == self.id)
+                           .tuples().get())
+            StorageUsage.add(old_logbook_id, -files, -size)
+            StorageUsage.add(self.logbook_id, files, size)
+        if self.thread_id != self.id:
+            # something happened in the thread
+            (Entry.update(sort_ts=timestamp)
+             .where((Entry.id == self.thread_id) &
+                    ((Entry.sort_ts < timestamp) | Entry.sort_ts.is_null()))
+             .execute())
+        return result
+
+    def _save_revision(self, revision):
+        # like an update by Model.save(), with the revision checked in
+        # the same statement, so there is no chance of missing changes
+        values = {field.name: self._data.get(field.name)
+                  for field in self.dirty_fields}
+        values["revision"] = self.revision
+        updated = (Entry.update(**values)
+                   .where((Entry.id == self.id) &
+                          (Entry.revision == revision))
+                   .execute())
+        if not updated:
+            raise self.Conflict()
+        self._dirty.clear()
+        return updated
+
+    def _move_followups(self, old_thread_id):
+        "The entry was moved to another thread; its followups go with it"
+        followups = {}
+        for entry_id, follows_id in (Entry.select(Entry.id, Entry.follows)
+                                     .where(Entry.thread_id == old_thread_id)
+                                     .tuples()):
+            followups.setdefault(follows_id, []).append(entry_id)
+        moved = set()
+        todo = [self.id]
+        while todo:
+            for entry_id in followups.pop(todo.pop(), []):
+                moved.add(entry_id)
+                todo.append(entry_id)
+        if moved:
+            (Entry.update(thread_id=self.thread_id)
+             .where(Entry.id << list(moved)).execute())
+
+    def load_thread(self):
+        """Get all the entries in the thread with one query, and put
+        them together. Returns the entries by id, each with its
+        'followups' as a list, so that they are not loaded one at a
+        time."""
+        if self.archive:
+            from .archive import get_archived_thread
+            entries = get_archived_thread(self)
+        else:
+            entries = (Entry.select()
+                       .where(Entry.thread_id == (self.thread_id or self.id))
+                       .order_by(Entry.id))
+        by_id = OrderedDict((entry.id, entry) for entry in entries)
+        for entry in by_id.values():
+            # hides the query for followups, for this entry only
+            entry.followups = []
+        for entry in by_id.values():
+            parent = by_id.get(entry.follows_id)
+            if parent is not None:
+                parent.followups.append(entry)
+                entry._obj_cache["follows"] = parent
+        return by_id
+
     @property
     def _thread(self):
-        entries = []
-        if self.follows:
-            entry = Entry.get(Entry.id == self.follows_id)
-            while True:
-                entries.append(entry)
-                if entry.follows_id:
-                    try:
-                        entry = Entry.get(Entry.id == entry.follows_id)
-                    except DoesNotExist:
-                        break
-                else:
-                    break
-        if entries:
-            return entries[-1]
-        return self
+        "The first entry in the thread, with all followups loaded"
+        return self.load_thread().get(self.thread_id or self.id, self)
+
+    def get_neighbour(self, newer, logbook=None, child_logbooks=False):
+        """The entry listed just before (newer) or after this one in the
+        logbook (by default the entry's own). Followups are placed
+        where their thread is."""
+        if self.archive:
+            return None  # archived entries are not listed
+        if self.follows_id:
+            try:
+                entry = Entry.get(Entry.id == self.thread_id)
+            except DoesNotExist:
+                return None
+        else:
+            entry = self
+        logbook = logbook or entry.logbook
+        if child_logbooks:
+            logbooks = [logbook] + [lb for lb in logbook.descendants
+                                    if not lb.archived]
+            ancestors = [lb for lb in logbook.ancestors if not lb.archived]
+        else:
+            logbooks, ancestors = [logbook], []
+        query, variables = db.dialect.neighbour_query(
+            (entry.priority, entry.sort_ts, entry.id), newer,
+            [lb.id for lb in logbooks], [lb.id for lb in ancestors])
+        for neighbour in Entry.raw(query, *variables):
+            return neighbour
 
     @property
     def next(self):
-        "Next entry (order by id)"
-        # TODO: broken
-        try:
-            return (Entry.select()
-                    .where((Entry.logbook == self.logbook) &
-                           (Entry.follows == None) &
-                           (fn.coalesce(Entry.last_changed_at, Entry.created_at)
-                            > fn.coalesce(self.last_changed_at, self.created_at)))
-                    .order_by(fn.coalesce(Entry.last_changed_at, Entry.created_at))
-                    .get())
-        except DoesNotExist:
-            pass
+        "Next (newer) entry, see get_neighbour()"
+        return self.get_neighbour(True, *self.navigation)
 
     @property
     def previous(self):
-        "Previous entry (order by id)"
-        # TODO: broken
-        try:
-            return (Entry.select()
-                    .where((Entry.logbook == self.logbook) &
-                           (Entry.follows == None) &
-                           (fn.coalesce(Entry.last_changed_at, Entry.created_at)
-                            < fn.coalesce(self.last_changed_at, self.created_at)))
-                    .order_by(fn.coalesce(Entry.last_changed_at,
-                                          Entry.created_at).desc())
-                    .get())
-        except DoesNotExist:
-            pass
+        "Previous (older) entry, see get_neighbour()"
+        return self.get_neighbour(False, *self.navigation)
 
     def make_change(self, **data):
         "Update the entry, storing the old values as a change"
@@ -485,6 +1036,7 @@ class Entry(Model):
         }
         # TODO: what should we do if the new data is the same as the old?
         change = EntryChange(entry=self, changed=original_values)
+        self.revision = self.revision_n + 1
         for attr in original_values:
             value = data[attr]
             setattr(self, attr, value)
@@ -507,7 +1059,9 @@ class Entry(Model):
 
     @property
     def revision_n(self):
-        return len(self.changes)
+        if self.revision is None:
+            return len(self.changes)
+        return self.revision
 
     def get_revision(self, version):
         if version == self.revision_n:
@@ -530,10 +1084,6 @@ class Entry(Model):
     #             content = apply_patch(content, revision.content)
     #     return content
 
-    @property
-    def stripped_content(self):
-        return strip_tags(self.content)
-
     def get_attachments(self, embedded=False):
         return self.attachments.filter((Attachment.embedded == embedded) &
                                        ~Attachment.archived)
@@ -543,26 +1093,35 @@ class Entry(Model):
         "Ensure that the attributes conform to the logbook configuration"
         return convert_attributes(self.logbook, self.attributes)
 
-    def get_lock(self, ip=None, acquire=False, steal=False):
+    def get_lock(self, ip=None, acquire=False, steal=False, lease=None):
         """check if there's a lock on the entry, and if an ip is given
-        try to acquire it."""
+        try to acquire it. A new lock expires after 'lease' seconds
+        (by default an hour)."""
+        def create():
+            lock = EntryLock(entry=self, owned_by_ip=ip)
+            if lease:
+                lock.expires_at = datetime.utcnow() + timedelta(seconds=lease)
+            lock.save()
+            return lock
         try:
             lock = EntryLock.get((EntryLock.entry_id == self.id) &
                                  (EntryLock.expires_at > datetime.utcnow()) &
                                  (EntryLock.cancelled_at == None))
             if steal:
                 lock.cancel(ip)
-                return EntryLock.create(entry=self, owned_by_ip=ip)
+                return create()
             if acquire and ip != lock.owned_by_ip:
                 raise self.Locked(lock)
             return lock
         except EntryLock.DoesNotExist:
             if acquire:
-                return EntryLock.create(entry=self, owned_by_ip=ip)
+                return create()
 
     @property
     def lock(self):
-        return self.get_lock()
+        "The active lock, if any. Cached, see locks.py"
+        from .locks import get_lock
+        return get_lock(self.id)
 
     @classmethod
     def search(cls, logbook=None, followups=False,
@@ -571,188 +1130,19 @@ class Entry(Model):
                attribute_filter=None, content_filter=None,
                title_filter=None, author_filter=None,
                attachment_filter=None, metadata_filter=None,
-               sort_by_timestamp=True):
-
-        # Note: this is all pretty messy. The reason we're building
-        # the query as a raw string is that peewee does not (currently)
-        # support recursive queries, which we need in order to search
-        # through nested logbooks. Cleanup needed!
-
-        if author_filter:
-            # extract the author names as a separate table, so that
-            # they can be searched
-            # TODO: maybe also take login?
-            authors = ", json_each(entry.authors) AS authors2"
-        else:
-            authors = ""
-
-        if attribute_filter:
-            # need to extract the attribute values from JSON here, so that
-            # we can match on them later
-            attributes = ", {}".format(
-                ", ".join(
-                    "json_extract(entry.attributes, '$.{attr}') AS {attr_id}"
-                    .format(attr=escape_string(attr),
-                            attr_id="attr{}".format(i))
-                    for i, (attr, _) in enumerate(attribute_filter)))
-        else:
-            attributes = ""
-
-        if metadata_filter:
-            # This works just like the attribute filter
-            metadata = ", {}".format(
-                ", ".join(
-                    "json_extract(entry.metadata, '$.{meta}') AS {meta_id}"
-                    .format(meta=escape_string(meta),
-                            meta_id="meta{}".format(i))
-                    for i, (meta, _) in enumerate(metadata_filter)))
-        else:
-            metadata = ""
-
-        if logbook:
-            if child_logbooks:
-                # recursive query to find all entries in the given logbook
-                # or any of its descendants, to arbitrary depth, and also
-                # any high priority ("important") entries in ancestors
-                query = """
-                -- recursively add all 'descentant' logbooks (children, grandchilren, ...)
-                WITH RECURSIVE logbook1(id,parent_id) AS (
-                    values({logbook}, NULL)  -- parent logbook
-                    UNION ALL
-                    SELECT logbook.id, logbook.parent_id FROM logbook,logbook1
-                    WHERE logbook.parent_id=logbook1.id
-                ),
-                -- recursively add all 'ancestor' logbooks (parent, grandparent, ...)
-                logbook2(id,parent_id) AS (
-                    SELECT id, parent_id from logbook WHERE id = {logbook}
-                    UNION ALL
-                    SELECT logbook.id, logbook.parent_id FROM logbook,logbook2
-                    WHERE logbook2.parent_id=logbook.id
-                )
-                SELECT entry.*{attributes}{metadata},
-                    {attachment}
-                    -- 'thread' is the id of the main entry, ignoring followups
-                    coalesce(followup.follows_id, entry.id) AS thread,
-                    count(distinct(followup.id)) AS n_followups,
-                    -- 'timestamp' is the latest modification time in the thread
-                    max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
-                        coalesce(entry.last_changed_at,entry.created_at)))) AS timestamp,
-                    -- collect authors from all followups
-                    json_group_array(json(ifnull(followup.authors, "[]"))) as followup_authors
-                FROM entry{authors}
-                JOIN logbook1
-                JOIN logbook2
-                JOIN logbook ON entry.logbook_id = logbook.id
-                {join_attachment}
-                LEFT JOIN entry AS followup ON entry.id == followup.follows_id
-                WHERE ((entry.logbook_id=logbook1.id)
-                       OR (entry.priority>100 AND entry.logbook_id=logbook2.id))
-                      AND NOT logbook.archived
-                """.format(attachment=("attachment.path as attachment_path,"
-                                       if attachment_filter else ""),
-                           authors=authors, logbook=logbook.id,
-                           attributes=attributes,
-                           metadata=metadata,
-                           join_attachment=("JOIN attachment ON attachment.entry_id == entry.id"
-                                            if attachment_filter else ""))
-            else:
-                # In this case we're not searching recursively
-                query = (
-                    """
-                    SELECT entry.*{attributes}{metadata},
-                      {attachment}
-                      coalesce(followup.follows_id, entry.id) AS thread,
-                      count(followup.id) AS n_followups,
-                      max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
-                        coalesce(entry.last_changed_at,entry.created_at)))) AS timestamp,
-                      json_group_array(json(ifnull(followup.authors, "[]"))) as followup_authors
-                    FROM entry{authors}
-                    {join_attachment}
-                    JOIN logbook on logbook.id = entry.logbook_id
-                    LEFT JOIN entry AS followup ON entry.id == followup.follows_id
-                    WHERE entry.logbook_id = {logbook} AND NOT logbook.archived"""
-                    .format(attachment=("attachment.path as attachment_path,"
-                                       if attachment_filter else ""),
-                            authors=authors,
-                            attributes=attributes,
-                            metadata=metadata,
-                            logbook=logbook.id,
-                            join_attachment=("JOIN attachment ON attachment.entry_id == entry.id"
-                                             if attachment_filter else "")))
-
-        else:
-            # In this case we're searching all entries and don't need
-            # the recursive logbook filtering. This always includes
-            # child logbooks.
-            query = """
-            SELECT entry.*{attributes}{metadata},
-                {attachment}
-                coalesce(followup.follows_id, entry.id) AS thread,
-                count(followup.id) AS n_followups,
-                max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
-                    coalesce(entry.last_changed_at,entry.created_at)))) AS timestamp,
-                json_group_array(json(ifnull(followup.authors, "[]"))) as followup_authors
-            FROM entry{authors}
-            {join_attachment}
-            JOIN logbook on logbook.id = entry.logbook_id
-            LEFT JOIN entry AS followup ON entry.id == followup.follows_id
-            WHERE NOT logbook.archived
-            """.format(attributes=attributes,
-                       metadata=metadata,
-                       attachment=("path as attachment_path,"
-                                   if attachment_filter else ""),
-                       authors=authors,
-                       join_attachment=(
-                           "JOIN attachment ON attachment.entry_id == entry.id"
-                           if attachment_filter else ""))
-
-        if not archived:
-            query += " AND NOT entry.archived\n"
-
-        variables = []
-
-        # if not followups:
-        #     query += " AND entry.follows_id IS NULL"
-
-        # further filters on the results, depending on search criteria
-        if content_filter:
-            # need to filter out null or REGEX will explode on them
-            query += " AND entry.content IS NOT NULL AND entry.content REGEXP ?\n"
-            variables.append(content_filter)
-        if title_filter:
-            query += " AND entry.title IS NOT NULL AND entry.title REGEXP ?\n"
-            variables.append(title_filter)
-        if author_filter:
-            query += " AND json_extract(authors2.value, '$.name') REGEXP ?\n"
-            variables.append(author_filter)
-        if attachment_filter:
-            query += " AND attachment_path REGEXP ?\n"
-            variables.append(attachment_filter)
-        if attribute_filter:
-            for i, (attr, value) in enumerate(attribute_filter):
-                query += " AND attr{} LIKE ?".format(i)
-                variables.append('%{}%'.format(value))
-        if metadata_filter:
-            for i, (meta, value) in enumerate(metadata_filter):
-                query += " AND meta{} LIKE ?".format(i)
-                variables.append('{}'.format(value))
-
-        # Check if we're searching, in that case we want to show all entries.
-        if followups or any([title_filter, content_filter, author_filter,
-                             metadata_filter, attribute_filter, attachment_filter]):
-            query += " GROUP BY thread"
-        else:
-            # We're not searching. In this case we'll only show
-            query += " GROUP BY thread HAVING entry.follows_id IS NULL"
-
-        # sort newest first, taking into account the last edit if any
-        # TODO: does this make sense? Should we only consider creation date?
-        order_by = sort_by_timestamp and "timestamp" or "entry.created_at"
-        query += " ORDER BY entry.priority DESC, {} DESC".format(order_by)
-        if n:
-            query += " LIMIT {}".format(n)
-            if offset:
-                query += " OFFSET {}".format(offset)
+               sort_by_timestamp=True, include_archive=False):
+        """With 'include_archive', entries that have been moved to the
+        archive databases (see archive.py) are also searched."""
+        extra = {}
+        if include_archive:
+            archives = db.archive_schemas()
+            if archives:
+                from .archive import archive_source
+                extra["entries"] = archive_source(Entry, archives)
+        query, variables = db.dialect.search_entries(
+            logbook, followups, child_logbooks, archived, n, offset,
+            attribute_filter, content_filter, title_filter, author_filter,
+            attachment_filter, metadata_filter, sort_by_timestamp, **extra)
         logging.debug("query=%r, variables=%r" % (query, variables))
         return Entry.raw(query, *variables)
 
@@ -853,6 +1243,7 @@ class EntryChange(Model):
     class Meta:
         database = db
 
+    id = AutoIncrementField()
     entry = ForeignKeyField(Entry, related_name="changes")
 
     changed = CustomJSONField()
@@ -874,18 +1265,12 @@ class EntryChange(Model):
         # Otherwise, check for the next revision where this attribute
         # changed; the value from there must be the current value
         # at this revision.
-        try:
-            change = (EntryChange.select()
-                      .where((EntryChange.entry == self.entry) &
-                             (EntryChange.changed.extract(attr) != None) &
-                             (EntryChange.id > self.id))
-                      .order_by(EntryChange.id)
-                      .get())
+        change = self._next_change(attr)
+        if change is not None:
             return change.changed[attr]
-        except DoesNotExist:
-            # No later revisions changed the attribute either, so we can just
-            # take the value from the entry
-            return getattr(self.entry, attr)
+        # No later revisions changed the attribute either, so we can just
+        # take the value from the entry
+        return getattr(self.entry, attr)
 
     def get_new_value(self, attr):
 
@@ -895,18 +1280,30 @@ class EntryChange(Model):
         # Check for the next revision where this attribute changed;
         # the value from there must also be the value after this
         # revision.
-        try:
-            change = (EntryChange.select()
-                        .where((EntryChange.entry == self.entry) &
-                               (EntryChange.changed.extract(attr) != None) &
-                               (EntryChange.id > self.id))
-                        .order_by(EntryChange.id)
-                        .get())
+        change = self._next_change(attr)
+        if change is not None:
             return change.changed[attr]
+        # No later revisions changed the attribute, so we can just
+        # take the value from the entry
+        return getattr(self.entry, attr)
+
+    def _next_change(self, attr):
+        "The first later change of the entry to the attribute, if any"
+        if self.entry.archive:
+            # archived changes are all loaded, see archive.py
+            return next((change for change in self.entry.changes
+                         if change.id > self.id and
+                         change.changed.get(attr) is not None), None)
+        try:
+            return (EntryChange.select()
+                    .where((EntryChange.entry == self.entry) &
+                           (db.dialect.json_extract(
+                               EntryChange.changed, attr) != None) &
+                           (EntryChange.id > self.id))
+                    .order_by(EntryChange.id)
+                    .get())
         except DoesNotExist:
-            # No later revisions changed the attribute, so we can just
-            # take the value from the entry
-            return getattr(self.entry, attr)
+            return None
 
 
 class EntryRevision:
@@ -991,6 +1388,26 @@ class EntryLock(Model):
         self.cancelled_by_ip = ip
         self.save()
 
+    def renew(self, lease):
+        "Keep the lock for another 'lease' seconds from now"
+        self.expires_at = datetime.utcnow() + timedelta(seconds=lease)
+        self.save()
+
+
+class Blob(Model):
+    """A stored file, named by the SHA-256 digest of its contents.
+    Several attachments may use the same blob, e.g. when the same image
+    is pasted into several entries. See storage.py for details.
+    """
+
+    class Meta:
+        database = db
+
+    digest = CharField(primary_key=True)
+    size = IntegerField()
+    refs = IntegerField(default=0)  # number of attachments using it
+    created_at = UTCDateTimeField(default=datetime.utcnow)
+
 
 class Attachment(Model):
     """Store information about an attachment, e.g. an arbitrary file
@@ -1005,12 +1422,53 @@ class Attachment(Model):
     entry = ForeignKeyField(Entry, null=True, related_name="attachments")
     filename = CharField(null=True)
     timestamp = UTCDateTimeField(default=datetime.utcnow)
-    path = CharField()  # path within the upload folder
+    path = CharField()  # within the upload folder, see storage.py
+    blob = ForeignKeyField(Blob, null=True, to_field="digest",
+                           related_name="attachments")
     content_type = CharField(null=True)
     embedded = BooleanField(default=False)  # i.e. an image in the content
     metadata = JSONField(null=True)  # may contain image size, etc
     archived = BooleanField(default=False)
 
+    def save(self, *args, **kwargs):
+        # keep the StorageUsage of the logbooks up to date
+        new = self.id is None
+        moved = not new and "entry" in self._dirty
+        if moved:
+            old_entry_id = (Attachment.select(Attachment.entry)
+                            .where(Attachment.id == self.id).scalar())
+        result = super().save(*args, **kwargs)
+        if new:
+            self._add_usage(self.entry_id, 1)
+        elif moved and old_entry_id != self.entry_id:
+            self._add_usage(old_entry_id, -1)
+            self._add_usage(self.entry_id, 1)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        result = super().delete_instance(*args, **kwargs)
+        self._add_usage(self.entry_id, -1)
+        return result
+
+    def _add_usage(self, entry_id, files):
+        if entry_id is None:
+            return
+        entry = self._obj_cache.get("entry")
+        if entry is not None and entry.id == entry_id:
+            logbook_id = entry.logbook_id
+        else:
+            logbook_id = (Entry.select(Entry.logbook)
+                          .where(Entry.id == entry_id).scalar())
+        staged = getattr(self, "staged_blob", None)
+        if staged is not None:
+            size = staged.size
+        elif self.blob_id:
+            size = (Blob.select(Blob.size)
+                    .where(Blob.digest == self.blob_id).scalar()) or 0
+        else:
+            size = 0  # not known without looking at the file
+        StorageUsage.add(logbook_id, files, files * size)
+
     @property
     def link(self):
         return url_for("get_attachment", path=self.path)
@@ -1018,3 +1476,86 @@ class Attachment(Model):
     @property
     def thumbnail_link(self):
         return url_for("get_attachment", path=self.path) + ".thumbnail"
+
+
+class Upload(Model):
+    """An upload in progress. Large files can be uploaded in chunks,
+    and the upload resumed if interrupted. When all the data is there,
+    the upload is turned into an attachment. See api/uploads.py."""
+
+    class Meta:
+        database = db
+
+    id = CharField(primary_key=True)
+    created_at = UTCDateTimeField(default=datetime.utcnow)
+    entry = ForeignKeyField(Entry, null=True)
+    filename = CharField()
+    content_type = CharField(null=True)
+    size = IntegerField()  # expected total size, in bytes
+    offset = IntegerField(default=0)  # bytes received so far
+    embedded = BooleanField(default=False)
+    metadata = JSONField(null=True)
+
+
+class StorageUsage(Model):
+    """The number of attachments in each logbook, and their total size.
+    Kept up to date as attachments are added and removed, or their
+    entries moved; set_storage_usage() counts everything again. Since
+    blobs are shared, the size is that of the files the attachments
+    use, which may well be larger than the disk space used."""
+
+    class Meta:
+        database = db
+
+    logbook = ForeignKeyField(Logbook, primary_key=True,
+                              related_name="storage_usage")
+    files = IntegerField(default=0)
+    bytes = IntegerField(default=0)
+
+    @classmethod
+    def add(cls, logbook_id, files, size):
+        if logbook_id is None or not (files or size):
+            return
+        updated = (cls.update(files=cls.files + files,
+                              bytes=cls.bytes + size)
+                   .where(cls.logbook == logbook_id)
+                   .execute())
+        if not updated:
+            cls.create(logbook=logbook_id, files=files, bytes=size)
+
+
+def set_storage_usage():
+    "Count the attachments in each logbook from scratch"
+    # attachments stay here when their entries are archived
+    archives = db.archive_schemas()
+    with db.atomic():
+        StorageUsage.delete().execute()
+        query = (Attachment
+                 .select(Entry.logbook, fn.COUNT(Attachment.id),
+                         fn.COALESCE(fn.SUM(Blob.size), 0))
+                 .join(Entry)
+                 .switch(Attachment)
+                 .join(Blob, JOIN.LEFT_OUTER)
+                 .group_by(Entry.logbook)
+                 # not Attachment's default order, which PostgreSQL
+                 # won't have in a grouped query
+                 .order_by())
+        (StorageUsage
+         .insert_from([StorageUsage.logbook, StorageUsage.files,
+                       StorageUsage.bytes], query)
+         .execute())
+        for schema in archives:
+            cursor = db.execute_sql("""
+                SELECT entry.logbook_id, count(attachment.id),
+                       coalesce(sum(blob.size), 0)
+                FROM attachment
+                JOIN {}.entry AS entry ON entry.id = attachment.entry_id
+                LEFT JOIN blob ON blob.digest = attachment.blob_id
+                GROUP BY entry.logbook_id""".format(schema))
+            for logbook_id, files, size in cursor.fetchall():
+                StorageUsage.add(logbook_id, files, size)
+
+
+# all the tables, in the order they can be created
+MODELS = (Logbook, LogbookChange, Entry, EntryChange, EntryLock,
+          Blob, Attachment, Upload, StorageUsage)
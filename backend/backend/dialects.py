@@ -0,0 +1,522 @@
+"""
+The parts of elogy that need SQL specific to the database in use:
+entry search and the recursive queries over the logbook tree.
+
+SQLite (the default) keeps everything in one file, and uses the JSON1
+extension and a Python REGEXP function. PostgreSQL can scale further.
+There, the JSON columns (stored as text, like in SQLite) are cast to
+JSONB, and searches use GIN indexes on those casts and on the words of
+the titles and contents ("tsvector"). The indexes are created by
+setup_database(). Regular expressions are matched with "~*", which
+is not exactly Python's flavor but close enough for searching.
+
+The database object has the dialect for its kind of database as
+db.dialect.
+"""
+
+import re
+
+from peewee import SQL, Clause
+
+
+def escape_string(s):
+    "Double single quotes for sqlite"
+    return s.replace("'", "''")
+
+
+class SQLiteDialect:
+
+    name = "sqlite"
+
+    # how to ask the database how it would run a query
+    explain_prefix = "EXPLAIN QUERY PLAN "
+
+    # placeholder for parameters in raw queries
+    param = "?"
+
+    def json_extract(self, field, key):
+        "The value of the given key in a JSON field, as an expression"
+        return field.extract(key)
+
+    # (name, definition) of any extra indexes
+    indexes = [
+        # case insensitive, like LIKE, for prefix_search()
+        ("entry_title_nocase", "entry (title COLLATE NOCASE)"),
+        # the order of the listing, for neighbour_query()
+        ("entry_listing",
+         "entry (logbook_id, follows_id, priority, sort_ts, id)"),
+    ]
+
+    def create_indexes(self, database):
+        for name, definition in self.indexes:
+            database.execute_sql("CREATE INDEX IF NOT EXISTS {} ON {}"
+                                 .format(name, definition))
+
+    def get_schema_version(self, database):
+        return database.execute_sql("PRAGMA user_version").fetchone()[0]
+
+    def set_schema_version(self, database, version):
+        database.execute_sql("PRAGMA user_version = {:d}".format(version))
+
+    def prefix_search(self, field, text):
+        """An expression matching values that start with the text,
+        ignoring case. It is a range, so that a NOCASE index on the
+        field can be used (the LIKE optimization does not work with
+        query parameters)."""
+        value = Clause(field, SQL("COLLATE NOCASE"))
+        return (value >= text) & (value < text + "\U0010ffff")
+
+    def neighbour_query(self, position, newer, logbook_ids,
+                        important_logbook_ids=()):
+        """The entry next to the given position (priority, sort_ts, id)
+        in the listing of top level entries; the newer or the older
+        one. Important entries are also taken from the second list
+        of logbooks (i.e. ancestors). Each logbook is looked up
+        separately, so that the index can be used to seek directly
+        to the position."""
+        op, order = (">", "ASC") if newer else ("<", "DESC")
+        where = ("entry.follows_id IS NULL AND NOT entry.archived AND "
+                 "(entry.priority, entry.sort_ts, entry.id) {} ({})"
+                 .format(op, ", ".join([self.param] * 3)))
+        order_by = ("ORDER BY priority {0}, sort_ts {0}, id {0} LIMIT 1"
+                    .format(order))
+        parts, variables = [], []
+        logbooks = ([(i, "") for i in logbook_ids] +
+                    [(i, " AND entry.priority > 100")
+                     for i in important_logbook_ids])
+        for n, (logbook_id, condition) in enumerate(logbooks):
+            parts.append(
+                "SELECT * FROM (SELECT entry.* FROM entry "
+                "WHERE entry.logbook_id = {} AND {}{} {}) AS n{}"
+                .format(self.param, where, condition, order_by, n))
+            variables += [logbook_id, *position]
+        query = "\nUNION ALL\n".join(parts) + "\n" + order_by
+        return query, variables
+
+    def ancestors_query(self, logbook_id):
+        query = "\n".join([
+            "WITH RECURSIVE child(id,parent_id) AS (",
+            "    SELECT id, parent_id from logbook WHERE id = ?",
+            "    UNION ALL",
+            "    SELECT logbook.id, logbook.parent_id FROM logbook,child",
+            "    WHERE child.parent_id=logbook.id",
+            ")",
+            "SELECT child_logbook.*",
+            "FROM child",
+            "JOIN logbook as child_logbook ON child_logbook.id = child.id",
+            "WHERE child_logbook.id != ?"
+        ])
+        return query, [logbook_id, logbook_id]
+
+    def descendants_query(self, logbook_id):
+        query = "\n".join([
+            "WITH RECURSIVE parent(id,parent_id) AS (",
+            "    values(?, NULL)",
+            "    UNION ALL",
+            "    SELECT logbook.id, logbook.parent_id FROM logbook,parent",
+            "    WHERE logbook.parent_id=parent.id",
+            ")",
+            "SELECT parent_logbook.*",
+            "FROM parent",
+            "JOIN logbook as parent_logbook ON parent_logbook.id = parent.id",
+            "GROUP BY parent.id",
+            "HAVING parent_logbook.id != ?"
+        ])
+        return query, [logbook_id, logbook_id]
+
+    def search_entries(self, logbook=None, followups=False,
+                       child_logbooks=False, archived=False,
+                       n=None, offset=0,
+                       attribute_filter=None, content_filter=None,
+                       title_filter=None, author_filter=None,
+                       attachment_filter=None, metadata_filter=None,
+                       sort_by_timestamp=True, entries="entry"):
+        """Returns the SQL and parameters for Entry.search(). The entries
+        can be taken from somewhere else than the entry table, e.g. a
+        subquery that includes the archives."""
+
+        # Note: this is all pretty messy. The reason we're building
+        # the query as a raw string is that peewee does not (currently)
+        # support recursive queries, which we need in order to search
+        # through nested logbooks. Cleanup needed!
+
+        if author_filter:
+            # extract the author names as a separate table, so that
+            # they can be searched
+            # TODO: maybe also take login?
+            authors = ", json_each(entry.authors) AS authors2"
+        else:
+            authors = ""
+
+        if attribute_filter:
+            # need to extract the attribute values from JSON here, so that
+            # we can match on them later
+            attributes = ", {}".format(
+                ", ".join(
+                    "json_extract(entry.attributes, '$.{attr}') AS {attr_id}"
+                    .format(attr=escape_string(attr),
+                            attr_id="attr{}".format(i))
+                    for i, (attr, _) in enumerate(attribute_filter)))
+        else:
+            attributes = ""
+
+        if metadata_filter:
+            # This works just like the attribute filter
+            metadata = ", {}".format(
+                ", ".join(
+                    "json_extract(entry.metadata, '$.{meta}') AS {meta_id}"
+                    .format(meta=escape_string(meta),
+                            meta_id="meta{}".format(i))
+                    for i, (meta, _) in enumerate(metadata_filter)))
+        else:
+            metadata = ""
+
+        if logbook:
+            if child_logbooks:
+                # recursive query to find all entries in the given logbook
+                # or any of its descendants, to arbitrary depth, and also
+                # any high priority ("important") entries in ancestors
+                query = """
+                -- recursively add all 'descentant' logbooks (children, grandchilren, ...)
+                WITH RECURSIVE logbook1(id,parent_id) AS (
+                    values({logbook}, NULL)  -- parent logbook
+                    UNION ALL
+                    SELECT logbook.id, logbook.parent_id FROM logbook,logbook1
+                    WHERE logbook.parent_id=logbook1.id
+                ),
+                -- recursively add all 'ancestor' logbooks (parent, grandparent, ...)
+                logbook2(id,parent_id) AS (
+                    SELECT id, parent_id from logbook WHERE id = {logbook}
+                    UNION ALL
+                    SELECT logbook.id, logbook.parent_id FROM logbook,logbook2
+                    WHERE logbook2.parent_id=logbook.id
+                )
+                SELECT entry.*{attributes}{metadata},
+                    {attachment}
+                    -- 'thread' is the id of the main entry, ignoring followups
+                    coalesce(followup.follows_id, entry.id) AS thread,
+                    count(distinct(followup.id)) AS n_followups,
+                    -- 'timestamp' is the latest modification time in the thread
+                    max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
+                        coalesce(entry.last_changed_at,entry.created_at)))) AS timestamp,
+                    -- collect authors from all followups
+                    json_group_array(json(ifnull(followup.authors, "[]"))) as followup_authors
+                FROM {entries} AS entry{authors}
+                JOIN logbook1
+                JOIN logbook2
+                JOIN logbook ON entry.logbook_id = logbook.id
+                {join_attachment}
+                LEFT JOIN {entries} AS followup ON entry.id == followup.follows_id
+                WHERE ((entry.logbook_id=logbook1.id)
+                       OR (entry.priority>100 AND entry.logbook_id=logbook2.id))
+                      AND NOT logbook.archived
+                """.format(attachment=("attachment.path as attachment_path,"
+                                       if attachment_filter else ""),
+                           authors=authors, logbook=logbook.id,
+                           entries=entries,
+                           attributes=attributes,
+                           metadata=metadata,
+                           join_attachment=("JOIN attachment ON attachment.entry_id == entry.id"
+                                            if attachment_filter else ""))
+            else:
+                # In this case we're not searching recursively
+                query = (
+                    """
+                    SELECT entry.*{attributes}{metadata},
+                      {attachment}
+                      coalesce(followup.follows_id, entry.id) AS thread,
+                      count(followup.id) AS n_followups,
+                      max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
+                        coalesce(entry.last_changed_at,entry.created_at)))) AS timestamp,
+                      json_group_array(json(ifnull(followup.authors, "[]"))) as followup_authors
+                    FROM {entries} AS entry{authors}
+                    {join_attachment}
+                    JOIN logbook on logbook.id = entry.logbook_id
+                    LEFT JOIN {entries} AS followup ON entry.id == followup.follows_id
+                    WHERE entry.logbook_id = {logbook} AND NOT logbook.archived"""
+                    .format(attachment=("attachment.path as attachment_path,"
+                                       if attachment_filter else ""),
+                            authors=authors, entries=entries,
+                            attributes=attributes,
+                            metadata=metadata,
+                            logbook=logbook.id,
+                            join_attachment=("JOIN attachment ON attachment.entry_id == entry.id"
+                                             if attachment_filter else "")))
+
+        else:
+            # In this case we're searching all entries and don't need
+            # the recursive logbook filtering. This always includes
+            # child logbooks.
+            query = """
+            SELECT entry.*{attributes}{metadata},
+                {attachment}
+                coalesce(followup.follows_id, entry.id) AS thread,
+                count(followup.id) AS n_followups,
+                max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
+                    coalesce(entry.last_changed_at,entry.created_at)))) AS timestamp,
+                json_group_array(json(ifnull(followup.authors, "[]"))) as followup_authors
+            FROM {entries} AS entry{authors}
+            {join_attachment}
+            JOIN logbook on logbook.id = entry.logbook_id
+            LEFT JOIN {entries} AS followup ON entry.id == followup.follows_id
+            WHERE NOT logbook.archived
+            """.format(attributes=attributes,
+                       metadata=metadata, entries=entries,
+                       attachment=("path as attachment_path,"
+                                   if attachment_filter else ""),
+                       authors=authors,
+                       join_attachment=(
+                           "JOIN attachment ON attachment.entry_id == entry.id"
+                           if attachment_filter else ""))
+
+        if not archived:
+            query += " AND NOT entry.archived\n"
+
+        variables = []
+
+        # if not followups:
+        #     query += " AND entry.follows_id IS NULL"
+
+        # further filters on the results, depending on search criteria
+        if content_filter:
+            # need to filter out null or REGEX will explode on them
+            query += " AND entry.content IS NOT NULL AND entry.content REGEXP ?\n"
+            variables.append(content_filter)
+        if title_filter:
+            query += " AND entry.title IS NOT NULL AND entry.title REGEXP ?\n"
+            variables.append(title_filter)
+        if author_filter:
+            query += " AND json_extract(authors2.value, '$.name') REGEXP ?\n"
+            variables.append(author_filter)
+        if attachment_filter:
+            query += " AND attachment_path REGEXP ?\n"
+            variables.append(attachment_filter)
+        if attribute_filter:
+            for i, (attr, value) in enumerate(attribute_filter):
+                query += " AND attr{} LIKE ?".format(i)
+                variables.append('%{}%'.format(value))
+        if metadata_filter:
+            for i, (meta, value) in enumerate(metadata_filter):
+                query += " AND meta{} LIKE ?".format(i)
+                variables.append('{}'.format(value))
+
+        # Check if we're searching, in that case we want to show all entries.
+        if followups or any([title_filter, content_filter, author_filter,
+                             metadata_filter, attribute_filter, attachment_filter]):
+            query += " GROUP BY thread"
+        else:
+            # We're not searching. In this case we'll only show
+            query += " GROUP BY thread HAVING entry.follows_id IS NULL"
+
+        # sort newest first, taking into account the last edit if any
+        # (of the entry or its followups, see Entry.sort_ts)
+        # TODO: does this make sense? Should we only consider creation date?
+        order_by = (sort_by_timestamp and "entry.sort_ts DESC, entry.id"
+                    or "entry.created_at")
+        query += " ORDER BY entry.priority DESC, {} DESC".format(order_by)
+        if n:
+            query += " LIMIT {}".format(n)
+            if offset:
+                query += " OFFSET {}".format(offset)
+        return query, variables
+
+
+# searches for plain words can use the full text index
+WORDS = re.compile(r"^[^\W_]+( [^\W_]+)*$")
+
+
+class PostgreSQLDialect:
+
+    name = "postgresql"
+
+    explain_prefix = "EXPLAIN "
+
+    param = "%s"
+
+    # (name, definition) of the indexes used by search_entries()
+    indexes = [
+        ("entry_title_words",
+         "entry USING gin (to_tsvector('simple', coalesce(title, '')))"),
+        ("entry_content_words",
+         "entry USING gin (to_tsvector('simple', coalesce(content, '')))"),
+        ("entry_attributes_jsonb", "entry USING gin ((attributes::jsonb))"),
+        ("entry_metadata_jsonb", "entry USING gin ((metadata::jsonb))"),
+        ("entry_follows_id", "entry (follows_id)"),
+        ("entry_listing",
+         "entry (logbook_id, follows_id, priority, sort_ts, id)"),
+        ("logbook_parent_id", "logbook (parent_id)"),
+    ]
+
+    def json_extract(self, field, key):
+        return Clause(SQL("("), field, SQL("::jsonb ->> %s)", key), glue="")
+
+    create_indexes = SQLiteDialect.create_indexes
+    neighbour_query = SQLiteDialect.neighbour_query
+
+    def get_schema_version(self, database):
+        # not kept track of, so the tables are always checked
+        return None
+
+    def set_schema_version(self, database, version):
+        pass
+
+    def prefix_search(self, field, text):
+        """Here, values containing words starting with the words in
+        the text, which can use a full text index if there is one."""
+        words = self._words(text)
+        if words:
+            return Clause(SQL("to_tsvector('simple', coalesce("), field,
+                          SQL(", '')) @@ to_tsquery('simple', %s)", words),
+                          glue="")
+        return field ** "%{}%".format(text)
+
+    def ancestors_query(self, logbook_id):
+        query = "\n".join([
+            "WITH RECURSIVE child(id, parent_id) AS (",
+            "    SELECT id, parent_id FROM logbook WHERE id = %s",
+            "    UNION ALL",
+            "    SELECT logbook.id, logbook.parent_id FROM logbook",
+            "    JOIN child ON child.parent_id = logbook.id",
+            ")",
+            "SELECT child_logbook.*",
+            "FROM child",
+            "JOIN logbook AS child_logbook ON child_logbook.id = child.id",
+            "WHERE child_logbook.id != %s"
+        ])
+        return query, [logbook_id, logbook_id]
+
+    def descendants_query(self, logbook_id):
+        # the logbooks form a tree, so no need to check for duplicates
+        query = "\n".join([
+            "WITH RECURSIVE parent(id) AS (",
+            "    SELECT %s",
+            "    UNION ALL",
+            "    SELECT logbook.id FROM logbook",
+            "    JOIN parent ON logbook.parent_id = parent.id",
+            ")",
+            "SELECT parent_logbook.*",
+            "FROM parent",
+            "JOIN logbook AS parent_logbook ON parent_logbook.id = parent.id",
+            "WHERE parent_logbook.id != %s"
+        ])
+        return query, [logbook_id, logbook_id]
+
+    def _words(self, pattern):
+        """If the pattern is just words, a full text query that matches
+        the beginnings of them, so that the index can be used to find
+        candidates for the regular expression."""
+        if WORDS.match(pattern):
+            return " & ".join("{}:*".format(word) for word in pattern.split())
+
+    def _text_filter(self, column, pattern, where, variables):
+        words = self._words(pattern)
+        if words:
+            where.append("to_tsvector('simple', coalesce({}, '')) @@ "
+                         "to_tsquery('simple', %s)".format(column))
+            variables.append(words)
+        where.append("{} ~* %s".format(column))
+        variables.append(pattern)
+
+    def search_entries(self, logbook=None, followups=False,
+                       child_logbooks=False, archived=False,
+                       n=None, offset=0,
+                       attribute_filter=None, content_filter=None,
+                       title_filter=None, author_filter=None,
+                       attachment_filter=None, metadata_filter=None,
+                       sort_by_timestamp=True):
+
+        "Works like the SQLite version, see above"
+
+        query = ""
+        where = ["NOT logbook.archived"]
+        variables = []
+
+        if logbook:
+            if child_logbooks:
+                # entries in the logbook and all its descendants, and
+                # high priority ("important") entries in its ancestors
+                query += """
+                WITH RECURSIVE descendant(id) AS (
+                    SELECT %s
+                    UNION ALL
+                    SELECT logbook.id FROM logbook
+                    JOIN descendant ON logbook.parent_id = descendant.id
+                ),
+                ancestor(id, parent_id) AS (
+                    SELECT id, parent_id FROM logbook WHERE id = %s
+                    UNION ALL
+                    SELECT logbook.id, logbook.parent_id FROM logbook
+                    JOIN ancestor ON ancestor.parent_id = logbook.id
+                )"""
+                variables += [logbook.id, logbook.id]
+                where.append(
+                    "(entry.logbook_id IN (SELECT id FROM descendant) OR "
+                    "(entry.priority > 100 AND "
+                    "entry.logbook_id IN (SELECT id FROM ancestor)))")
+            else:
+                where.append("entry.logbook_id = %s")
+                variables.append(logbook.id)
+
+        # entry.* is allowed since we group by the primary key. The
+        # timestamp and authors are formatted like SQLite's, as text.
+        query += """
+        SELECT entry.*,
+            entry.id AS thread,
+            count(DISTINCT followup.id) AS n_followups,
+            to_char(max(coalesce(followup.last_changed_at,
+                                 followup.created_at,
+                                 entry.last_changed_at,
+                                 entry.created_at)),
+                    'YYYY-MM-DD HH24:MI:SS') AS "timestamp",
+            json_agg(coalesce(followup.authors, '[]')::json)::text
+                AS followup_authors
+        FROM entry
+        JOIN logbook ON logbook.id = entry.logbook_id
+        LEFT JOIN entry AS followup ON followup.follows_id = entry.id
+        """
+
+        if not archived:
+            where.append("NOT entry.archived")
+        if content_filter:
+            self._text_filter("entry.content", content_filter,
+                              where, variables)
+        if title_filter:
+            self._text_filter("entry.title", title_filter, where, variables)
+        if author_filter:
+            where.append(
+                "EXISTS (SELECT 1 FROM "
+                "jsonb_array_elements(entry.authors::jsonb) AS author "
+                "WHERE author ->> 'name' ~* %s)")
+            variables.append(author_filter)
+        if attachment_filter:
+            where.append(
+                "EXISTS (SELECT 1 FROM attachment "
+                "WHERE attachment.entry_id = entry.id "
+                "AND attachment.path ~* %s)")
+            variables.append(attachment_filter)
+        # checking that the key exists first lets the index help
+        for name, value in attribute_filter or []:
+            where.append("entry.attributes::jsonb ? %s AND "
+                         "entry.attributes::jsonb ->> %s ILIKE %s")
+            variables += [name, name, "%{}%".format(value)]
+        for name, value in metadata_filter or []:
+            where.append("entry.metadata::jsonb ? %s AND "
+                         "entry.metadata::jsonb ->> %s ILIKE %s")
+            variables += [name, name, value]
+
+        if not (followups or any([title_filter, content_filter,
+                                  author_filter, metadata_filter,
+                                  attribute_filter, attachment_filter])):
+            # not searching; only show the first entry of each thread
+            where.append("entry.follows_id IS NULL")
+
+        query += "WHERE " + "\n  AND ".join(where)
+        query += "\nGROUP BY entry.id"
+        order_by = (sort_by_timestamp and "entry.sort_ts DESC, entry.id"
+                    or "entry.created_at")
+        query += "\nORDER BY entry.priority DESC, {} DESC".format(order_by)
+        if n:
+            query += " LIMIT {}".format(n)
+            if offset:
+                query += " OFFSET {}".format(offset)
+        return query, variables
@@ -1,10 +1,5 @@
 from tempfile import NamedTemporaryFile
 
-try:
-    import pdfkit
-except ImportError:
-    pdfkit = None
-
 
 def export_entries_as_pdf(logbook, entries):
 
@@ -16,7 +11,10 @@ def export_entries_as_pdf(logbook, entries):
     "reportlab" looks pretty good (https://bitbucket.org/rptlab/reportlab)
     """
 
-    if pdfkit is None:
+    try:
+        # imported here since it's rarely needed
+        import pdfkit
+    except ImportError:
         return None
 
     entries_html = [
@@ -0,0 +1,189 @@
+"""
+Image processing for attachments, e.g. thumbnails.
+
+Decoding a large image (think 40 megapixel detector images) takes a
+lot of time and memory, so it's not done in the request that uploaded
+the file. Instead the work is handed to a pool of worker processes and
+the attachment metadata is filled in when it's done. Until then, the
+original file is served in place of the thumbnail.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import logging
+import mimetypes
+import os
+import uuid
+import warnings
+
+from flask import current_app
+
+from .db import Attachment
+from .storage import get_disk_path
+from .writequeue import run_write
+
+
+THUMBNAIL_SIZE = (100, 100)
+
+# The pool is created on first use, so that each (forked) worker process
+# gets its own instead of inheriting a broken one.
+_executor = None
+
+
+def get_executor(workers):
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=workers)
+    return _executor
+
+
+def is_image(attachment):
+    "Guess if the attachment is an image, without looking at the file"
+    content_type = (attachment.content_type or
+                    mimetypes.guess_type(attachment.filename or "")[0] or "")
+    return content_type.startswith("image/")
+
+
+def open_image(path, max_pixels=None):
+    """Open an image file for reading, refusing images larger than
+    max_pixels since decoding them might eat all our memory. Returns None
+    if the file can't be used."""
+    # PIL is imported here since it's only needed in the worker processes
+    from PIL import Image
+    if max_pixels:
+        Image.MAX_IMAGE_PIXELS = max_pixels
+    with warnings.catch_warnings():
+        # PIL just warns about large images, unless they are *very* large
+        warnings.simplefilter("error", Image.DecompressionBombWarning)
+        try:
+            return Image.open(path)
+        except (IOError, Image.DecompressionBombWarning,
+                Image.DecompressionBombError) as e:
+            logging.info("Not using %s as image: %s", path, e)
+
+
+def flatten_alpha(image):
+    """JPEG does not support alpha channel, so we'll superimpose images
+    with transparency on a white background."""
+    from PIL import Image
+    if ((image.mode in ("RGBA", "LA")) or
+            (image.mode == 'P' and "transparency" in image.info)):
+        alpha = image.convert("RGBA").split()[-1]
+        bg = Image.new("RGB", image.size, (255, 255, 255, 255))
+        bg.paste(image, mask=alpha)
+        return bg
+    return image.convert("RGB")
+
+
+def make_thumbnail(path, max_pixels=None):
+    """Create a thumbnail version of the image at the given path, stored
+    next to it. Returns image metadata, or None if the file is not a
+    recognized image. This is run in a worker process."""
+    image = open_image(path, max_pixels)
+    if image is None:
+        return None
+    width, height = image.size
+    metadata = dict(size={"width": width, "height": height})
+    thumbnail_path = path + ".thumbnail"
+    if os.path.exists(thumbnail_path):
+        # the same file has been uploaded before
+        if width > THUMBNAIL_SIZE[0] or height > THUMBNAIL_SIZE[1]:
+            thumbnail = open_image(thumbnail_path)
+            if thumbnail is not None:
+                width, height = thumbnail.size
+                metadata["thumbnail_size"] = {"width": width,
+                                              "height": height}
+        return metadata
+    if width > THUMBNAIL_SIZE[0] or height > THUMBNAIL_SIZE[1]:
+        # Draft mode lets the JPEG decoder scale the image down while
+        # decoding, which is much faster and uses less memory than loading
+        # the whole thing. Only has an effect on JPEG (and a few others).
+        image.draft("RGB", THUMBNAIL_SIZE)
+        # Written to a temporary file first, so that a half written
+        # thumbnail is never found by the check above. Thumbnails may be
+        # made in threads (see schedule_thumbnail()) so the pid won't do.
+        tmp_path = "{}.{}.tmp".format(thumbnail_path, uuid.uuid4().hex)
+        try:
+            image.thumbnail(THUMBNAIL_SIZE)
+            image = flatten_alpha(image)
+            image.save(tmp_path, "JPEG")
+            os.replace(tmp_path, thumbnail_path)
+        except (IOError, OSError) as e:
+            logging.error("Error making thumbnail of %s: %s", path, e)
+            return metadata
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        width, height = image.size
+        metadata["thumbnail_size"] = {"width": width, "height": height}
+    else:
+        # small image, re-use it as its own thumbnail
+        try:
+            os.link(path, thumbnail_path)
+        except FileExistsError:
+            pass  # the same file, thumbnailed meanwhile
+    return metadata
+
+
+def store_image_metadata(attachment_id, metadata):
+    "Add image information to the metadata of an attachment"
+    if metadata is None:
+        return
+    try:
+        attachment = Attachment.get(Attachment.id == attachment_id)
+    except Attachment.DoesNotExist:
+        # must have been deleted meanwhile
+        return
+    # any metadata given by the user takes precedence
+    attachment.metadata = dict(metadata, **(attachment.metadata or {}))
+    attachment.save(only=[Attachment.metadata])
+
+
+def _thumbnail_done(attachment_id, future):
+    # runs in the executor's thread, so the write must be queued like
+    # any other (see writequeue.py)
+    try:
+        run_write(store_image_metadata, attachment_id, future.result())
+    except Exception as e:
+        logging.error("Failed to create thumbnail for attachment %d: %s",
+                      attachment_id, e)
+
+
+def schedule_thumbnail(attachment):
+    """Arrange for a thumbnail to be created for the attachment, if it's
+    an image. The attachment must already have been saved.
+
+    If THUMBNAIL_WORKERS is 0, the thumbnail is created immediately.
+    Otherwise returns the future of the thumbnail."""
+    if not is_image(attachment):
+        return None
+    path = os.path.join(current_app.config["UPLOAD_FOLDER"],
+                        get_disk_path(attachment.path))
+    max_pixels = current_app.config.get("MAX_IMAGE_PIXELS")
+    workers = current_app.config.get("THUMBNAIL_WORKERS", 0)
+    if not workers:
+        run_write(store_image_metadata, attachment.id,
+                  make_thumbnail(path, max_pixels))
+        return None
+    future = get_executor(workers).submit(make_thumbnail, path, max_pixels)
+    future.add_done_callback(partial(_thumbnail_done, attachment.id))
+    return future
+
+
+def make_rendition(path, rendition_path, width, format="JPEG",
+                   max_pixels=None):
+    """Save a version of the image at path, scaled down to the given
+    width, to rendition_path. Images are never scaled up. Returns False if
+    the file is not a recognized image. This is run in a worker process."""
+    image = open_image(path, max_pixels)
+    if image is None:
+        return False
+    size = (width, image.size[1])
+    image.draft("RGB", size)
+    image.thumbnail(size)
+    if format == "JPEG":
+        image = flatten_alpha(image)
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    image.save(rendition_path, format, quality=85)
+    return True
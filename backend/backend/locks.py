@@ -0,0 +1,176 @@
+"""
+Entry edit locks (see EntryLock in db.py), with the active ones cached.
+
+Whether an entry is locked is checked every time an entry is shown,
+also for each of its followups, and nearly always the answer is no.
+So each process remembers the active lock (or that there is none) of
+the entries it has looked at. Whenever a lock changes, a counter
+shared by all processes (see sharedmem.py) is increased, after the
+change is committed, and the processes then forget what they had
+cached. Checking for locks when saving an entry still goes to the
+database, inside the same transaction.
+
+A lock is a lease, that expires after LOCK_LEASE seconds unless the
+client keeps it alive with "heartbeats" (see renew_lock()). Locks that
+have expired or been cancelled are deleted LOCK_RETENTION seconds
+later; this is checked at most every LOCK_SWEEP_INTERVAL seconds, when
+a lock is acquired.
+"""
+
+from datetime import datetime, timedelta
+import logging
+import os
+import tempfile
+import threading
+from time import monotonic
+
+from flask import has_app_context
+
+from .db import Entry, EntryLock
+from .sharedmem import SharedCounter
+from .writequeue import run_write
+
+
+logger = logging.getLogger(__name__)
+
+# set up from the config, see setup_locks()
+_cache = None
+_settings = {"lease": 3600, "retention": 86400, "sweep_interval": 600}
+_last_sweep = None
+
+
+class LockCache:
+
+    """The active lock (or None) of each entry looked up, as long as
+    the shared counter doesn't change."""
+
+    def __init__(self, counter, max_size=10000):
+        self.counter = counter
+        self.max_size = max_size
+        self._locks = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self, entry_id):
+        version = self.counter.total()
+        with self._lock:
+            if version != self._version:
+                self._locks.clear()
+                self._version = version
+            if entry_id in self._locks:
+                lock = self._locks[entry_id]
+                if lock is None or lock.locked:
+                    return lock
+        lock = find_lock(entry_id)
+        with self._lock:
+            # if something changed meanwhile, this may already be old
+            if version == self._version:
+                if len(self._locks) >= self.max_size:
+                    self._locks.clear()
+                self._locks[entry_id] = lock
+        return lock
+
+    def changed(self):
+        "Make all processes forget their cached locks"
+        self.counter.increase()
+
+
+def find_lock(entry_id):
+    "The active lock on the entry, from the database"
+    try:
+        return EntryLock.get((EntryLock.entry_id == entry_id) &
+                             (EntryLock.expires_at > datetime.utcnow()) &
+                             (EntryLock.cancelled_at == None))
+    except EntryLock.DoesNotExist:
+        return None
+
+
+def get_lock(entry_id):
+    """The active lock on the entry, or None. Outside the app (e.g. in
+    scripts) there is no cache, since the database may be another."""
+    if _cache is None or not has_app_context():
+        return find_lock(entry_id)
+    return _cache.get(entry_id)
+
+
+def locks_changed():
+    "Call after committing any change to locks"
+    if _cache is not None:
+        _cache.changed()
+
+
+def acquire_lock(entry, ip, steal=False):
+    """Lock the entry for the given IP, unless someone else has it.
+    If 'steal' is given, any existing lock is cancelled."""
+    lock = run_write(entry.get_lock, ip=ip, acquire=True, steal=steal,
+                     lease=_settings["lease"])
+    locks_changed()
+    maybe_sweep()
+    return lock
+
+
+def cancel_lock(lock, ip):
+    run_write(lock.cancel, ip)
+    locks_changed()
+    return lock
+
+
+def _renew(lock_id, entry_id, ip, lease):
+    lock = EntryLock.get((EntryLock.id == lock_id) &
+                         (EntryLock.entry_id == entry_id))
+    current = find_lock(entry_id)
+    if current is not None and current.id != lock.id:
+        # someone else has taken over
+        raise Entry.Locked(current)
+    if lock.cancelled_at or lock.owned_by_ip != ip:
+        raise Entry.Locked(lock)
+    # it's fine to renew an expired lock, since nobody else took it
+    lock.renew(lease)
+    return lock
+
+
+def renew_lock(lock_id, entry_id, ip):
+    """A heartbeat from the owner of a lock, extending the lease.
+    Raises Entry.Locked if the lock has been lost to someone else."""
+    lock = run_write(_renew, lock_id, entry_id, ip, _settings["lease"])
+    locks_changed()
+    return lock
+
+
+def sweep_locks(retention=None):
+    """Delete locks that expired or were cancelled more than 'retention'
+    seconds ago. They are not active anymore, so the cache is still
+    valid. Returns the number of locks deleted."""
+    if retention is None:
+        retention = _settings["retention"]
+    before = datetime.utcnow() - timedelta(seconds=retention)
+    return run_write(lambda: EntryLock.delete().where(
+        (EntryLock.expires_at < before) |
+        (EntryLock.cancelled_at < before)).execute())
+
+
+def maybe_sweep():
+    global _last_sweep
+    now = monotonic()
+    if _last_sweep is not None and now - _last_sweep < _settings["sweep_interval"]:
+        return
+    _last_sweep = now
+    try:
+        deleted = sweep_locks()
+    except Exception:
+        logger.exception("Failed to delete old locks")
+    else:
+        if deleted:
+            logger.info("Deleted %d old locks", deleted)
+
+
+def setup_locks(app):
+    global _cache, _last_sweep
+    folder = (app.config.get("METRICS_FOLDER") or
+              os.path.join(tempfile.gettempdir(), "elogy-metrics"))
+    _cache = LockCache(SharedCounter(os.path.join(folder, "locks.count")))
+    _settings.update(
+        lease=app.config.get("LOCK_LEASE", 3600),
+        retention=app.config.get("LOCK_RETENTION", 86400),
+        sweep_interval=app.config.get("LOCK_SWEEP_INTERVAL", 600))
+    _last_sweep = None
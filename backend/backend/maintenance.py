@@ -0,0 +1,258 @@
+"""
+Regular maintenance of the SQLite database.
+
+- "optimize" lets SQLite update the statistics the query planner
+  uses (ANALYZE), for the tables where they look out of date.
+- "vacuum" gives free pages back to the file system, e.g. after
+  entries have been archived (see archive.py). This needs the
+  database to be in incremental auto_vacuum mode, which new databases
+  are; older ones can be converted, once, with
+  "flask maintenance --enable-incremental-vacuum" (which rewrites the
+  whole file, so do it while elogy is down). Pages are freed a few at
+  a time, so that writers don't have to wait for long.
+- "checkpoint" copies changes from the WAL back into the database.
+  Normally SQLite does that automatically, in whatever request
+  happens to commit when the WAL reaches WAL_AUTOCHECKPOINT pages,
+  which then takes longer. A "passive" checkpoint, done here every
+  CHECKPOINT_INTERVAL seconds, does the same without waiting for
+  anybody. "truncate" (in the daily run) also waits for readers and
+  writers to finish, and then empties the WAL file.
+
+The daily run (at MAINTENANCE_TIME) does all of these. It can be done
+from the command line, e.g. from cron:
+
+$ FLASK_APP=backend.app ELOGY_CONFIG_FILE=../config.py flask maintenance
+
+or in the background by one of the elogy processes, if
+MAINTENANCE_IN_PROCESS is set. Then the autocheckpoints can be turned
+down (or off) with WAL_AUTOCHECKPOINT, so that requests don't do them.
+
+The time each step takes, and how much space was reclaimed, is logged.
+"""
+
+from datetime import datetime, timedelta
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+from time import perf_counter, sleep
+
+from .db import db
+
+
+logger = logging.getLogger(__name__)
+
+TASKS = ("optimize", "vacuum", "checkpoint")
+
+# set up from the config, see setup_maintenance()
+_scheduler = None
+
+
+def _pragma(name):
+    return db.execute_sql("PRAGMA {}".format(name)).fetchone()[0]
+
+
+def optimize():
+    """Update the query planner statistics where needed. Databases that
+    have never been analyzed get a full ANALYZE."""
+    analyzed = db.execute_sql(
+        "SELECT count(*) FROM sqlite_master WHERE name = 'sqlite_stat1'"
+    ).fetchone()[0]
+    # keeps ANALYZE quick on big tables (ignored by older SQLite)
+    db.execute_sql("PRAGMA analysis_limit = 1000")
+    if analyzed:
+        db.execute_sql("PRAGMA optimize")
+    else:
+        db.execute_sql("ANALYZE")
+
+
+def incremental_vacuum(step=1000, pause=0.01):
+    """Free the unused pages, 'step' at a time. Returns the number of
+    pages freed."""
+    if _pragma("auto_vacuum") != 2:
+        free = _pragma("freelist_count")
+        if free:
+            logger.info("%d free pages, but incremental auto_vacuum is not "
+                        "enabled", free)
+        return 0
+    freed = 0
+    while True:
+        before = _pragma("freelist_count")
+        if not before:
+            break
+        # each pragma call frees one page, so it must be run to the end
+        db.execute_sql(
+            "PRAGMA incremental_vacuum({})".format(step)).fetchall()
+        after = _pragma("freelist_count")
+        if after >= before:
+            break  # e.g. someone else freed more meanwhile
+        freed += before - after
+        sleep(pause)
+    return freed
+
+
+def enable_incremental_vacuum():
+    """Switch an existing database to incremental auto_vacuum. This
+    rewrites the whole database, and can take a long time."""
+    db.execute_sql("PRAGMA auto_vacuum = INCREMENTAL")
+    db.execute_sql("VACUUM")
+
+
+def checkpoint(mode="PASSIVE"):
+    """Checkpoint the WAL. Returns the number of pages in the WAL and
+    the number of them checkpointed, or None if not in WAL mode."""
+    busy, log, checkpointed = db.execute_sql(
+        "PRAGMA wal_checkpoint({})".format(mode)).fetchone()
+    if log < 0:
+        return None
+    if busy:
+        logger.info("Checkpoint (%s) could not finish; database busy", mode)
+    return log, checkpointed
+
+
+def _disk_usage(path):
+    "Size of the database file and its WAL, or None if not a file"
+    if not os.path.isfile(path):
+        return None
+    size = os.path.getsize(path)
+    if os.path.exists(path + "-wal"):
+        size += os.path.getsize(path + "-wal")
+    return size
+
+
+def run_maintenance(tasks=TASKS, checkpoint_mode="TRUNCATE", vacuum_step=1000):
+    """Run the given tasks, see above. Returns a dict of statistics."""
+    if db.dialect.name != "sqlite":
+        logger.info("Skipping maintenance, only needed for SQLite")
+        return {}
+    stats = {}
+    size = _disk_usage(db.database)
+    for task in TASKS:
+        if task not in tasks:
+            continue
+        start = perf_counter()
+        if task == "optimize":
+            optimize()
+        elif task == "vacuum":
+            freed = incremental_vacuum(vacuum_step)
+            stats["vacuumed_bytes"] = freed * _pragma("page_size")
+        elif task == "checkpoint":
+            result = checkpoint(checkpoint_mode)
+            if result is not None:
+                stats["wal_pages"], stats["checkpointed_pages"] = result
+        stats[task + "_seconds"] = round(perf_counter() - start, 3)
+    if size is not None:
+        stats["reclaimed_bytes"] = size - _disk_usage(db.database)
+    logger.info("Maintenance: %r", stats)
+    return stats
+
+
+def next_daily(now, time_of_day):
+    "The next time it's 'time_of_day' (as 'HH:MM'), after 'now'"
+    hours, minutes = (int(part) for part in time_of_day.split(":"))
+    then = now.replace(hour=hours, minute=minutes, second=0, microsecond=0)
+    if then <= now:
+        then += timedelta(days=1)
+    return then
+
+
+class MaintenanceScheduler:
+
+    """Runs passive checkpoints every 'checkpoint_interval' seconds,
+    and the full maintenance daily at 'daily_at', in a background
+    thread. Only one of the processes sharing the lock file does it."""
+
+    def __init__(self, lock_path, checkpoint_interval=300, daily_at="03:30",
+                 vacuum_step=1000):
+        self.lock_path = lock_path
+        self.checkpoint_interval = checkpoint_interval
+        self.daily_at = daily_at
+        self.vacuum_step = vacuum_step
+        self._lock_file = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_thread(self):
+        # started lazily, since threads don't survive a fork (uWSGI)
+        thread = self._thread
+        if thread is not None and thread.pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._thread.pid != os.getpid():
+                self._lock_file = None  # the lock belongs to the parent
+                self._thread = threading.Thread(target=self._run,
+                                                name="elogy-maintenance",
+                                                daemon=True)
+                self._thread.pid = os.getpid()
+                self._thread.start()
+
+    def _is_ours(self):
+        "Whether this process is the one doing maintenance"
+        if self._lock_file is None:
+            lock_file = open(self.lock_path, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            # kept for as long as the process lives
+            self._lock_file = lock_file
+        return True
+
+    def run(self, daily):
+        if daily:
+            run_maintenance(vacuum_step=self.vacuum_step)
+        else:
+            start = perf_counter()
+            result = checkpoint("PASSIVE")
+            logger.debug("Checkpoint %r took %.3f s", result,
+                         perf_counter() - start)
+
+    def _run(self):
+        now = datetime.now()
+        next_checkpoint = (now + timedelta(seconds=self.checkpoint_interval)
+                           if self.checkpoint_interval else None)
+        next_run = next_daily(now, self.daily_at) if self.daily_at else None
+        while next_checkpoint or next_run:
+            due = min(t for t in (next_checkpoint, next_run) if t)
+            sleep(max(0, (due - datetime.now()).total_seconds()))
+            now = datetime.now()
+            daily = next_run is not None and now >= next_run
+            if daily:
+                next_run = next_daily(now, self.daily_at)
+            if next_checkpoint is not None and now >= next_checkpoint:
+                next_checkpoint = now + timedelta(
+                    seconds=self.checkpoint_interval)
+            elif not daily:
+                continue
+            try:
+                if self._is_ours():
+                    self.run(daily)
+            except Exception:
+                logger.exception("Database maintenance failed")
+            finally:
+                db.close()
+
+
+def ensure_scheduler():
+    "Make sure the maintenance runs in this process, if configured to"
+    if _scheduler is not None:
+        _scheduler.ensure_thread()
+
+
+def setup_maintenance(app):
+    global _scheduler
+    _scheduler = None
+    if not app.config.get("MAINTENANCE_IN_PROCESS"):
+        return
+    if db.dialect.name != "sqlite":
+        return
+    folder = (app.config.get("METRICS_FOLDER") or
+              os.path.join(tempfile.gettempdir(), "elogy-metrics"))
+    os.makedirs(folder, exist_ok=True)
+    _scheduler = MaintenanceScheduler(
+        os.path.join(folder, "maintenance.lock"),
+        checkpoint_interval=app.config.get("CHECKPOINT_INTERVAL", 300),
+        daily_at=app.config.get("MAINTENANCE_TIME", "03:30"),
+        vacuum_step=app.config.get("VACUUM_STEP", 1000))
@@ -0,0 +1,258 @@
+"""
+Metrics about what the application is doing, in the Prometheus text
+format, served at /metrics.
+
+Values are kept in memory mapped files (see sharedmem.py), one per
+process, in the METRICS_FOLDER. The endpoint adds up the values from
+all the files, so the metrics cover all uWSGI workers no matter which
+one handles the request. When a process has exited, its counters are
+added to the totals in "metrics-exited.json" and its file is removed;
+gauges (e.g. requests in progress) only count live processes.
+"""
+
+from collections import OrderedDict
+import json
+import os
+import tempfile
+from time import time
+
+from flask import Response, current_app, g, has_request_context, request
+
+from .db import pool_hooks, query_hooks, query_error_hooks
+from .sharedmem import ProcessValues, read_file
+
+
+# name -> (type, help text)
+METRICS = OrderedDict([
+    ("elogy_http_requests_in_progress",
+     ("gauge", "Requests currently being handled")),
+    ("elogy_http_responses_total",
+     ("counter", "Responses sent, by status code")),
+    ("elogy_http_request_duration_seconds",
+     ("histogram", "Time taken to handle requests")),
+    ("elogy_http_response_size_bytes",
+     ("histogram", "Size of response bodies, when known")),
+    ("elogy_sql_queries_total",
+     ("counter", "SQL statements executed in requests")),
+    ("elogy_sql_duration_seconds_total",
+     ("counter", "Time spent executing SQL statements")),
+    ("elogy_sql_errors_total",
+     ("counter", "Failed SQL statements; 'busy' means the database was locked")),
+    ("elogy_sql_queries_per_request",
+     ("histogram", "Number of SQL statements executed per request")),
+    ("elogy_sql_duration_seconds_per_request",
+     ("histogram", "Time spent executing SQL statements per request")),
+    ("elogy_db_read_connections_in_use",
+     ("gauge", "Read only database connections currently used by requests")),
+    ("elogy_db_read_connections_open",
+     ("gauge", "Read only database connections opened, in use or idle")),
+    ("elogy_db_read_connection_acquisitions_total",
+     ("counter", "Read only connections handed out to requests")),
+    ("elogy_db_read_connection_wait_seconds_total",
+     ("counter", "Time spent waiting for a read only connection")),
+    ("elogy_db_read_pool_exhausted_total",
+     ("counter", "Times no read only connection was free in time, "
+      "so the writer connection was used")),
+    ("elogy_actions_in_progress",
+     ("gauge", "Configured actions currently running")),
+    ("elogy_actions_total",
+     ("counter", "Configured actions run")),
+])
+
+BUCKETS = {
+    "elogy_http_request_duration_seconds": [
+        .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10],
+    "elogy_http_response_size_bytes": [
+        100, 1000, 10000, 100000, 1000000, 10000000, 100000000],
+    "elogy_sql_queries_per_request": [
+        1, 2, 5, 10, 20, 50, 100, 200, 500],
+    "elogy_sql_duration_seconds_per_request": [
+        .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5],
+}
+
+_store = None
+
+
+def _exited_path(folder):
+    return os.path.join(folder, "metrics-exited.json")
+
+
+def _load_exited(folder):
+    try:
+        with open(_exited_path(folder)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _retire(path):
+    "Keep the counters of a process that has exited (see ProcessValues)"
+    folder = os.path.dirname(path)
+    totals = _load_exited(folder)
+    for key, value in read_file(path):
+        if METRICS.get(json.loads(key)[0], ("",))[0] != "gauge":
+            totals[key] = totals.get(key, 0) + value
+    exited = _exited_path(folder)
+    with open(exited + ".part", "w") as f:
+        json.dump(totals, f)
+    os.replace(exited + ".part", exited)
+
+
+def get_store():
+    global _store
+    if _store is None:
+        folder = (current_app.config.get("METRICS_FOLDER") or
+                  os.path.join(tempfile.gettempdir(), "elogy-metrics"))
+        _store = ProcessValues(folder, "metrics", retire=_retire)
+    return _store
+
+
+def _key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+def inc(name, amount=1, **labels):
+    get_store().values.add(_key(name, labels), amount)
+
+
+def observe(name, value, **labels):
+    "Add a value to a histogram"
+    values = get_store().values
+    for bucket in BUCKETS[name]:
+        if value <= bucket:
+            values.add(_key(name + "_bucket", dict(labels, le=str(bucket))))
+    values.add(_key(name + "_bucket", dict(labels, le="+Inf")))
+    values.add(_key(name + "_sum", labels), value)
+    values.add(_key(name + "_count", labels))
+
+
+def collect():
+    "Add up the values from all processes"
+    store = get_store()
+    # files() first, since it may move more values to the exited ones
+    paths = [path for _, path in store.files()]
+    totals = _load_exited(store.folder)
+    for path in paths:
+        try:
+            items = read_file(path)
+        except FileNotFoundError:
+            continue
+        for key, value in items:
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def _escape(value):
+    return (str(value).replace("\\", r"\\").replace("\n", r"\n")
+            .replace('"', r'\"'))
+
+
+def _sort_key(sample):
+    "Order histogram buckets by size, not alphabetically"
+    labels, _ = sample
+    return [(k, float(v) if k == "le" else v) for k, v in labels]
+
+
+def render(totals):
+    samples = {}
+    for key, value in totals.items():
+        name, labels = json.loads(key)
+        samples.setdefault(name, []).append((labels, value))
+    lines = []
+    for metric, (type_, help_) in METRICS.items():
+        lines.append("# HELP {} {}".format(metric, help_))
+        lines.append("# TYPE {} {}".format(metric, type_))
+        if type_ == "histogram":
+            names = [metric + suffix for suffix in ("_bucket", "_sum", "_count")]
+        else:
+            names = [metric]
+        for name in names:
+            for labels, value in sorted(samples.get(name, []), key=_sort_key):
+                if labels:
+                    label_str = "{{{}}}".format(",".join(
+                        '{}="{}"'.format(k, _escape(v)) for k, v in labels))
+                else:
+                    label_str = ""
+                lines.append("{}{} {}".format(name, label_str, repr(value)))
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view():
+    return Response(render(collect()),
+                    mimetype="text/plain; version=0.0.4")
+
+
+# Request hooks
+
+def _endpoint():
+    return request.endpoint or "none"
+
+
+def before_request():
+    g.metrics_start = time()
+    g.sql_queries = 0
+    g.sql_time = 0
+    inc("elogy_http_requests_in_progress")
+
+
+def after_request(response):
+    g.metrics_status = response.status_code
+    if response.content_length is not None:
+        observe("elogy_http_response_size_bytes", response.content_length,
+                endpoint=_endpoint())
+    return response
+
+
+def teardown_request(exception=None):
+    if "metrics_start" not in g:
+        return
+    inc("elogy_http_requests_in_progress", -1)
+    endpoint = _endpoint()
+    observe("elogy_http_request_duration_seconds",
+            time() - g.metrics_start, endpoint=endpoint,
+            method=request.method)
+    inc("elogy_http_responses_total", endpoint=endpoint,
+        method=request.method, status=str(g.get("metrics_status", 500)))
+    inc("elogy_sql_queries_total", g.sql_queries)
+    inc("elogy_sql_duration_seconds_total", g.sql_time)
+    observe("elogy_sql_queries_per_request", g.sql_queries,
+            endpoint=endpoint)
+    observe("elogy_sql_duration_seconds_per_request", g.sql_time,
+            endpoint=endpoint)
+
+
+def record_query(sql, params, duration, cursor):
+    if has_request_context() and "sql_queries" in g:
+        g.sql_queries += 1
+        g.sql_time += duration
+
+
+def record_query_error(sql, params, duration, error):
+    if has_request_context():
+        message = str(error).lower()
+        busy = "locked" in message or "busy" in message
+        inc("elogy_sql_errors_total", kind="busy" if busy else "other")
+
+
+def record_pool_event(event, pool, wait):
+    values = get_store().values
+    values.set(_key("elogy_db_read_connections_open", {}), pool.created)
+    if event == "acquire":
+        inc("elogy_db_read_connections_in_use")
+        inc("elogy_db_read_connection_acquisitions_total")
+        inc("elogy_db_read_connection_wait_seconds_total", wait)
+    elif event == "release":
+        inc("elogy_db_read_connections_in_use", -1)
+    elif event == "exhausted":
+        inc("elogy_db_read_pool_exhausted_total")
+        inc("elogy_db_read_connection_wait_seconds_total", wait)
+
+
+def setup_metrics(app):
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+    query_hooks.append(record_query)
+    query_error_hooks.append(record_query_error)
+    pool_hooks.append(record_pool_event)
@@ -0,0 +1,169 @@
+"""
+Keeps track of the SQL statements executed in each request: the SQL,
+parameters, time taken (including fetching the results) and number of
+rows.
+
+Statements slower than SLOW_QUERY_THRESHOLD are logged as warnings,
+together with their query plan from the database.
+
+If SQL_TRACE is enabled, the trace can be requested by adding the
+header "X-Elogy-SQL-Trace: 1" or the argument "sql_trace=1" to any
+request. JSON responses then get an extra "sql_trace" field, and all
+responses get headers with the number of statements and total time.
+Statements run more than once are listed under "repeated", which is
+where N+1 problems show up.
+"""
+
+from collections import Counter
+import json
+import logging
+from time import perf_counter
+
+from flask import current_app, g, has_request_context, request
+
+from .db import db, query_hooks
+
+
+# Don't keep more than this many statements for a single request
+MAX_TRACE_LENGTH = 1000
+
+# set from the config, see setup_profiler()
+slow_query_threshold = None
+
+logger = logging.getLogger(__name__)
+
+
+class TracedCursor:
+
+    "Wraps a DB cursor, counting the rows fetched and the time it takes"
+
+    def __init__(self, cursor, entry):
+        self._cursor = cursor
+        self._entry = entry
+
+    def _fetched(self, start, n_rows):
+        self._entry["duration"] += perf_counter() - start
+        self._entry["rows"] += n_rows
+
+    def fetchone(self):
+        start = perf_counter()
+        row = self._cursor.fetchone()
+        self._fetched(start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, *args):
+        start = perf_counter()
+        rows = self._cursor.fetchmany(*args)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = perf_counter()
+        rows = self._cursor.fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+
+def _json_safe(params):
+    return [p if isinstance(p, (int, float, str, type(None))) else str(p)
+            for p in (params or [])]
+
+
+def explain(sql, params):
+    "Get the query plan for a statement from the database, as text"
+    try:
+        # using a cursor directly, to stay out of the trace
+        cursor = db.get_cursor()
+        cursor.execute(db.dialect.explain_prefix + sql, params or ())
+        rows = cursor.fetchall()
+    except Exception as e:
+        return "(no query plan: {})".format(e)
+    return "\n".join("  {}".format(row[-1]) for row in rows)
+
+
+def log_slow_query(sql, params, duration, rows=None):
+    logger.warning("Slow query (%.3f s, %s rows): %s %r\n%s",
+                   duration, "?" if rows is None else rows, sql, params,
+                   explain(sql, params))
+
+
+def record_query(sql, params, duration, cursor):
+    if not (has_request_context() and "sql_trace" in g):
+        if (slow_query_threshold is not None and
+                duration > slow_query_threshold):
+            log_slow_query(sql, params, duration)
+        return
+    g.sql_trace_count += 1
+    if len(g.sql_trace) >= MAX_TRACE_LENGTH:
+        return
+    entry = {"sql": sql, "params": params, "duration": duration,
+             "rows": cursor.rowcount if cursor.rowcount != -1 else 0}
+    g.sql_trace.append(entry)
+    if cursor.description is not None:
+        # a query with results; they are fetched later
+        return TracedCursor(cursor, entry)
+
+
+def _trace_requested():
+    return (current_app.config.get("SQL_TRACE", False) and
+            (request.headers.get("X-Elogy-SQL-Trace") == "1" or
+             request.args.get("sql_trace") == "1"))
+
+
+def get_trace():
+    queries = g.get("sql_trace", [])
+    counts = Counter(entry["sql"] for entry in queries)
+    return {
+        "count": g.get("sql_trace_count", 0),
+        "duration": sum(entry["duration"] for entry in queries),
+        "repeated": [{"sql": sql, "count": n}
+                     for sql, n in counts.most_common() if n > 1],
+        "queries": [dict(entry, params=_json_safe(entry["params"]))
+                    for entry in queries],
+    }
+
+
+def before_request():
+    g.sql_trace = []
+    g.sql_trace_count = 0
+
+
+def after_request(response):
+    if "sql_trace" not in g:
+        return response
+    if slow_query_threshold is not None:
+        for entry in g.sql_trace:
+            if entry["duration"] > slow_query_threshold:
+                log_slow_query(entry["sql"], entry["params"],
+                               entry["duration"], entry["rows"])
+    if _trace_requested():
+        trace = get_trace()
+        response.headers["X-Elogy-SQL-Count"] = str(trace["count"])
+        response.headers["X-Elogy-SQL-Time"] = "{:.6f}".format(
+            trace["duration"])
+        if response.mimetype == "application/json":
+            data = json.loads(response.get_data(as_text=True))
+            if isinstance(data, dict):
+                data["sql_trace"] = trace
+                response.set_data(json.dumps(data))
+    return response
+
+
+def setup_profiler(app):
+    global slow_query_threshold
+    slow_query_threshold = app.config.get("SLOW_QUERY_THRESHOLD")
+    app.before_request(before_request)
+    app.after_request(after_request)
+    query_hooks.append(record_query)
@@ -0,0 +1,91 @@
+"""
+A pool of read only connections to an SQLite database.
+
+In WAL mode, readers don't block the writer and vice versa, but only
+as long as they use separate connections. The pool keeps a number of
+connections opened with "mode=ro" and "query_only" that are shared by
+all the threads in a process, and handed out for the duration of a
+request (see ElogyDatabase in db.py).
+"""
+
+import os
+from queue import Empty, LifoQueue
+import sqlite3
+import threading
+from time import perf_counter
+from urllib.request import pathname2url
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+def connect_read_only(path, timeout):
+    "Open a connection to the database file that can't be used to write"
+    uri = "file:{}?mode=ro".format(pathname2url(os.path.abspath(path)))
+    conn = sqlite3.connect(uri, uri=True, timeout=timeout,
+                           check_same_thread=False)
+    conn.isolation_level = None
+    conn.execute("PRAGMA query_only = 1")
+    return conn
+
+
+class ReadConnectionPool:
+
+    """At most 'size' connections, created as needed by calling
+    'connect'. Getting a connection waits up to 'timeout' seconds for
+    one to be released if they are all in use."""
+
+    def __init__(self, connect, size, timeout):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        # the most recently used connection is likely the warmest
+        self._idle = LifoQueue()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.pid = os.getpid()
+
+    def acquire(self):
+        """Returns a connection, and the time spent waiting for it.
+        Raises PoolExhausted if none became available in time."""
+        start = perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except Empty:
+            with self._lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self.created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except Empty:
+                    raise PoolExhausted()
+        with self._lock:
+            self.in_use += 1
+        return conn, perf_counter() - start
+
+    def release(self, conn):
+        with self._lock:
+            self.in_use -= 1
+        self._idle.put(conn)
+
+    def close(self):
+        "Close the idle connections"
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                break
+            conn.close()
+            with self._lock:
+                self.created -= 1
@@ -0,0 +1,273 @@
+"""
+Garbage collection of attachment files.
+
+Files can end up in the UPLOAD_FOLDER without anything using them, e.g.
+when an old style attachment was deleted, a staged file was left by a
+crash, or an upload was abandoned. collect_garbage() finds them and
+moves them to a "quarantine" folder, from where they are deleted
+after a while (or can be put back, if it turns out to be a mistake):
+
+    <UPLOAD_FOLDER>/quarantine/<YYYYmmdd-HHMMSS>/<original path>
+
+It also makes sure the reference counts of the blobs (see storage.py)
+match the attachments, puts back blob files that were staged but never
+put in storage (if elogy stopped right after the commit), reports
+blobs whose files are still missing, gives
+up on uploads that nobody has sent data to for a while, and counts
+the storage used by each logbook again (see db.StorageUsage).
+Normally those are kept right as things change, since blob references
+are only added or removed in the same transaction as the attachments.
+
+The folder is gone through one directory at a time, and the files
+are looked up in the database in batches, so this works for any
+number of files. Files changed in the last 'grace' seconds are left
+alone, since they may belong to a request that is not finished.
+
+Run it from the command line, e.g. every night:
+
+$ FLASK_APP=backend.app ELOGY_CONFIG_FILE=../config.py flask collect-garbage
+"""
+
+from datetime import datetime, timedelta
+import logging
+import os
+import shutil
+from time import time
+
+from .db import db, Attachment, Blob, Upload, set_storage_usage
+from .storage import (BLOB_FOLDER, blob_lock, get_blob_path,
+                      get_partial_path, remove_upload, restore_blob)
+from .writequeue import run_write
+
+
+logger = logging.getLogger(__name__)
+
+QUARANTINE_FOLDER = "quarantine"
+QUARANTINE_TIME_FORMAT = "%Y%m%d-%H%M%S"
+
+# number of files to look up in the database at once
+BATCH_SIZE = 500
+
+
+def reconcile_blobs():
+    """Set the reference count of each blob to the number of attachments
+    actually using it, and remove blobs that nobody uses. Their files
+    are then found by find_orphans(). Returns the number of blobs that
+    were fixed."""
+    def reconcile():
+        count_refs = """(SELECT count(*) FROM attachment
+                         WHERE attachment.blob_id = blob.digest)"""
+        cursor = db.execute_sql(
+            "UPDATE blob SET refs = {0} WHERE refs != {0}".format(count_refs))
+        Blob.delete().where(Blob.refs <= 0).execute()
+        return cursor.rowcount
+    return run_write(reconcile)
+
+
+def _walk(upload_folder):
+    "All the files in the folder, as relative paths, except quarantine"
+    for dirpath, dirnames, filenames in os.walk(upload_folder):
+        relpath = os.path.relpath(dirpath, upload_folder)
+        if relpath == ".":
+            dirnames[:] = [d for d in dirnames if d != QUARANTINE_FOLDER]
+            relpath = ""
+        elif relpath == os.path.join(BLOB_FOLDER, "locks"):
+            continue
+        for filename in filenames:
+            yield os.path.join(relpath, filename).replace(os.sep, "/")
+
+
+def _classify(path):
+    """What an orphan check needs to look for in the database: a
+    ("blob", digest), an ("upload", id), an ("attachment", path), or
+    ("tmp", None) for a staged file, which is never in use for long."""
+    parts = path.split("/")
+    if parts[0] == BLOB_FOLDER:
+        if len(parts) == 3 and parts[1] == "tmp":
+            if parts[2].endswith(".part"):
+                return "upload", parts[2][:-len(".part")]
+            return "tmp", None
+        if len(parts) == 4:
+            return "blob", parts[3].split(".")[0]
+    if path.endswith(".thumbnail"):
+        path = path[:-len(".thumbnail")]
+    return "attachment", path
+
+
+def _in_use(kind, keys):
+    "The ones of the given keys that are in use"
+    if kind == "blob":
+        query = Blob.select(Blob.digest).where(Blob.digest << keys)
+    elif kind == "upload":
+        query = Upload.select(Upload.id).where(Upload.id << keys)
+    elif kind == "attachment":
+        query = (Attachment.select(Attachment.path)
+                 .where(Attachment.path << keys))
+    else:
+        return set()
+    return set(row[0] for row in query.tuples())
+
+
+def _check_batch(batch):
+    by_kind = {}
+    for path, kind, key in batch:
+        by_kind.setdefault(kind, set()).add(key)
+    in_use = {kind: _in_use(kind, list(keys))
+              for kind, keys in by_kind.items()}
+    for path, kind, key in batch:
+        if key not in in_use[kind]:
+            yield path, kind, key
+
+
+def find_orphans(upload_folder, grace=86400):
+    """Go through the upload folder, yielding (path, kind, key) for
+    each file not used by anything, see _classify()."""
+    before = time() - grace
+    batch = []
+    for path in _walk(upload_folder):
+        try:
+            stat = os.stat(os.path.join(upload_folder, path))
+        except FileNotFoundError:
+            continue  # removed meanwhile
+        if stat.st_mtime > before:
+            continue
+        kind, key = _classify(path)
+        if kind == "attachment" and stat.st_nlink > 1:
+            # left as a link to a blob by scripts/migrate_attachments.py,
+            # since old entries may still link to it
+            continue
+        batch.append((path, kind, key))
+        if len(batch) >= BATCH_SIZE:
+            yield from _check_batch(batch)
+            batch = []
+    yield from _check_batch(batch)
+
+
+def restore_staged(upload_folder):
+    """Put staged files in storage, whose blobs are in the database but
+    have no file. They are left where they are, in case they still
+    belong to a request; find_orphans() takes care of them later.
+    Returns the number of blobs restored."""
+    tmp_dir = os.path.join(upload_folder, BLOB_FOLDER, "tmp")
+    try:
+        names = os.listdir(tmp_dir)
+    except FileNotFoundError:
+        return 0
+    restored = 0
+    for name in names:
+        # named by digest, see storage.get_staged_path()
+        digest = name.split(".")[0]
+        if len(digest) != 64:
+            continue  # e.g. an unfinished upload
+        if restore_blob(upload_folder, os.path.join(tmp_dir, name), digest):
+            logger.warning("Restored the file of blob %s", digest)
+            restored += 1
+    return restored
+
+
+def find_missing(upload_folder, grace=86400):
+    "Yield the digests of blobs whose files are not there"
+    before = datetime.utcnow() - timedelta(seconds=grace)
+    query = (Blob.select(Blob.digest)
+             .where(Blob.created_at < before)
+             .tuples())
+    for digest, in query.iterator():
+        path = os.path.join(upload_folder, get_blob_path(digest))
+        if not os.path.exists(path):
+            yield digest
+
+
+def expire_uploads(upload_folder, days):
+    """Remove uploads started more than 'days' days ago, that have not
+    received any data since either. Returns the number removed."""
+    before = datetime.utcnow() - timedelta(days=days)
+    expired = 0
+    query = (Upload.select(Upload.id)
+             .where(Upload.created_at < before)
+             .tuples())
+    for upload_id, in list(query):
+        try:
+            mtime = datetime.utcfromtimestamp(os.path.getmtime(
+                get_partial_path(upload_folder, upload_id)))
+        except FileNotFoundError:
+            mtime = None
+        if mtime is not None and mtime >= before:
+            continue  # still going
+        deleted = run_write(lambda: Upload.delete().where(
+            Upload.id == upload_id).execute())
+        if deleted:
+            remove_upload(upload_folder, upload_id)
+            expired += 1
+    return expired
+
+
+def quarantine(upload_folder, path, folder):
+    "Move a file from the upload folder into the quarantine folder"
+    destination = os.path.join(upload_folder, QUARANTINE_FOLDER, folder, path)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    os.replace(os.path.join(upload_folder, path), destination)
+
+
+def purge_quarantine(upload_folder, days):
+    """Delete files that have been in quarantine for more than the given
+    number of days. Returns the number of folders deleted."""
+    quarantine_folder = os.path.join(upload_folder, QUARANTINE_FOLDER)
+    before = datetime.utcnow() - timedelta(days=days)
+    purged = 0
+    try:
+        folders = os.listdir(quarantine_folder)
+    except FileNotFoundError:
+        return 0
+    for name in folders:
+        try:
+            timestamp = datetime.strptime(name, QUARANTINE_TIME_FORMAT)
+        except ValueError:
+            continue  # not ours
+        if timestamp < before:
+            shutil.rmtree(os.path.join(quarantine_folder, name))
+            purged += 1
+    return purged
+
+
+def collect_garbage(upload_folder, grace=86400, purge_days=None,
+                    upload_expiry_days=None, dry_run=False):
+    """Reconcile the blobs, quarantine orphaned files and count the
+    storage used again. With 'dry_run', only report what would be done.
+    Returns a dict of statistics."""
+    stats = {"blobs_fixed": 0, "restored": 0, "orphans": 0,
+             "orphan_bytes": 0, "missing": 0, "purged": 0,
+             "expired_uploads": 0}
+    if not dry_run:
+        stats["blobs_fixed"] = reconcile_blobs()
+        stats["restored"] = restore_staged(upload_folder)
+        if upload_expiry_days is not None:
+            stats["expired_uploads"] = expire_uploads(upload_folder,
+                                                      upload_expiry_days)
+    folder = datetime.utcnow().strftime(QUARANTINE_TIME_FORMAT)
+    for path, kind, key in find_orphans(upload_folder, grace):
+        full_path = os.path.join(upload_folder, path)
+        try:
+            size = os.path.getsize(full_path)
+        except FileNotFoundError:
+            continue
+        if dry_run:
+            logger.info("Orphan: %s", path)
+        elif kind == "blob":
+            # someone might be adding the blob again
+            with blob_lock(upload_folder, key):
+                if Blob.select().where(Blob.digest == key).exists():
+                    continue
+                quarantine(upload_folder, path, folder)
+        else:
+            quarantine(upload_folder, path, folder)
+        stats["orphans"] += 1
+        stats["orphan_bytes"] += size
+    for digest in find_missing(upload_folder, grace):
+        logger.warning("Missing file for blob %s", digest)
+        stats["missing"] += 1
+    if not dry_run:
+        run_write(set_storage_usage)
+        if purge_days is not None:
+            stats["purged"] = purge_quarantine(upload_folder, purge_days)
+    logger.info("Garbage collection: %r", stats)
+    return stats
@@ -0,0 +1,207 @@
+"""
+Resized versions ("renditions") of image attachments, so that the
+frontend does not need to download full size originals to show
+e.g. a gallery of images.
+
+Renditions are made on demand, in a few fixed widths, and stored in a
+separate cache folder. The cache has a size limit; when it's exceeded
+the least recently used files are removed. A given rendition is only
+generated once, even if several requests for it arrive at the same
+time in different worker processes.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from time import time
+
+from flask import abort, current_app, safe_join, send_from_directory
+
+from .attachments import IMMUTABLE_MAX_AGE
+from .images import get_executor, make_rendition
+from .storage import get_disk_path
+
+
+RENDITION_WIDTHS = [100, 400, 1200]
+
+# format name given in the request -> (PIL format, mimetype)
+RENDITION_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+# How often (at most) to check the total size of the cache, in seconds
+EVICTION_INTERVAL = 60
+
+
+class RenditionCache:
+
+    """A folder of files, with a total size limit. Files are organized
+    by the hash of their key. Any process using the same folder will share
+    the cache.
+
+    Since atime is often not updated by the filesystem, we keep track of
+    the last use of a file by touching its mtime instead."""
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self._size = None  # our estimate of the total size
+        self._last_scan = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(folder, "locks"), exist_ok=True)
+
+    @contextmanager
+    def _file_lock(self, name, blocking=True):
+        """Lock that works between threads as well as processes. We use
+        a fixed set of lock files, to avoid having to clean them up."""
+        with open(os.path.join(self.folder, "locks", name), "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking
+                                                else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, key, extension, create):
+        """Return the full path to the cached file for the given key.
+        If it does not exist, create(path) is called to make it. If that
+        returns False, so will this."""
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        path = os.path.join(self.folder, digest[:2],
+                            "{}.{}".format(digest, extension))
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+        with self._file_lock(digest[:2]):
+            # someone else may have made it while we were waiting
+            if os.path.exists(path):
+                return path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            try:
+                if not create(tmp_path):
+                    return False
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        self._added(os.path.getsize(path))
+        return path
+
+    def _added(self, size):
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            check = (self._size is None or self._size > self.max_size or
+                     time() - self._last_scan > EVICTION_INTERVAL)
+        if check:
+            self.evict()
+
+    def evict(self):
+        """Go through the cache, and if it's too large remove the least
+        recently used files until it's comfortably below the limit."""
+        with self._file_lock("evict", blocking=False) as locked:
+            if not locked:
+                return  # someone else is already doing it
+            start = time()
+            files = []
+            total = 0
+            for subdir in os.scandir(self.folder):
+                if not subdir.is_dir() or subdir.name == "locks":
+                    continue
+                for entry in os.scandir(subdir.path):
+                    if entry.name.endswith(".tmp"):
+                        continue
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            n_removed = 0
+            if total > self.max_size:
+                files.sort()
+                target = 0.9 * self.max_size
+                for _, size, path in files:
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+                    n_removed += 1
+            with self._lock:
+                self._size = total
+                self._last_scan = time()
+            logging.debug("Rendition cache: %d bytes, removed %d files in %f s",
+                          total, n_removed, time() - start)
+
+
+_caches = {}
+
+
+def get_cache():
+    folder = (current_app.config.get("RENDITION_FOLDER") or
+              os.path.join(tempfile.gettempdir(), "elogy-renditions"))
+    if folder not in _caches:
+        max_size = current_app.config.get("RENDITION_CACHE_SIZE", 1024**3)
+        _caches[folder] = RenditionCache(folder, max_size)
+    return _caches[folder]
+
+
+def get_width_bucket(width):
+    "Round up to the nearest available width"
+    widths = sorted(current_app.config.get("RENDITION_WIDTHS",
+                                           RENDITION_WIDTHS))
+    for bucket in widths:
+        if bucket >= width:
+            return bucket
+    return widths[-1]
+
+
+def send_rendition(path, width, format="jpeg"):
+    """Respond with a version of the given attachment, resized to (at most)
+    the given width. Returns None if the attachment is not an image."""
+    if not width or width <= 0:
+        abort(400)
+    if format not in RENDITION_FORMATS:
+        abort(400)
+    pil_format, mimetype = RENDITION_FORMATS[format]
+    width = get_width_bucket(width)
+    upload_folder = current_app.config["UPLOAD_FOLDER"]
+    original = safe_join(upload_folder, get_disk_path(path))
+    if not os.path.isfile(original):
+        abort(404)
+    max_pixels = current_app.config.get("MAX_IMAGE_PIXELS")
+    workers = current_app.config.get("THUMBNAIL_WORKERS", 0)
+
+    def create(rendition_path):
+        args = (original, rendition_path, width, pil_format, max_pixels)
+        if workers:
+            # we still have to wait for it, but this way the decoded
+            # image does not take up memory in the web worker
+            return get_executor(workers).submit(make_rendition, *args).result()
+        return make_rendition(*args)
+
+    cache = get_cache()
+    rendition = cache.get("{}:{}:{}".format(path, width, format), format,
+                          create)
+    if not rendition:
+        return None
+    response = send_from_directory(cache.folder,
+                                   os.path.relpath(rendition, cache.folder),
+                                   mimetype=mimetype)
+    if get_disk_path(path) != path:
+        # content addressed, so this rendition will never change
+        response.headers["Cache-Control"] = (
+            "public, max-age={}, immutable".format(IMMUTABLE_MAX_AGE))
+    return response
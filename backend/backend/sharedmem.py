@@ -0,0 +1,243 @@
+"""
+Numbers shared between processes, using memory mapped files.
+
+Under uWSGI there may be several worker processes, and we want e.g.
+metrics to cover all of them. Each process writes to its own file (so
+no locking is needed between processes) and anyone who wants the total
+reads all the files in the folder. (A SharedCounter, which is read
+much more often than it is written, is instead kept in one file.)
+
+A file contains a used size header, followed by a sequence of entries:
+
+    <key length: int32> <key: utf-8, padded to 8 bytes> <value: float64>
+
+New entries are written before the header is updated, and values are
+aligned 8 byte writes, so readers never see half an entry.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+
+
+HEADER = struct.Struct("i4x")
+KEY_LENGTH = struct.Struct("i")
+VALUE = struct.Struct("d")
+
+INITIAL_SIZE = 64 * 1024
+
+
+def _padded(length):
+    "Room needed for a key of the given length, keeping values aligned"
+    return length + (8 - (KEY_LENGTH.size + length) % 8) % 8
+
+
+def read_entries(data):
+    "Yield (key, value, position of value) for each entry in the data"
+    used = HEADER.unpack_from(data, 0)[0] or HEADER.size
+    pos = HEADER.size
+    while pos < used:
+        length = KEY_LENGTH.unpack_from(data, pos)[0]
+        key_start = pos + KEY_LENGTH.size
+        key = bytes(data[key_start:key_start + length]).decode("utf-8")
+        value_pos = key_start + _padded(length)
+        yield key, VALUE.unpack_from(data, value_pos)[0], value_pos
+        pos = value_pos + VALUE.size
+
+
+class SharedValues:
+
+    """A dict of float values backed by a file. Only one process may
+    write to a given file, but any process can read it. Thread safe.
+    With 'reset', any values already in the file are thrown away."""
+
+    def __init__(self, path, reset=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a+b")
+        if reset:
+            self._file.truncate(0)
+        size = os.fstat(self._file.fileno()).st_size
+        if size < INITIAL_SIZE:
+            self._file.truncate(INITIAL_SIZE)
+            size = INITIAL_SIZE
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._positions = {}
+        self._used = HEADER.size
+        for key, _, pos in read_entries(self._map):
+            self._positions[key] = pos
+            self._used = pos + VALUE.size
+
+    def _add_key(self, key):
+        encoded = key.encode("utf-8")
+        needed = KEY_LENGTH.size + _padded(len(encoded)) + VALUE.size
+        while self._used + needed > len(self._map):
+            new_size = 2 * len(self._map)
+            self._file.truncate(new_size)
+            self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), new_size)
+        KEY_LENGTH.pack_into(self._map, self._used, len(encoded))
+        start = self._used + KEY_LENGTH.size
+        self._map[start:start + len(encoded)] = encoded
+        pos = start + _padded(len(encoded))
+        VALUE.pack_into(self._map, pos, 0.0)
+        self._used = pos + VALUE.size
+        HEADER.pack_into(self._map, 0, self._used)
+        self._positions[key] = pos
+        return pos
+
+    def _position(self, key):
+        pos = self._positions.get(key)
+        if pos is None:
+            pos = self._add_key(key)
+        return pos
+
+    def get(self, key):
+        with self._lock:
+            pos = self._positions.get(key)
+            return 0.0 if pos is None else VALUE.unpack_from(self._map, pos)[0]
+
+    def set(self, key, value):
+        with self._lock:
+            VALUE.pack_into(self._map, self._position(key), value)
+
+    def add(self, key, amount=1):
+        with self._lock:
+            pos = self._position(key)
+            value = VALUE.unpack_from(self._map, pos)[0] + amount
+            VALUE.pack_into(self._map, pos, value)
+            return value
+
+    def items(self):
+        with self._lock:
+            return [(key, value) for key, value, _ in read_entries(self._map)]
+
+
+def read_file(path):
+    "Read all values from a file, which may belong to another process"
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        return []
+    return [(key, value) for key, value, _ in read_entries(data)]
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # exists, but belongs to someone else
+    return True
+
+
+class ProcessValues:
+
+    """Per-process SharedValues files in a folder, named by process id.
+    Takes care of opening a new file after a fork. The files of processes
+    that are gone are removed (see files()), after calling 'retire' with
+    the path, e.g. to keep what they counted."""
+
+    def __init__(self, folder, prefix, retire=None):
+        self.folder = folder
+        self.prefix = prefix
+        self.retire = retire
+        self._pid = None
+        self._values = None
+        self._lock = threading.Lock()
+
+    @property
+    def values(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    os.makedirs(self.folder, exist_ok=True)
+                    path = os.path.join(
+                        self.folder, "{}-{}.db".format(self.prefix, pid))
+                    # left by an earlier process with the same pid
+                    self._remove(path)
+                    self._values = SharedValues(path, reset=True)
+                    self._pid = pid
+        return self._values
+
+    def _remove(self, path):
+        # locked, so that the file is only retired once
+        lock_path = os.path.join(self.folder, self.prefix + ".lock")
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not os.path.exists(path):
+                return
+            if self.retire is not None:
+                self.retire(path)
+            os.remove(path)
+
+    def files(self):
+        """Yield (pid, path) of each process file in the folder, removing
+        the files of processes that are gone"""
+        try:
+            names = os.listdir(self.folder)
+        except FileNotFoundError:
+            return
+        for name in names:
+            prefix, _, rest = name.partition("-")
+            if prefix == self.prefix and rest.endswith(".db"):
+                try:
+                    pid = int(rest[:-3])
+                except ValueError:
+                    continue
+                path = os.path.join(self.folder, name)
+                if pid != os.getpid() and not pid_alive(pid):
+                    self._remove(path)
+                    continue
+                yield pid, path
+
+
+class SharedCounter:
+
+    """A number that any process can increase, and all processes can
+    read, e.g. to find out that something has changed. It is kept in a
+    single memory mapped file, so reading it is just reading 8 bytes.
+    Increases are done holding an flock on the file."""
+
+    COUNT = struct.Struct("q")
+
+    def __init__(self, path):
+        self.path = path
+        self._pid = None
+        self._file = None
+        self._map = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # reopened after a fork, since the flock would be shared
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    f = open(self.path, "a+b")
+                    if os.fstat(f.fileno()).st_size < self.COUNT.size:
+                        # keeps the contents, if someone else got here first
+                        f.truncate(self.COUNT.size)
+                    self._file = f
+                    self._map = mmap.mmap(f.fileno(), self.COUNT.size)
+                    self._pid = pid
+        return self._map
+
+    def increase(self):
+        data = self._open()
+        with self._lock:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                value = self.COUNT.unpack_from(data, 0)[0] + 1
+                self.COUNT.pack_into(data, 0, value)
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+        return value
+
+    def total(self):
+        return self.COUNT.unpack_from(self._open(), 0)[0]
@@ -0,0 +1,325 @@
+"""
+Content addressed storage of attachment files.
+
+Each file is stored once, as a "blob" named by the SHA-256 hash of its
+contents, in a fan-out of directories based on the hash:
+
+    <UPLOAD_FOLDER>/blobs/ab/cd/abcd1234...
+
+That way the same screenshot pasted into ten entries only takes up
+space once, and no directory gets too many files. Blobs are reference
+counted in the database (see db.Blob) so that they can be removed when
+the last attachment using them is deleted. Any files left over that
+nothing uses are cleaned up by reconcile.py.
+
+Attachments still need a file name (for the mimetype and for the user)
+so their paths look like "blobs/ab/cd/abcd1234.../image.png", where the
+last part is not really on disk. Use get_disk_path() to find the file.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import os
+import tempfile
+import uuid
+
+from .db import Blob
+
+
+BLOB_FOLDER = "blobs"
+
+# SHA-256 state of uploads in progress, see write_chunk()
+_upload_hashes = {}
+
+CHUNK_SIZE = 64 * 1024
+
+
+def get_blob_path(digest):
+    "Where a blob is stored, relative to the upload folder"
+    return "/".join([BLOB_FOLDER, digest[:2], digest[2:4], digest])
+
+
+def get_attachment_path(digest, filename):
+    return "/".join([get_blob_path(digest), filename])
+
+
+def get_disk_path(path):
+    """Translate an attachment path into the path of the actual file,
+    relative to the upload folder. Thumbnails are stored next to their
+    blobs. Old style paths (not content addressed) are returned as is."""
+    parts = path.split("/")
+    if parts[0] == BLOB_FOLDER and len(parts) == 5:
+        blob_path = "/".join(parts[:4])
+        if parts[4].endswith(".thumbnail"):
+            return blob_path + ".thumbnail"
+        return blob_path
+    return path
+
+
+def hash_file(file_, output=None):
+    """Compute the SHA-256 digest and size of the contents of a file-like
+    object, in one pass. If an output file is given, the data is also
+    written to it."""
+    sha = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: file_.read(CHUNK_SIZE), b""):
+        sha.update(chunk)
+        size += len(chunk)
+        if output:
+            output.write(chunk)
+    return sha.hexdigest(), size
+
+
+@contextmanager
+def blob_lock(upload_folder, digest):
+    """Prevent a blob from being removed at the same time as someone
+    else is adding a reference to it. Works between processes."""
+    lock_dir = os.path.join(upload_folder, BLOB_FOLDER, "locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, digest[:2]), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _link_blob(source, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.link(source, path)
+    except FileExistsError:
+        pass  # we already have this one
+
+
+def reference_blob(digest, size):
+    "Add a reference to a blob in the database, creating it if needed"
+    updated = (Blob.update(refs=Blob.refs + 1)
+               .where(Blob.digest == digest)
+               .execute())
+    if not updated:
+        Blob.create(digest=digest, size=size, refs=1)
+
+
+def add_blob(upload_folder, source, digest, size):
+    """Put the file at the source path into storage by hardlinking it,
+    unless there already is a blob with the same digest. In any case
+    the blob gets a new reference."""
+    path = os.path.join(upload_folder, get_blob_path(digest))
+    with blob_lock(upload_folder, digest):
+        _link_blob(source, path)
+        reference_blob(digest, size)
+
+
+class StagedBlob:
+
+    "A file written to the staging area, but not yet put in storage"
+
+    def __init__(self, path, digest, size):
+        self.path = path
+        self.digest = digest
+        self.size = size
+
+
+def get_staged_path(upload_folder, digest, key):
+    """Where a file is staged, until it's put in storage. The name starts
+    with the digest, since if elogy stops between the commit and
+    commit_blob(), the blob is in the database but its file is only
+    here; then reconcile.py puts it in place."""
+    return os.path.join(upload_folder, BLOB_FOLDER, "tmp",
+                        "{}.{}".format(digest, key))
+
+
+def stage_blob(upload_folder, file_):
+    """Write the contents of a file-like object to a temporary file,
+    hashing it on the way. Nothing is changed in the database, so this
+    can be done before the write transaction. In the transaction, call
+    reference_blob() for the staged blob, and after commit,
+    commit_blob() (or discard_blob() if it failed)."""
+    tmp_dir = os.path.join(upload_folder, BLOB_FOLDER, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as f:
+        try:
+            digest, size = hash_file(file_, f)
+        except Exception:
+            os.remove(f.name)
+            raise
+    path = get_staged_path(upload_folder, digest, os.path.basename(f.name))
+    os.rename(f.name, path)
+    return StagedBlob(path, digest, size)
+
+
+def store_blob(upload_folder, file_):
+    """Store the contents of the given file-like object, returning the
+    digest. The data is hashed while it's written to a temporary file,
+    so it's only read once.
+
+    The caller gets a reference to the blob, which is expected to be
+    handed over to an attachment. Use unreference_blob() to give it up."""
+    staged = stage_blob(upload_folder, file_)
+    try:
+        add_blob(upload_folder, staged.path, staged.digest, staged.size)
+    finally:
+        os.remove(staged.path)
+    return staged.digest
+
+
+def commit_blob(upload_folder, staged):
+    """Move a staged blob into storage. Its reference is already
+    committed, so if someone else had the blob it can't have been
+    removed meanwhile; and if it was removed before our reference,
+    the file is put back here."""
+    path = os.path.join(upload_folder, get_blob_path(staged.digest))
+    with blob_lock(upload_folder, staged.digest):
+        _link_blob(staged.path, path)
+    os.remove(staged.path)
+
+
+def restore_blob(upload_folder, source, digest):
+    """Put a staged file in storage, if the blob is in the database but
+    its file is missing. Returns whether it was."""
+    path = os.path.join(upload_folder, get_blob_path(digest))
+    with blob_lock(upload_folder, digest):
+        if (os.path.exists(path) or
+                not Blob.select().where(Blob.digest == digest).exists()):
+            return False
+        try:
+            _link_blob(source, path)
+        except FileNotFoundError:
+            return False  # put in storage meanwhile
+    return True
+
+
+def discard_blob(staged):
+    try:
+        os.remove(staged.path)
+    except FileNotFoundError:
+        pass
+
+
+def unreference_blob(digest):
+    """Drop a reference to a blob in the database, deleting it if it's
+    no longer in use. Call in the write transaction, and then
+    remove_blob() after commit."""
+    (Blob.update(refs=Blob.refs - 1)
+     .where(Blob.digest == digest)
+     .execute())
+    (Blob.delete()
+     .where((Blob.digest == digest) & (Blob.refs <= 0))
+     .execute())
+
+
+def remove_blob(upload_folder, digest):
+    """Remove the file of a blob, unless it's in the database. If
+    someone adds the blob again meanwhile, either their reference is
+    committed first and the file is kept, or they put the file back
+    (see add_blob() and commit_blob()). Returns whether it was removed."""
+    path = os.path.join(upload_folder, get_blob_path(digest))
+    with blob_lock(upload_folder, digest):
+        if Blob.select().where(Blob.digest == digest).exists():
+            return False
+        for filename in (path, path + ".thumbnail"):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+    return True
+
+
+class UploadOffsetMismatch(Exception):
+    "Data for a partial upload that does not start where it should"
+    def __init__(self, offset):
+        super().__init__(offset)
+        self.offset = offset
+
+
+def get_partial_path(upload_folder, upload_id):
+    """Where the data of an unfinished upload is kept. Since it's on the
+    same filesystem as the blobs, it never needs to be copied."""
+    return os.path.join(upload_folder, BLOB_FOLDER, "tmp",
+                        "{}.part".format(upload_id))
+
+
+def start_upload(upload_folder, upload_id):
+    "Create an empty file for the upload"
+    path = get_partial_path(upload_folder, upload_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "xb").close()
+    _upload_hashes[upload_id] = (0, hashlib.sha256())
+
+
+def _hash_file_part(path, size):
+    "SHA-256 of the first 'size' bytes of the file"
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        remaining = size
+        while remaining:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            sha.update(chunk)
+            remaining -= len(chunk)
+    return sha
+
+
+def write_chunk(upload_folder, upload_id, offset, stream, max_size):
+    """Append the data from the stream to a partial upload, which must
+    currently contain exactly offset bytes. The data is hashed as it's
+    written, if possible. Returns the new size of the upload."""
+    path = get_partial_path(upload_folder, upload_id)
+    with open(path, "r+b") as f:
+        # in case someone is sending the same chunk in parallel
+        fcntl.flock(f, fcntl.LOCK_EX)
+        current = os.fstat(f.fileno()).st_size
+        if current != offset:
+            raise UploadOffsetMismatch(current)
+        # Hash objects can't be shared between processes, so if an
+        # earlier chunk went to another process, we give up hashing as
+        # we go; finish_upload() then reads the file once instead.
+        state = _upload_hashes.pop(upload_id, None)
+        sha = state[1] if state and state[0] == offset else None
+        f.seek(current)
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+            if current + len(chunk) > max_size:
+                # whatever was written is still fine, but the hash
+                # is not to be trusted any more
+                raise ValueError("More data than the size of the upload")
+            f.write(chunk)
+            if sha is not None:
+                sha.update(chunk)
+            current += len(chunk)
+        if sha is not None:
+            _upload_hashes[upload_id] = (current, sha)
+    return current
+
+
+def finish_upload(upload_folder, upload_id, size):
+    """Check that a completed upload has all its data, and stage it to
+    be put in storage, like stage_blob(). The staged file is a link to
+    the data, so if the write fails the upload can still be finished
+    again. Once the blob is in storage, call remove_upload()."""
+    path = get_partial_path(upload_folder, upload_id)
+    with open(path, "rb") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        current = os.fstat(f.fileno()).st_size
+        if current != size:
+            raise UploadOffsetMismatch(current)
+        state = _upload_hashes.pop(upload_id, None)
+        if state and state[0] == size:
+            digest = state[1].hexdigest()
+        else:
+            digest = _hash_file_part(path, size).hexdigest()
+    # not shared, in case the upload is finished twice at the same time
+    staged_path = get_staged_path(upload_folder, digest, uuid.uuid4().hex)
+    os.link(path, staged_path)
+    return StagedBlob(staged_path, digest, size)
+
+
+def remove_upload(upload_folder, upload_id):
+    "Throw away an unfinished upload"
+    _upload_hashes.pop(upload_id, None)
+    try:
+        os.remove(get_partial_path(upload_folder, upload_id))
+    except FileNotFoundError:
+        pass
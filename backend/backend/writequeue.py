@@ -0,0 +1,126 @@
+"""
+Optional "group commit" of small writes.
+
+Normally each request that changes something commits its own
+transaction, which means waiting for the disk every time. With
+COMMIT_MODE = "group", writes handed to run_write() are instead queued
+up for a single writer thread, that runs everything arriving within
+GROUP_COMMIT_WINDOW seconds in one transaction. Each write gets its
+own savepoint, so if it fails only its changes are rolled back, and
+the exception is raised in the caller. Callers only get their result
+once the whole transaction is committed, so a successful response
+still means the change is on disk.
+
+The writes run in another thread, so they must not use the request
+(e.g. request.remote_addr); pass in what is needed as arguments.
+
+With COMMIT_MODE = "strict" (the default) run_write() just runs the
+write in a transaction of its own, right away.
+"""
+
+from concurrent.futures import Future
+import logging
+import os
+from queue import Empty, Queue
+import threading
+from time import perf_counter
+
+from .db import db
+
+
+logger = logging.getLogger(__name__)
+
+# set up from the config, see setup_write_queue()
+_queue = None
+
+
+class WriteQueue:
+
+    def __init__(self, database, window=0.002, max_batch=100):
+        self.database = database
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self):
+        # started lazily, since threads don't survive a fork (uWSGI)
+        with self._lock:
+            if (self._thread is None or not self._thread.is_alive() or
+                    self._thread.pid != os.getpid()):
+                self._thread = threading.Thread(target=self._run,
+                                                name="elogy-writer",
+                                                daemon=True)
+                self._thread.pid = os.getpid()
+                self._thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        "Queue up a write. Returns a Future with the result."
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((future, function, args, kwargs))
+        return future
+
+    def _get_batch(self):
+        batch = [self._queue.get()]
+        deadline = perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def run_batch(self, batch):
+        "Run the writes in one transaction and resolve their futures"
+        results = []
+        try:
+            with self.database.atomic():
+                for future, function, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with self.database.atomic():
+                            result = function(*args, **kwargs)
+                    except Exception as e:
+                        future.set_exception(e)
+                    else:
+                        results.append((future, result))
+        except Exception as e:
+            # the commit failed, so none of it happened
+            logger.exception("Failed to commit %d writes", len(batch))
+            for future, _ in results:
+                future.set_exception(e)
+            return
+        for future, result in results:
+            future.set_result(result)
+
+    def _run(self):
+        while True:
+            batch = self._get_batch()
+            start = perf_counter()
+            self.run_batch(batch)
+            logger.debug("Committed %d writes in %.3f s",
+                         len(batch), perf_counter() - start)
+
+
+def run_write(function, *args, **kwargs):
+    """Run a function that writes to the database, as one transaction
+    (or part of one, in group commit mode). Returns the result."""
+    if _queue is None:
+        with db.atomic():
+            return function(*args, **kwargs)
+    return _queue.submit(function, *args, **kwargs).result()
+
+
+def setup_write_queue(app):
+    global _queue
+    if app.config.get("COMMIT_MODE", "strict") == "group":
+        _queue = WriteQueue(db, app.config.get("GROUP_COMMIT_WINDOW", 0.002))
+    else:
+        _queue = None
@@ -0,0 +1,6 @@
+"""
+Benchmarks for various parts of elogy. Run them from the "backend"
+directory, e.g.
+
+$ python -m benchmark.content
+"""
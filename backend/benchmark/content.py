@@ -0,0 +1,88 @@
+"""
+Time the processing of entry content (see backend/content.py) for
+large documents, like long logs or spreadsheets pasted into an entry.
+
+For comparison, the old way of handling content is also timed; the
+HTML was parsed once when saving (to extract images and clean it) and
+then again each time a preview or the plain text was needed.
+
+$ python -m benchmark.content --paragraphs 2000 --rows 2000
+"""
+
+import argparse
+from collections import defaultdict
+import random
+from time import perf_counter
+
+from lxml import html
+
+from backend.content import html_clean, process_content, STAGES
+from backend.db import strip_tags
+
+
+WORDS = ("beam current vacuum pressure magnet injection orbit shutter "
+         "interlock temperature valve undulator gap kicker septum "
+         "linac klystron cavity feedback dipole quadrupole").split()
+
+
+def sentence(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+
+def make_document(paragraphs, rows, seed=0):
+    "Something like what you get when pasting from an office program"
+    rng = random.Random(seed)
+    parts = ["<html><body>"]
+    for i in range(paragraphs):
+        parts.append('<p style="margin: 0">{} <a href="/logbooks/1/entries/{}/">'
+                     'see here</a> <b>{}</b></p>'
+                     .format(sentence(rng, 20), i, sentence(rng, 3)))
+    parts.append('<table border="1">')
+    for i in range(rows):
+        parts.append("<tr>{}</tr>".format(
+            "".join("<td>{:.3f}</td>".format(rng.random()) for _ in range(8))))
+    parts.append("</table>")
+    parts.append("<script>alert('hello');</script></body></html>")
+    return "".join(parts)
+
+
+def old_pipeline(content):
+    "Roughly what used to happen to content, from saving to listing"
+    doc = html.document_fromstring(content)
+    html_clean(doc)
+    html.tostring(doc)
+    # the entry list preview
+    html.document_fromstring(content).text_content()[:200]
+    # the old Entry.stripped_content
+    strip_tags(content)
+
+
+def run(content, repeat):
+    times = defaultdict(list)
+    for _ in range(repeat):
+        start = perf_counter()
+        old_pipeline(content)
+        times["old (total)"].append(perf_counter() - start)
+        start = perf_counter()
+        result = process_content(content, stages=STAGES[1:])  # no images
+        times["new (total)"].append(perf_counter() - start)
+        for name, t in result.timings.items():
+            times["new: " + name].append(t)
+    return times
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark processing of large entry contents.')
+    parser.add_argument("-p", "--paragraphs", type=int, default=1000)
+    parser.add_argument("-r", "--rows", type=int, default=1000,
+                        help="Number of rows in a table")
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    content = make_document(args.paragraphs, args.rows)
+    print("Document size: {} bytes".format(len(content)))
+    for name, values in run(content, args.repeat).items():
+        print("{:24} min {:8.4f} s   mean {:8.4f} s".format(
+            name, min(values), sum(values) / len(values)))
@@ -0,0 +1,278 @@
+"""
+Generate a large synthetic elogy database, e.g. for benchmarking or
+for reproducing problems that only show up with lots of data.
+
+Rows are written directly to the database file in large batched
+inserts, one transaction per batch, instead of going through the API.
+That makes it possible to create a million entries in a few minutes. Content comes
+from the same providers as the tests (test/providers.py), but a pool
+of it is made up front and then reused, since generating text is the
+slow part. The same seed gives the same dataset.
+
+The dataset has a tree of logbooks with attributes, entries with
+followup threads, revision history, and attachments backed by small
+dummy files in the upload folder (several attachments share each file,
+like in real life).
+
+$ python -m benchmark.generate /tmp/big.db --entries 1000000
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import io
+import logging
+import os
+import random
+import sys
+from time import perf_counter
+
+from lxml import html
+
+
+ATTRIBUTES = [
+    {"name": "Type", "type": "option", "required": False,
+     "options": ["Fault", "Info", "Shift summary", "Maintenance"]},
+    {"name": "Value", "type": "number", "required": False},
+]
+
+SHIFTS = ["morning", "afternoon", "night"]
+
+# Number of distinct titles, contents etc to generate
+POOL_SIZE = 1000
+
+# Number of distinct attachment files
+N_FILES = 200
+
+START_TIME = datetime(2015, 1, 1)
+
+def make_pools(seed):
+    "Pregenerate content to pick from"
+    from faker import Faker
+    from backend.content import make_preview
+    from test.providers import ElogyProvider
+
+    Faker.seed(seed)
+    fake = Faker()
+    fake.add_provider(ElogyProvider)
+    contents = [fake.html_content() for _ in range(POOL_SIZE)]
+    return {
+        "titles": [fake.title() for _ in range(POOL_SIZE)],
+        "authors": [fake.authors() for _ in range(POOL_SIZE)],
+        "contents": [
+            (content,
+             make_preview(html.document_fromstring(content).text_content()))
+            for content in contents],
+        "filenames": [fake.file_name() for _ in range(N_FILES)],
+    }
+
+
+def insert_rows(model, rows):
+    """Insert rows, given as dicts of field -> value. This does the same
+    thing as model.insert_many(), but building the SQL for each batch
+    turns out to take most of the time, so we just do it once."""
+    if not rows:
+        return
+    fields = list(rows[0])
+    database = model._meta.database
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        model._meta.db_table,
+        ", ".join('"{}"'.format(field.db_column) for field in fields),
+        ", ".join([database.interpolation] * len(fields)))
+    database.get_cursor().executemany(
+        sql, ([field.db_value(row[field]) for field in fields]
+              for row in rows))
+
+
+def make_logbooks(rng, n_logbooks, depth):
+    "Logbooks arranged in a tree at most depth levels deep"
+    from backend.db import Logbook
+    logbooks = []
+    levels = {}
+    for i in range(n_logbooks):
+        # mostly attach to a random logbook that is not too deep already
+        candidates = [lb for lb in logbooks if levels[lb] < depth]
+        if candidates and rng.random() < 0.8:
+            parent = rng.choice(candidates)
+        else:
+            parent = None
+        logbook = Logbook.create(name="Logbook {}".format(i),
+                                 description="Generated dataset",
+                                 attributes=ATTRIBUTES, parent=parent,
+                                 created_at=START_TIME)
+        levels[logbook.id] = levels[parent] + 1 if parent else 1
+        logbooks.append(logbook.id)
+    return logbooks
+
+
+def make_files(rng, upload_folder, filenames):
+    """Write a set of small dummy files into storage, returning
+    (digest, size, filename) for each."""
+    from backend.storage import get_blob_path, hash_file
+    files = []
+    for filename in filenames:
+        data = bytes(rng.getrandbits(8) for _ in range(rng.randint(100, 5000)))
+        digest, size = hash_file(io.BytesIO(data))
+        path = os.path.join(upload_folder, get_blob_path(digest))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        files.append((digest, size, filename))
+    return files
+
+
+def generate(upload_folder, n_logbooks=20, depth=3, n_entries=10000,
+             thread_length=10, revisions=0.2, attachments=0.1, seed=0,
+             batch_size=10000):
+    """Add generated data to the (already set up) database. Roughly
+    the given fraction of entries get revisions or an attachment."""
+    from backend.db import (db, Attachment, Blob, Entry, EntryChange,
+                            set_sort_ts, set_storage_usage)
+    from backend.storage import get_attachment_path
+
+    rng = random.Random(seed)
+    pools = make_pools(seed)
+    start = perf_counter()
+
+    with db.atomic():
+        logbooks = make_logbooks(rng, n_logbooks, depth)
+    files = make_files(rng, upload_folder, pools["filenames"])
+    blob_refs = dict.fromkeys((digest for digest, _, _ in files), 0)
+
+    first_id = (Entry.select().order_by(Entry.id.desc()).first() or
+                Entry(id=0)).id + 1
+    threads = []  # recent (root id, logbook id, n_followups)
+    n_created = 0
+    counts = {"entries": 0, "changes": 0, "attachments": 0}
+    while n_created < n_entries:
+        entries, changes, attachment_rows = [], [], []
+        for _ in range(min(batch_size, n_entries - n_created)):
+            entry_id = first_id + n_created
+            created_at = START_TIME + timedelta(minutes=5 * n_created)
+            if threads and rng.random() < 0.4:
+                i = rng.randrange(len(threads))
+                root_id, logbook_id, length = threads[i]
+                follows_id = root_id
+                threads[i] = (root_id, logbook_id, length + 1)
+                if length + 1 >= thread_length:
+                    threads.pop(i)
+            else:
+                follows_id = None
+                logbook_id = rng.choice(logbooks)
+                threads.append((entry_id, logbook_id, 0))
+                if len(threads) > 50:
+                    threads.pop(0)
+            content, preview = rng.choice(pools["contents"])
+            entry = {
+                Entry.id: entry_id,
+                Entry.logbook: logbook_id,
+                Entry.follows: follows_id,
+                Entry.thread_id: follows_id or entry_id,
+                Entry.title: None if follows_id else rng.choice(pools["titles"]),
+                Entry.authors: rng.choice(pools["authors"]),
+                Entry.content: content,
+                Entry.content_preview: preview,
+                Entry.content_type: "text/html; charset=UTF-8",
+                Entry.attributes: {
+                    "Type": rng.choice(ATTRIBUTES[0]["options"]),
+                    "Value": round(rng.random() * 100, 2)},
+                Entry.metadata: {"shift": rng.choice(SHIFTS)},
+                Entry.priority: 0,
+                Entry.archived: False,
+                Entry.created_at: created_at,
+                Entry.last_changed_at: None,
+                Entry.revision: 0,
+            }
+            if rng.random() < revisions:
+                n_changes = rng.randint(1, 10)
+                for i in range(n_changes):
+                    old_content, _ = rng.choice(pools["contents"])
+                    changes.append({
+                        EntryChange.entry: entry_id,
+                        EntryChange.changed: {
+                            "title": rng.choice(pools["titles"]),
+                            "content": old_content},
+                        EntryChange.timestamp: created_at + timedelta(
+                            seconds=i + 1),
+                        EntryChange.change_authors: rng.choice(
+                            pools["authors"]),
+                    })
+                entry[Entry.last_changed_at] = created_at + timedelta(
+                    seconds=n_changes)
+                entry[Entry.revision] = n_changes
+            if rng.random() < attachments:
+                digest, size, filename = rng.choice(files)
+                blob_refs[digest] += 1
+                attachment_rows.append({
+                    Attachment.entry: entry_id,
+                    Attachment.filename: filename,
+                    Attachment.path: get_attachment_path(digest, filename),
+                    Attachment.blob: digest,
+                    Attachment.timestamp: created_at,
+                    Attachment.content_type: "application/octet-stream",
+                    Attachment.embedded: False,
+                    Attachment.archived: False,
+                })
+            entries.append(entry)
+            n_created += 1
+        with db.atomic():
+            insert_rows(Entry, entries)
+            insert_rows(EntryChange, changes)
+            insert_rows(Attachment, attachment_rows)
+        counts["entries"] += len(entries)
+        counts["changes"] += len(changes)
+        counts["attachments"] += len(attachment_rows)
+        elapsed = perf_counter() - start
+        logging.info("%d entries, %d changes, %d attachments; %.0f rows/s",
+                     counts["entries"], counts["changes"],
+                     counts["attachments"], sum(counts.values()) / elapsed)
+
+    with db.atomic():
+        for digest, size, _ in files:
+            if not blob_refs[digest]:
+                continue
+            updated = (Blob.update(refs=Blob.refs + blob_refs[digest])
+                       .where(Blob.digest == digest).execute())
+            if not updated:
+                Blob.create(digest=digest, size=size, refs=blob_refs[digest])
+    # the threads' latest activity, for sorting
+    set_sort_ts()
+    set_storage_usage()
+    return counts
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Generate a large synthetic elogy database.')
+    parser.add_argument("database", metavar="DB", type=str,
+                        help="Database file (created if needed)")
+    parser.add_argument("--upload-folder", type=str,
+                        help="Where to put attachment files "
+                        "(default: 'attachments' next to the database)")
+    parser.add_argument("--logbooks", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=3,
+                        help="Max depth of the logbook tree")
+    parser.add_argument("--entries", type=int, default=10000)
+    parser.add_argument("--thread-length", type=int, default=10,
+                        help="Max number of followups to an entry")
+    parser.add_argument("--revisions", type=float, default=0.2,
+                        help="Fraction of entries that have been edited")
+    parser.add_argument("--attachments", type=float, default=0.1,
+                        help="Fraction of entries with an attachment")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=10000,
+                        help="Number of entries per transaction")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    from backend.db import db, setup_database
+
+    setup_database(args.database, close=False)
+    # it's just generated data, so don't wait for the disk
+    db.execute_sql("PRAGMA synchronous = OFF")
+    upload_folder = args.upload_folder or os.path.join(
+        os.path.dirname(os.path.abspath(args.database)), "attachments")
+    generate(upload_folder, args.logbooks, args.depth, args.entries,
+             args.thread_length, args.revisions, args.attachments,
+             args.seed, args.batch_size)
@@ -0,0 +1,344 @@
+"""
+Put concurrent load on elogy, with a mix of reading and writing, to
+find problems that only show up under concurrency (like the database
+being locked).
+
+Runs against the app in this process (with a generated dataset, or a
+copy of an existing database), with one thread per client:
+
+$ python -m benchmark.loadtest --clients 20 --duration 30
+
+or against a running server, e.g. uWSGI started locally:
+
+$ python -m benchmark.loadtest --url http://localhost:8000 --clients 50
+
+The mix of operations is given as weights, e.g.
+"--mix list=30,search=20,get=30,post=5,put=5,lock=5,upload=5".
+At the end, throughput, latency percentiles and error rates are shown
+for each operation, along with the number of SQL statements that failed
+because the database was busy (from /metrics). Expected conflicts
+(409, e.g. a lock held by another client) are counted separately from
+errors. Everything runs locally.
+"""
+
+import argparse
+from collections import defaultdict
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from .generate import ATTRIBUTES, generate
+from .suite import make_app, percentile
+
+
+DEFAULT_MIX = "list=30,search=20,get=30,post=5,put=5,lock=5,upload=5"
+
+
+class Response:
+
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+    def json(self):
+        return json.loads(self.data.decode("utf-8"))
+
+
+class TestClient:
+
+    "Requests to the app in this process"
+
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def request(self, method, path, data=None, headers=None,
+                content_type=None):
+        response = self._client.open(path, method=method, data=data,
+                                     headers=headers or {},
+                                     content_type=content_type)
+        return Response(response.status_code, response.get_data())
+
+
+class HTTPClient:
+
+    "Requests to a running server"
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def request(self, method, path, data=None, headers=None,
+                content_type=None):
+        headers = dict(headers or {})
+        if content_type:
+            headers["Content-Type"] = content_type
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        request = Request(self.url + path, data=data, headers=headers,
+                          method=method)
+        try:
+            with urlopen(request, timeout=60) as response:
+                return Response(response.status, response.read())
+        except HTTPError as e:
+            return Response(e.code, e.read())
+
+
+def post_json(client, path, data, method="POST"):
+    return client.request(method, path, data=json.dumps(data),
+                          content_type="application/json")
+
+
+# === Operations ===
+# Each takes a client and a random generator and returns the response
+# that decides how the operation went.
+
+def op_list(client, rng, ids):
+    return client.request("GET", "/api/logbooks/{}/entries/".format(
+        rng.choice(ids["logbooks"])))
+
+
+def op_search(client, rng, ids):
+    query = rng.choice([
+        "content=" + rng.choice(ids["words"]),
+        "title=" + rng.choice(ids["words"]),
+        "attribute=Type:" + rng.choice(ATTRIBUTES[0]["options"]),
+    ])
+    return client.request("GET", "/api/logbooks/0/entries/?" + query)
+
+
+def op_get(client, rng, ids):
+    return client.request("GET", "/api/entries/{}/".format(
+        rng.choice(ids["entries"])))
+
+
+def op_post(client, rng, ids):
+    response = post_json(
+        client, "/api/logbooks/{}/entries/".format(rng.choice(ids["logbooks"])),
+        {"title": "Load test {}".format(rng.random()),
+         "authors": [{"name": "Load Test"}],
+         "content": "<p>Written under load</p>" * rng.randint(1, 50)})
+    if response.status == 200:
+        ids["entries"].append(response.json()["entry"]["id"])
+    return response
+
+
+def op_put(client, rng, ids):
+    entry_id = rng.choice(ids["entries"])
+    response = client.request("GET", "/api/entries/{}/".format(entry_id))
+    if response.status != 200:
+        return response
+    entry = response.json()["entry"]
+    return post_json(
+        client, "/api/logbooks/{}/entries/{}/".format(
+            entry["logbook"]["id"], entry_id),
+        {"title": "Edited under load {}".format(rng.random()),
+         "revision_n": entry["revision_n"]}, method="PUT")
+
+
+def op_lock(client, rng, ids):
+    "Take a lock on an entry, hold it for a moment and release it"
+    url = "/api/entries/{}/lock".format(rng.choice(ids["entries"]))
+    response = client.request("POST", url)
+    if response.status != 200:
+        return response
+    sleep(rng.random() * 0.1)
+    return client.request("DELETE", url + "?lock_id={}".format(
+        response.json()["lock"]["id"]))
+
+
+def op_upload(client, rng, ids):
+    data = os.urandom(rng.randint(1000, 200000))
+    response = post_json(client, "/api/uploads/", {
+        "filename": "load.bin", "size": len(data),
+        "entry_id": rng.choice(ids["entries"])})
+    if response.status != 200:
+        return response
+    url = "/api/uploads/{}".format(response.json()["upload"]["id"])
+    response = client.request(
+        "PUT", url, data=data, content_type="application/octet-stream",
+        headers={"Content-Range": "bytes 0-{}/{}".format(len(data) - 1,
+                                                         len(data))})
+    if response.status != 200:
+        return response
+    return client.request("POST", url)
+
+
+OPERATIONS = {name[len("op_"):]: function
+              for name, function in globals().items()
+              if name.startswith("op_")}
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation: {}".format(name))
+        weights[name] = float(weight)
+    return weights
+
+
+def get_ids(client):
+    "Find some logbooks and entries to work on"
+    logbooks = [lb["id"] for lb in
+                client.request("GET", "/api/logbooks/").json()
+                ["logbook"]["children"]]
+    entries = client.request("GET", "/api/logbooks/0/entries/?n=1000").json()
+    words = [word for e in entries["entries"]
+             for word in (e["title"] or "").split() if len(word) > 3]
+    return {"logbooks": logbooks,
+            "entries": [e["id"] for e in entries["entries"]],
+            "words": words or ["the"]}
+
+
+def get_busy_errors(client):
+    "Number of SQL statements that failed because the database was busy"
+    metrics = client.request("GET", "/metrics").data.decode("utf-8")
+    match = re.search(r'^elogy_sql_errors_total\{kind="busy"\} (\S+)$',
+                      metrics, re.MULTILINE)
+    return float(match.group(1)) if match else 0
+
+
+class Stats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.times = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def add(self, operation, duration, status):
+        with self._lock:
+            self.times[operation].append(duration)
+            self.statuses[operation][status] += 1
+
+    def summary(self, elapsed):
+        result = {}
+        for operation, times in sorted(self.times.items()):
+            statuses = self.statuses[operation]
+            n = len(times)
+            errors = sum(count for status, count in statuses.items()
+                         if status == "exception" or status >= 500)
+            ms = [t * 1000 for t in times]
+            result[operation] = {
+                "n": n,
+                "throughput": n / elapsed,
+                "p50": percentile(ms, 50),
+                "p90": percentile(ms, 90),
+                "p99": percentile(ms, 99),
+                "max": max(ms),
+                "error_rate": errors / n,
+                "conflicts": statuses.get(409, 0),
+                "statuses": {str(k): v for k, v in statuses.items()},
+            }
+        return result
+
+
+def client_loop(client, weights, ids, stats, stop, seed):
+    rng = random.Random(seed)
+    names = list(weights)
+    cumulative = [weights[name] for name in names]
+    while not stop.is_set():
+        name = rng.choices(names, weights=cumulative)[0]
+        start = perf_counter()
+        try:
+            status = OPERATIONS[name](client, rng, ids).status
+        except (URLError, OSError) as e:
+            logging.debug("%s failed: %s", name, e)
+            status = "exception"
+        stats.add(name, perf_counter() - start, status)
+
+
+def run(make_client, n_clients, duration, weights, seed=0):
+    ids = get_ids(make_client())
+    busy_before = get_busy_errors(make_client())
+    stats = Stats()
+    stop = threading.Event()
+    threads = [threading.Thread(target=client_loop,
+                                args=(make_client(), weights, ids, stats,
+                                      stop, seed + i))
+               for i in range(n_clients)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    operations = stats.summary(elapsed)
+    total = sum(op["n"] for op in operations.values())
+    return {
+        "clients": n_clients,
+        "elapsed": elapsed,
+        "throughput": total / elapsed,
+        "busy_errors": get_busy_errors(make_client()) - busy_before,
+        "operations": operations,
+    }
+
+
+def print_report(result):
+    print("{clients} clients, {elapsed:.1f} s, {throughput:.1f} requests/s, "
+          "{busy_errors:.0f} busy database errors".format(**result))
+    print("{:8} {:>7} {:>8} {:>9} {:>9} {:>9} {:>9} {:>7} {:>9}".format(
+        "", "n", "req/s", "p50 ms", "p90 ms", "p99 ms", "max ms",
+        "errors", "conflicts"))
+    for name, op in result["operations"].items():
+        print("{:8} {n:7d} {throughput:8.1f} {p50:9.1f} {p90:9.1f} {p99:9.1f} "
+              "{max:9.1f} {error_rate:7.1%} {conflicts:9d}".format(name, **op))
+
+
+def main(args):
+    weights = parse_mix(args.mix)
+    if args.url:
+        result = run(lambda: HTTPClient(args.url), args.clients,
+                     args.duration, weights, args.seed)
+    else:
+        workdir = tempfile.mkdtemp(prefix="elogy-loadtest-")
+        try:
+            database = os.path.join(workdir, "elogy.db")
+            if args.database:
+                shutil.copy(args.database, database)
+            app = make_app(workdir, database)
+            if not args.database:
+                generate(os.path.join(workdir, "attachments"),
+                         n_entries=args.entries, seed=args.seed)
+            result = run(lambda: TestClient(app), args.clients,
+                         args.duration, weights, args.seed)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Concurrent load test of elogy.')
+    parser.add_argument("--url", type=str,
+                        help="Test a running server instead of the app "
+                        "in this process, e.g. http://localhost:8000")
+    parser.add_argument("--database", type=str,
+                        help="Use (a copy of) an existing database")
+    parser.add_argument("--entries", type=int, default=5000,
+                        help="Size of the generated dataset")
+    parser.add_argument("-c", "--clients", type=int, default=10)
+    parser.add_argument("-d", "--duration", type=float, default=10,
+                        help="Seconds to run")
+    parser.add_argument("--mix", type=str, default=DEFAULT_MIX,
+                        help="Weights of the operations")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=str,
+                        help="Write results to this JSON file")
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    main(parser.parse_args())
@@ -0,0 +1,427 @@
+"""
+Time the most used parts of the API on a realistic dataset.
+
+A dataset is generated from a seed (see generate.py): a tree of
+logbooks, entries with followup threads, attributes, revisions and
+attachments. Alternatively a copy of an existing database can be used. Each benchmark is then run a
+number of times through the Flask test client, and statistics (in
+milliseconds) are written as JSON, e.g.
+
+$ python -m benchmark.suite --entries 100000 --output before.json
+$ python -m benchmark.suite --entries 100000 --compare before.json
+
+The second run reports any benchmark whose median got slower than the
+given tolerance, and exits with an error status if there are any.
+
+"startup" is the time it takes a new process to load the app, like
+a uWSGI worker, and also reports the time of its first request and
+its peak memory use (RSS).
+"""
+
+import argparse
+from datetime import datetime
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+from .generate import ATTRIBUTES, SHIFTS, generate
+
+
+CONFIG = """
+TITLE = "elogy benchmark"
+SECRET = "benchmark"
+DEBUG = False
+DATABASE = {{"name": {database!r}}}
+UPLOAD_FOLDER = {upload_folder!r}
+RENDITION_FOLDER = {rendition_folder!r}
+METRICS_FOLDER = {metrics_folder!r}
+THUMBNAIL_WORKERS = 0
+SLOW_QUERY_THRESHOLD = None
+READ_POOL_SIZE = 4
+ACTIONS = {{}}
+"""
+
+
+def make_app(workdir, database):
+    "Set up an elogy app working on the given database"
+    config = os.path.join(workdir, "config.py")
+    with open(config, "w") as f:
+        f.write(CONFIG.format(
+            database=database,
+            upload_folder=os.path.join(workdir, "attachments"),
+            rendition_folder=os.path.join(workdir, "renditions"),
+            metrics_folder=os.path.join(workdir, "metrics")))
+    os.environ["ELOGY_CONFIG_FILE"] = config
+    from backend.app import app
+    return app
+
+
+class Context:
+
+    "Things the benchmarks need to pick from"
+
+    def __init__(self, client, seed=0):
+        from backend.db import Entry, Logbook
+        self.client = client
+        self.random = random.Random(seed)
+        self.logbook_ids = [lb.id for lb in Logbook.select(Logbook.id)]
+        self.root_logbook_ids = [lb.id for lb in Logbook.select(Logbook.id)
+                                 .where(Logbook.parent >> None)]
+        self.entry_ids = [e.id for e in Entry.select(Entry.id)]
+        sample = (Entry.select(Entry.title, Entry.authors)
+                  .where(~(Entry.title >> None))
+                  .order_by(Entry.id.desc())
+                  .limit(100))
+        self.title_words = [word for e in sample
+                            for word in e.title.split() if len(word) > 3]
+        self.author_names = [a["name"].split()[-1] for e in sample
+                             for a in e.authors]
+
+    def entry_id(self):
+        return self.random.choice(self.entry_ids)
+
+    def logbook_id(self):
+        return self.random.choice(self.logbook_ids)
+
+    def root_logbook_id(self):
+        return self.random.choice(self.root_logbook_ids)
+
+
+# === Benchmarks ===
+# Each takes a Context and a timer, and should only time the interesting
+# part, by running it inside the timer context.
+
+def bench_logbook_tree(ctx, timer):
+    with timer:
+        return ctx.client.get("/api/logbooks/")
+
+
+def bench_logbook_get(ctx, timer):
+    with timer:
+        return ctx.client.get("/api/logbooks/{}/".format(ctx.logbook_id()))
+
+
+def _list(ctx, timer, query="", logbook_id=None):
+    if logbook_id is None:
+        logbook_id = ctx.root_logbook_id()
+    with timer:
+        return ctx.client.get("/api/logbooks/{}/entries/?{}"
+                              .format(logbook_id, query))
+
+
+def bench_entries_list(ctx, timer):
+    return _list(ctx, timer)
+
+
+def bench_entries_list_ignore_children(ctx, timer):
+    return _list(ctx, timer, "ignore_children=1")
+
+
+def bench_entries_list_all(ctx, timer):
+    return _list(ctx, timer, logbook_id=0)
+
+
+def bench_entries_list_offset(ctx, timer):
+    return _list(ctx, timer, "offset=1000", logbook_id=0)
+
+
+def bench_search_title(ctx, timer):
+    return _list(ctx, timer, "title=" + ctx.random.choice(ctx.title_words),
+                 logbook_id=0)
+
+
+def bench_search_content(ctx, timer):
+    return _list(ctx, timer, "content=" + ctx.random.choice(ctx.title_words),
+                 logbook_id=0)
+
+
+def bench_search_authors(ctx, timer):
+    return _list(ctx, timer, "authors=" + ctx.random.choice(ctx.author_names),
+                 logbook_id=0)
+
+
+def bench_search_attachments(ctx, timer):
+    return _list(ctx, timer, "attachments=.", logbook_id=0)
+
+
+def bench_search_attribute(ctx, timer):
+    option = ctx.random.choice(ATTRIBUTES[0]["options"])
+    return _list(ctx, timer, "attribute=Type:" + option, logbook_id=0)
+
+
+def bench_search_metadata(ctx, timer):
+    return _list(ctx, timer, "metadata=shift:" + ctx.random.choice(SHIFTS),
+                 logbook_id=0)
+
+
+def bench_entry_get(ctx, timer):
+    with timer:
+        return ctx.client.get("/api/entries/{}/".format(ctx.entry_id()))
+
+
+def bench_entry_get_thread(ctx, timer):
+    with timer:
+        return ctx.client.get("/api/entries/{}/?thread=1"
+                              .format(ctx.entry_id()))
+
+
+def bench_entry_revisions(ctx, timer):
+    from backend.db import Entry
+    entry = Entry.get(Entry.id == ctx.entry_id())
+    with timer:
+        return ctx.client.get("/api/logbooks/{}/entries/{}/revisions/"
+                              .format(entry.logbook_id, entry.id))
+
+
+def bench_entry_revision(ctx, timer):
+    from backend.db import Entry
+    entry = Entry.get(Entry.id == ctx.entry_id())
+    with timer:
+        return ctx.client.get("/api/logbooks/{}/entries/{}/revisions/0"
+                              .format(entry.logbook_id, entry.id))
+
+
+def bench_entry_post(ctx, timer):
+    data = json.dumps({"title": "Benchmark entry",
+                       "authors": [{"name": "Bench Mark"}],
+                       "content": "<p>Some <b>content</b></p>" * 20,
+                       "attributes": {"Type": "Info"}})
+    with timer:
+        return ctx.client.post("/api/logbooks/{}/entries/"
+                               .format(ctx.logbook_id()), data=data,
+                               content_type="application/json")
+
+
+def bench_entry_post_images(ctx, timer):
+    "An entry with ten pasted (inline) images"
+    from base64 import b64encode
+    from io import BytesIO
+    from PIL import Image
+    images = []
+    for i in range(10):
+        data = BytesIO()
+        color = tuple(ctx.random.randrange(256) for _ in range(3))
+        Image.new("RGB", (64, 64), color).save(data, "PNG")
+        images.append('<p><img src="data:image/png;base64,{}"></p>'.format(
+            b64encode(data.getvalue()).decode("ascii")))
+    data = json.dumps({"title": "Benchmark entry with images",
+                       "authors": [{"name": "Bench Mark"}],
+                       "content": "".join(images),
+                       "attributes": {"Type": "Info"}})
+    with timer:
+        return ctx.client.post("/api/logbooks/{}/entries/"
+                               .format(ctx.logbook_id()), data=data,
+                               content_type="application/json")
+
+
+def bench_entry_put(ctx, timer):
+    from backend.db import Entry
+    entry = Entry.get(Entry.id == ctx.entry_id())
+    data = json.dumps({"title": "Edited {}".format(ctx.random.random()),
+                       "revision_n": entry.revision_n})
+    with timer:
+        return ctx.client.put("/api/logbooks/{}/entries/{}/"
+                              .format(entry.logbook_id, entry.id),
+                              data=data, content_type="application/json")
+
+
+BENCHMARKS = [(name[len("bench_"):], function)
+              for name, function in sorted(globals().items())
+              if name.startswith("bench_")]
+
+
+class Timer:
+
+    def __init__(self):
+        self.times = []
+
+    def __enter__(self):
+        self._start = perf_counter()
+
+    def __exit__(self, *args):
+        self.times.append(perf_counter() - self._start)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def statistics(times):
+    ms = [t * 1000 for t in times]
+    return {
+        "n": len(ms),
+        "min": min(ms),
+        "median": percentile(ms, 50),
+        "mean": sum(ms) / len(ms),
+        "p95": percentile(ms, 95),
+        "max": max(ms),
+    }
+
+
+def run_benchmarks(ctx, names=None, repeat=20):
+    results = {}
+    for name, function in BENCHMARKS:
+        if names and name not in names:
+            continue
+        timer = Timer()
+        errors = 0
+        for _ in range(repeat):
+            response = function(ctx, timer)
+            if response.status_code != 200:
+                errors += 1
+        results[name] = dict(statistics(timer.times), errors=errors)
+        logging.info("%-28s median %8.2f ms", name, results[name]["median"])
+    return results
+
+
+# Run in a fresh process, like a new worker
+STARTUP_SCRIPT = """
+import json, resource
+from time import perf_counter
+start = perf_counter()
+from backend.app import app
+loaded = perf_counter()
+with app.test_client() as client:
+    client.get("/api/logbooks/")
+print(json.dumps({"import": loaded - start,
+                  "first_request": perf_counter() - loaded,
+                  "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+"""
+
+
+def measure_startup(repeat=5):
+    """Time loading the app (and handling a first request) in a new
+    process, on the already set up database. Also reports the peak
+    memory use of the process."""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        runs.append(json.loads(output.decode().splitlines()[-1]))
+    result = statistics([run["import"] for run in runs])
+    result["first_request_median"] = percentile(
+        [run["first_request"] * 1000 for run in runs], 50)
+    # ru_maxrss is in kilobytes on Linux
+    result["max_rss_mb"] = max(run["max_rss"] for run in runs) / 1024
+    result["errors"] = 0
+    logging.info("%-28s median %8.2f ms, %.1f MB", "startup",
+                 result["median"], result["max_rss_mb"])
+    return result
+
+
+def compare(results, baseline, tolerance):
+    "Return the benchmarks that got slower than the baseline"
+    regressions = {}
+    for name, stats in results.items():
+        old = baseline["results"].get(name)
+        if old and stats["median"] > old["median"] * (1 + tolerance):
+            regressions[name] = stats["median"] / old["median"]
+    return regressions
+
+
+def describe_dataset():
+    from backend.db import Attachment, Entry, EntryChange, Logbook
+    return {
+        "logbooks": Logbook.select().count(),
+        "entries": Entry.select().count(),
+        "followups": Entry.select().where(~(Entry.follows >> None)).count(),
+        "revisions": EntryChange.select().count(),
+        "attachments": Attachment.select().count(),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(__file__)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix="elogy-benchmark-")
+    try:
+        database = os.path.join(workdir, "elogy.db")
+        if args.database:
+            # the benchmarks write, so work on a copy
+            shutil.copy(args.database, database)
+        app = make_app(workdir, database)
+        if not args.database:
+            generate(os.path.join(workdir, "attachments"), args.logbooks,
+                     args.depth, args.entries, args.thread_length,
+                     args.revisions, args.attachments, args.seed)
+        with app.test_client() as client:
+            ctx = Context(client, args.seed)
+            results = run_benchmarks(ctx, args.benchmark, args.repeat)
+            if not args.benchmark or "startup" in args.benchmark:
+                results["startup"] = measure_startup()
+            output = {
+                "created_at": datetime.utcnow().isoformat(),
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "arguments": vars(args),
+                "dataset": describe_dataset(),
+                "results": results,
+            }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, ratio in sorted(regressions.items()):
+            logging.warning("Regression: %s is %.2f times slower", name, ratio)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark elogy on a generated dataset.')
+    parser.add_argument("--database", type=str,
+                        help="Use (a copy of) an existing database instead")
+    parser.add_argument("--logbooks", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=3,
+                        help="Max depth of the logbook tree")
+    parser.add_argument("--entries", type=int, default=5000)
+    parser.add_argument("--thread-length", type=int, default=10,
+                        help="Max number of followups to an entry")
+    parser.add_argument("--revisions", type=float, default=0.2,
+                        help="Fraction of entries that have been edited")
+    parser.add_argument("--attachments", type=float, default=0.1,
+                        help="Fraction of entries with an attachment")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-n", "--repeat", type=int, default=20,
+                        help="Number of times to run each benchmark")
+    parser.add_argument("-b", "--benchmark", action="append",
+                        help="Only run the given benchmark(s)")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Write results to this JSON file")
+    parser.add_argument("--compare", type=str,
+                        help="Compare with results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown before reporting regressions")
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    main(parser.parse_args())
@@ -17,6 +17,102 @@ SECRET = os.getenv('ELOGY_SECRET', 'MW3sr3ctkmRvagBE')
 # The folder where all uploaded files will be stored.
 UPLOAD_FOLDER = os.getenv('ELOGY_UPLOAD_FOLDER', '/tmp/elogy')  # !!!Again, /tmp is a bad choice!!!
 
+# Thumbnails of uploaded images are created by this many background
+# processes. If set to 0, they are created immediately in the request
+# instead (slow for large images).
+THUMBNAIL_WORKERS = int(os.getenv('ELOGY_THUMBNAIL_WORKERS', 2))
+
+# Images with more pixels than this are not decoded at all, to limit
+# the memory used when making thumbnails.
+MAX_IMAGE_PIXELS = int(os.getenv('ELOGY_MAX_IMAGE_PIXELS', 200000000))
+
+# Resized versions of images, requested like /attachments/...?width=400,
+# are cached in this folder. When it grows larger than the given size
+# (in bytes) the least recently used ones are removed.
+RENDITION_FOLDER = os.getenv('ELOGY_RENDITION_FOLDER', '/tmp/elogy-renditions')
+RENDITION_CACHE_SIZE = int(os.getenv('ELOGY_RENDITION_CACHE_SIZE', 1024**3))
+RENDITION_WIDTHS = [100, 400, 1200]
+
+# Let the web server in front of elogy send attachment files, instead of
+# streaming them through python. Can be "x-accel-redirect" (nginx, see
+# balancer/nginx.conf), "x-sendfile" (e.g. apache with mod_xsendfile) or
+# "" to send files directly. For nginx, the prefix should be an "internal"
+# location that serves the UPLOAD_FOLDER.
+ATTACHMENT_OFFLOAD = os.getenv('ELOGY_ATTACHMENT_OFFLOAD', '')
+ATTACHMENT_OFFLOAD_PREFIX = os.getenv('ELOGY_ATTACHMENT_OFFLOAD_PREFIX',
+                                      '/protected-attachments/')
+
+# Metrics are served at /metrics, in Prometheus format. To cover all
+# worker processes they are kept in files in this folder, which should
+# be local (not e.g. NFS) and ideally emptied when elogy is started.
+METRICS_FOLDER = os.getenv('ELOGY_METRICS_FOLDER', '/tmp/elogy-metrics')
+
+# SQL statements taking longer than this (in seconds) are logged along
+# with their query plan. Set to None (or the environment variable to an
+# empty string) to turn off.
+_slow_query_threshold = os.getenv('ELOGY_SLOW_QUERY_THRESHOLD', '0.2')
+SLOW_QUERY_THRESHOLD = (float(_slow_query_threshold)
+                        if _slow_query_threshold else None)
+
+# Number of read only database connections per process, used by GET
+# requests so that reading never holds up writing. 0 means all requests
+# use the same connections as writes.
+READ_POOL_SIZE = int(os.getenv('ELOGY_READ_POOL_SIZE', 4))
+
+# How long (in seconds) to wait for the database when another process
+# or thread is writing, before giving up.
+BUSY_TIMEOUT = float(os.getenv('ELOGY_BUSY_TIMEOUT', 5))
+
+# How changes to entries and locks are committed. "strict" commits each
+# request on its own. "group" lets a single writer thread commit all
+# the changes arriving within GROUP_COMMIT_WINDOW seconds together,
+# which means fewer waits for the disk when there are lots of small
+# writes, at the cost of a little latency. See writequeue.py.
+COMMIT_MODE = os.getenv('ELOGY_COMMIT_MODE', 'strict')
+GROUP_COMMIT_WINDOW = float(os.getenv('ELOGY_GROUP_COMMIT_WINDOW', 0.002))
+
+# Edit locks on entries expire after LOCK_LEASE seconds, unless the
+# client renews them by a "heartbeat". Expired or cancelled locks are
+# deleted after LOCK_RETENTION seconds, checked at most every
+# LOCK_SWEEP_INTERVAL seconds. See locks.py.
+LOCK_LEASE = int(os.getenv('ELOGY_LOCK_LEASE', 3600))
+LOCK_RETENTION = int(os.getenv('ELOGY_LOCK_RETENTION', 86400))
+LOCK_SWEEP_INTERVAL = int(os.getenv('ELOGY_LOCK_SWEEP_INTERVAL', 600))
+
+# Attachment files that nothing uses are moved to a "quarantine" folder
+# by "flask collect-garbage" (see reconcile.py), and deleted from there
+# after QUARANTINE_DAYS days.
+QUARANTINE_DAYS = int(os.getenv('ELOGY_QUARANTINE_DAYS', 30))
+
+# Resumable uploads (see api/uploads.py) that have not received any data
+# in UPLOAD_EXPIRY_DAYS days are removed by "flask collect-garbage".
+UPLOAD_EXPIRY_DAYS = int(os.getenv('ELOGY_UPLOAD_EXPIRY_DAYS', 7))
+
+# Threads with no activity in ARCHIVE_AFTER_DAYS days, and threads in
+# archived logbooks, are moved to yearly databases in the ARCHIVE_FOLDER
+# by "flask archive-entries" (see archive.py). They can still be looked
+# up by id, and searched with "?archive=1". SQLite only; leave the
+# folder empty to not use archives.
+ARCHIVE_FOLDER = os.getenv('ELOGY_ARCHIVE_FOLDER', '')
+ARCHIVE_AFTER_DAYS = int(os.getenv('ELOGY_ARCHIVE_AFTER_DAYS', 3 * 365))
+
+# SQLite maintenance (see maintenance.py): planner statistics, giving
+# free space back and emptying the WAL, daily at MAINTENANCE_TIME (local
+# time, "HH:MM"), plus a passive WAL checkpoint every CHECKPOINT_INTERVAL
+# seconds. Done in the background by one of the elogy processes if
+# MAINTENANCE_IN_PROCESS is set, otherwise run "flask maintenance" e.g.
+# from cron. WAL_AUTOCHECKPOINT (pages) is how big the WAL may get before
+# a committing request checkpoints it; None leaves the SQLite default.
+MAINTENANCE_IN_PROCESS = bool(os.getenv('ELOGY_MAINTENANCE_IN_PROCESS', ''))
+MAINTENANCE_TIME = os.getenv('ELOGY_MAINTENANCE_TIME', '03:30')
+CHECKPOINT_INTERVAL = int(os.getenv('ELOGY_CHECKPOINT_INTERVAL', 300))
+VACUUM_STEP = int(os.getenv('ELOGY_VACUUM_STEP', 1000))
+WAL_AUTOCHECKPOINT = None
+
+# Allow getting a trace of the SQL statements run by a request, by
+# adding "?sql_trace=1" or the header "X-Elogy-SQL-Trace: 1".
+SQL_TRACE = DEBUG
+
 # Optional LDAP config. Used to autocomplete author names.
 # Requires the "pyldap" package. If not set, elogy will try
 # to fall back to looking up users through the local system.
@@ -92,8 +188,10 @@ ACTIONS = {
 # Don't change anything below this line unless you know what you're doing!
 # ------------------------------------------------------------------------
 
+# To use PostgreSQL instead of SQLite, set "engine" to "postgresql",
+# "name" to the name of the database, and add "host", "port", "user"
+# and "password" as needed. Requires the "psycopg2" package.
 DATABASE = {
-    # Note: Currently *only* works with sqlite!
     "name": DATABASE,
     "engine": "playhouse.sqlite_ext.SqliteExtDatabase",
     "threadlocals": True,
@@ -25,6 +25,9 @@ setup(
             "pytest",
             "faker",
             "splinter"
+        ],
+        "postgresql": [
+            "psycopg2"
         ]
     }
 )
@@ -16,6 +16,11 @@ with NamedTemporaryFile(delete=False) as f:
 # The folder where all uploaded files will be stored.
 UPLOAD_FOLDER = '/tmp/test_elogy'
 
+RENDITION_FOLDER = '/tmp/test_elogy_renditions'
+METRICS_FOLDER = '/tmp/test_elogy_metrics'
+SQL_TRACE = True
+READ_POOL_SIZE = 2
+
 
 # Don't change anything below this line unless you know what you're doing!
 # ------------------------------------------------------------------------
@@ -1,5 +1,8 @@
+from glob import glob
 from multiprocessing import Process
 import os
+import shutil
+import subprocess
 from tempfile import NamedTemporaryFile
 
 import pytest
@@ -30,16 +33,67 @@ def elogy(request):
     proc.terminate()
 
 
-@pytest.fixture(scope="function")
-def db(request):
+def find_initdb():
+    path = shutil.which("initdb")
+    if path:
+        return path
+    # e.g. Debian does not put it in the PATH
+    candidates = sorted(glob("/usr/lib/postgresql/*/bin/initdb"))
+    if candidates:
+        return candidates[-1]
+
+
+@pytest.fixture(scope="session")
+def postgresql_server(tmpdir_factory):
+
+    "Start a throwaway PostgreSQL server, if PostgreSQL is installed"
+
+    pytest.importorskip("psycopg2")
+    initdb = find_initdb()
+    if not initdb:
+        pytest.skip("PostgreSQL is not installed")
+    if os.geteuid() == 0:
+        pytest.skip("PostgreSQL refuses to run as root")
+    pg_ctl = os.path.join(os.path.dirname(initdb), "pg_ctl")
+    datadir = str(tmpdir_factory.mktemp("postgresql"))
+    subprocess.check_call([initdb, "-D", datadir, "-A", "trust",
+                           "-U", "elogy"], stdout=subprocess.DEVNULL)
+    # only listen on a unix socket in the data directory
+    subprocess.check_call([pg_ctl, "-D", datadir, "-w",
+                           "-l", os.path.join(datadir, "log"),
+                           "-o", "-k {} -c listen_addresses=''".format(datadir),
+                           "start"], stdout=subprocess.DEVNULL)
 
-    from elogy.db import db, setup_database
+    yield {"host": datadir, "user": "elogy"}
+
+    subprocess.call([pg_ctl, "-D", datadir, "-m", "immediate", "stop"],
+                    stdout=subprocess.DEVNULL)
+
+
+@pytest.fixture(scope="function", params=["sqlite", "postgresql"])
+def db(request):
 
-    setup_database(":memory:", close=False)
-    return db
-    # with NamedTemporaryFile() as f:
-    #     setup_database(f.name)
-    #     yield db
+    "An empty database, of each supported kind"
+
+    from elogy.db import db, sqlite_db, setup_database
+
+    if request.param == "postgresql":
+        server = request.getfixturevalue("postgresql_server")
+        import psycopg2
+        conn = psycopg2.connect(dbname="postgres", **server)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("DROP DATABASE IF EXISTS elogy_test")
+            cursor.execute("CREATE DATABASE elogy_test")
+        conn.close()
+        setup_database("elogy_test", close=False, engine="postgresql",
+                       **server)
+        yield db
+        db.close()
+        db.initialize(sqlite_db)
+    else:
+        setup_database(":memory:", close=False)
+        yield db
 
 
 @pytest.fixture(scope="module")
@@ -1,7 +1,10 @@
 from io import BytesIO
 import json
+import os
+import sqlite3
+import threading
 
-from pytest import mark
+from pytest import mark, raises
 
 from .fixtures import elogy_client
 
@@ -442,6 +445,517 @@ def test_create_attachment(elogy_client):
     assert response["entry"]["attachments"][0]["id"] == att["id"]
 
 
+def test_create_image_attachment_thumbnail(elogy_client):
+    from PIL import Image
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+
+    # upload an image that's larger than the thumbnail size
+    image_data = BytesIO()
+    Image.new("RGB", (300, 200), (255, 0, 0)).save(image_data, "PNG")
+    image_data.seek(0)
+    URL = ("/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/"
+           .format(logbook=logbook, entry=entry))
+    att = decode_response(
+        elogy_client.post(
+            URL,
+            content_type='multipart/form-data',
+            data={"attachment": [(image_data, "image.png")]}))
+
+    # the image metadata is filled in once the thumbnail is done
+    response = decode_response(elogy_client.get(
+        "/api/logbooks/{logbook[id]}/entries/{entry[id]}/"
+        .format(logbook=logbook, entry=entry)))
+    attachment = response["entry"]["attachments"][0]
+    assert attachment["id"] == att["id"]
+    assert attachment["metadata"]["size"] == {"width": 300, "height": 200}
+    assert attachment["metadata"]["thumbnail_size"] == {"width": 100,
+                                                        "height": 66}
+
+    thumbnail = elogy_client.get(attachment["thumbnail_link"])
+    assert thumbnail.status_code == 200
+    assert Image.open(BytesIO(thumbnail.get_data())).size == (100, 66)
+
+
+def test_image_thumbnail_in_worker(elogy_client, monkeypatch):
+    from PIL import Image
+    from elogy import images
+    from elogy.app import app
+    from elogy.db import Attachment
+    from elogy.images import schedule_thumbnail
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    image_data = BytesIO()
+    Image.new("RGB", (300, 200), (0, 255, 0)).save(image_data, "PNG")
+    image_data.seek(0)
+    att = decode_response(elogy_client.post(
+        "/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/"
+        .format(logbook=logbook, entry=entry),
+        content_type='multipart/form-data',
+        data={"attachment": [(image_data, "worker.png")]}))
+    attachment = Attachment.get(Attachment.id == att["id"])
+    attachment.metadata = None
+    attachment.save()
+
+    writes = []
+    run_write = images.run_write
+    monkeypatch.setattr(images, "run_write", lambda function, *args: (
+        writes.append(function), run_write(function, *args))[1])
+    workers = app.config.get("THUMBNAIL_WORKERS", 0)
+    try:
+        with app.app_context():
+            app.config["THUMBNAIL_WORKERS"] = 1
+            future = schedule_thumbnail(attachment)
+        assert future.result(timeout=30)["size"] == {"width": 300,
+                                                     "height": 200}
+        # the callback runs after the result is set; shutting down the
+        # pool waits for it
+        images._executor.shutdown(wait=True)
+    finally:
+        app.config["THUMBNAIL_WORKERS"] = workers
+        images._executor = None
+    assert writes == [images.store_image_metadata]
+    attachment = Attachment.get(Attachment.id == att["id"])
+    assert attachment.metadata["thumbnail_size"] == {"width": 100,
+                                                     "height": 66}
+
+
+def test_make_thumbnail(tmpdir, monkeypatch):
+    from PIL import Image
+    from elogy.images import make_thumbnail
+
+    big = str(tmpdir.join("big"))
+    Image.new("RGB", (300, 200), (0, 0, 255)).save(big, "PNG")
+    metadata = make_thumbnail(big)
+    assert metadata["thumbnail_size"] == {"width": 100, "height": 66}
+    # nothing left over from writing it
+    assert sorted(tmpdir.listdir()) == [tmpdir.join("big"),
+                                        tmpdir.join("big.thumbnail")]
+
+    # another worker linked the same small image meanwhile
+    small = str(tmpdir.join("small"))
+    Image.new("RGB", (10, 10), (0, 0, 255)).save(small, "PNG")
+    os.link(small, small + ".thumbnail")
+    monkeypatch.setattr(os.path, "exists", lambda path: False)
+    assert make_thumbnail(small) == {"size": {"width": 10, "height": 10}}
+
+
+def test_get_image_attachment_rendition(elogy_client):
+    from PIL import Image
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+
+    image_data = BytesIO()
+    Image.new("RGBA", (1000, 500), (0, 255, 0, 128)).save(image_data, "PNG")
+    image_data.seek(0)
+    URL = ("/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/"
+           .format(logbook=logbook, entry=entry))
+    att = decode_response(
+        elogy_client.post(
+            URL,
+            content_type='multipart/form-data',
+            data={"attachment": [(image_data, "image.png")]}))
+
+    # the width is rounded up to the closest available size
+    for i in range(2):
+        rendition = elogy_client.get(att["location"] + "?width=350")
+        assert rendition.status_code == 200
+        assert rendition.mimetype == "image/jpeg"
+        assert Image.open(BytesIO(rendition.get_data())).size == (400, 200)
+
+    rendition = elogy_client.get(att["location"] + "?width=100&format=webp")
+    assert rendition.mimetype == "image/webp"
+    assert Image.open(BytesIO(rendition.get_data())).size == (100, 50)
+
+    # images are not scaled up
+    rendition = elogy_client.get(att["location"] + "?width=5000")
+    assert Image.open(BytesIO(rendition.get_data())).size == (1000, 500)
+
+    rendition = elogy_client.get(att["location"] + "?width=400&format=gif")
+    assert rendition.status_code == 400
+
+
+def test_attachment_deduplication(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    DATA = b"some data that is uploaded twice"
+    attachments = []
+    for i in range(2):
+        in_entry, entry = make_entry(elogy_client, logbook)
+        URL = ("/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/"
+               .format(logbook=logbook, entry=entry))
+        att = decode_response(
+            elogy_client.post(
+                URL,
+                content_type='multipart/form-data',
+                data={"attachment": [(BytesIO(DATA), "file{}.txt".format(i))]}))
+        attachments.append((URL, att))
+
+    # both attachments use the same stored file
+    (url1, att1), (url2, att2) = attachments
+    assert att1["location"] != att2["location"]
+    assert (att1["location"].rsplit("/", 1)[0] ==
+            att2["location"].rsplit("/", 1)[0])
+
+    # the file stays until the last attachment using it is deleted
+    elogy_client.delete(url1 + str(att1["id"]))
+    assert elogy_client.get(att2["location"]).get_data() == DATA
+    elogy_client.delete(url2 + str(att2["id"]))
+    assert elogy_client.get(att2["location"]).status_code == 404
+
+
+def test_delete_attachment_rolled_back(elogy_client):
+    from elogy.attachments import delete_attachment
+    from elogy.db import Attachment, Blob
+    from elogy.writequeue import run_write
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    URL = ("/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/"
+           .format(logbook=logbook, entry=entry))
+    DATA = b"data for an attachment that is not deleted after all"
+    att = decode_response(elogy_client.post(
+        URL, content_type='multipart/form-data',
+        data={"attachment": [(BytesIO(DATA), "kept.txt")]}))
+    attachment = Attachment.get(Attachment.id == att["id"])
+
+    def delete_and_fail():
+        delete_attachment(attachment)
+        raise RuntimeError("failed after deleting")
+
+    # nothing is removed until the deletion is committed
+    with raises(RuntimeError):
+        run_write(delete_and_fail)
+    assert Blob.get(Blob.digest == attachment.blob_id).refs == 1
+    assert elogy_client.get(att["location"]).get_data() == DATA
+
+
+def test_storage_usage(elogy_client):
+    from elogy.db import Attachment
+    in_parent, parent = make_logbook(elogy_client)
+    in_logbook, logbook = make_logbook(elogy_client, dict(
+        name="Child", parent_id=parent["id"]))
+    in_entry, entry = make_entry(elogy_client, logbook)
+    URL = ("/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/"
+           .format(logbook=logbook, entry=entry))
+    attachments = [
+        decode_response(elogy_client.post(
+            URL, content_type='multipart/form-data',
+            data={"attachment": [(BytesIO(data), "usage.txt")]}))
+        for data in [b"12345", b"1234567890"]]
+
+    def usage(logbook):
+        return decode_response(elogy_client.get(
+            "/api/logbooks/{}/usage".format(logbook["id"])))["usage"]
+
+    assert usage(logbook)["files"] == 2
+    assert usage(logbook)["bytes"] == 15
+    # changing an attachment does not count it again
+    attachment = Attachment.get(Attachment.id == attachments[1]["id"])
+    attachment.metadata = {"checked": True}
+    attachment.save()
+    assert usage(logbook)["files"] == 2
+    assert usage(parent)["files"] == 0
+    assert usage(parent)["total_bytes"] == 15
+
+    elogy_client.delete(URL + str(attachments[0]["id"]))
+    assert usage(logbook)["bytes"] == 10
+
+    # the attachments move along with the entry
+    response = elogy_client.put(
+        "/api/logbooks/{logbook[id]}/entries/{entry[id]}/".format(
+            logbook=logbook, entry=entry),
+        data=dict(logbook_id=parent["id"], revision_n=entry["revision_n"]))
+    assert response.status_code == 200
+    assert usage(logbook)["files"] == 0
+    assert usage(parent)["files"] == 1
+    assert usage(parent)["bytes"] == 10
+
+    everything = decode_response(
+        elogy_client.get("/api/logbooks/usage"))["usage"]
+    assert {"logbook_id": parent["id"], "files": 1, "bytes": 10,
+            "total_files": None, "total_bytes": None} in everything
+
+
+def test_restore_staged(elogy_client):
+    from time import time
+    from elogy.app import app
+    from elogy.attachments import save_staged
+    from elogy.reconcile import collect_garbage
+    from elogy.storage import get_blob_path, stage_blob
+    from elogy.writequeue import run_write
+    from elogy.db import Attachment
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    upload_folder = app.config["UPLOAD_FOLDER"]
+    # not already stored by an earlier test run
+    DATA = "committed, but never put in storage, {}".format(
+        time()).encode("utf-8")
+    staged = stage_blob(upload_folder, BytesIO(DATA))
+    attachment = Attachment(path=get_blob_path(staged.digest) + "/lost.txt",
+                            blob=staged.digest, filename="lost.txt")
+    attachment.staged_blob = staged
+    # as if elogy stopped right after the commit
+    run_write(save_staged, attachment, entry["id"])
+
+    try:
+        stats = collect_garbage(upload_folder, grace=3600)
+        assert stats["restored"] == 1
+        with open(os.path.join(upload_folder,
+                               get_blob_path(staged.digest)), "rb") as f:
+            assert f.read() == DATA
+    finally:
+        os.remove(staged.path)
+
+
+def test_collect_garbage(elogy_client):
+    import os
+    from time import time
+    from elogy.app import app
+    from elogy.db import Blob, StorageUsage
+    from elogy.reconcile import collect_garbage
+    from elogy.storage import get_blob_path
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    URL = ("/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/"
+           .format(logbook=logbook, entry=entry))
+    att = decode_response(elogy_client.post(
+        URL, content_type='multipart/form-data',
+        data={"attachment": [(BytesIO(b"keep me"), "keep.txt")]}))
+    digest = att["location"].split("/")[-2]
+
+    upload_folder = app.config["UPLOAD_FOLDER"]
+    orphans = [get_blob_path("f" * 64), get_blob_path("f" * 64) + ".thumbnail",
+               "blobs/tmp/tmpstaged", "2017/old_style.png"]
+    a_day_ago = time() - 86400
+    for path in orphans + [get_blob_path(digest)]:
+        full_path = os.path.join(upload_folder, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        if not os.path.exists(full_path):
+            with open(full_path, "wb") as f:
+                f.write(b"orphan")
+        os.utime(full_path, (a_day_ago, a_day_ago))
+    Blob.update(refs=5).where(Blob.digest == digest).execute()
+    StorageUsage.delete().execute()
+
+    stats = collect_garbage(upload_folder, grace=3600, dry_run=True)
+    assert stats["orphans"] >= len(orphans)
+    assert all(os.path.exists(os.path.join(upload_folder, path))
+               for path in orphans)
+
+    stats = collect_garbage(upload_folder, grace=3600)
+    assert stats["blobs_fixed"] >= 1
+    assert Blob.get(Blob.digest == digest).refs == 1
+    for path in orphans:
+        assert not os.path.exists(os.path.join(upload_folder, path))
+    assert os.path.exists(os.path.join(upload_folder, get_blob_path(digest)))
+    assert elogy_client.get(att["location"]).get_data() == b"keep me"
+    quarantined = os.listdir(os.path.join(upload_folder, "quarantine"))
+    assert any(os.path.exists(os.path.join(upload_folder, "quarantine",
+                                           folder, "2017/old_style.png"))
+               for folder in quarantined)
+    # the usage was counted again
+    assert StorageUsage.get(StorageUsage.logbook == logbook["id"]).files == 1
+
+
+def test_archive_entries(elogy_client, tmpdir):
+    from datetime import datetime
+    from elogy.archive import archive_entries
+    from elogy.db import Entry, sqlite_db
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    entry_url = "/api/logbooks/{}/entries/{}/".format(logbook["id"],
+                                                      entry["id"])
+    followup = decode_response(post_json(
+        elogy_client, entry_url, data=dict(
+            title="Old followup", content="Followup",
+            content_type="text/plain")))["entry"]
+    response = elogy_client.put(entry_url, data=dict(
+        title="Old entry", revision_n=entry["revision_n"]))
+    assert response.status_code == 200
+    in_new, new = make_entry(elogy_client, logbook)
+    long_ago = datetime(2010, 1, 1)
+    Entry.update(created_at=long_ago, sort_ts=long_ago).where(
+        Entry.thread_id == entry["id"]).execute()
+
+    def listed(**query):
+        result = decode_response(elogy_client.get(
+            "/api/logbooks/{}/entries/".format(logbook["id"]),
+            query_string=query))
+        return [e["id"] for e in result["entries"]]
+
+    try:
+        sqlite_db.archive_folder = str(tmpdir)
+        assert archive_entries(str(tmpdir), days=365) == (1, 2)
+        assert os.path.exists(str(tmpdir.join("elogy-archive-2010.db")))
+        assert not Entry.select().where(
+            Entry.thread_id == entry["id"]).exists()
+
+        # still there when asked for
+        archived = decode_response(elogy_client.get(entry_url))["entry"]
+        assert archived["title"] == "Old entry"
+        assert archived["next"] is None
+        assert [f["id"] for f in archived["followups"]] == [followup["id"]]
+        revision = decode_response(elogy_client.get(
+            entry_url + "revisions/0"))["entry"]
+        assert revision["title"] == "Test entry"
+        changes = decode_response(elogy_client.get(
+            entry_url + "revisions/"))["entry_changes"]
+        assert len(changes) == 1
+
+        # ...but only listed when asked to
+        assert listed() == [new["id"]]
+        assert set(listed(archive=1)) == {new["id"], entry["id"]}
+
+        # and can't be changed
+        response = elogy_client.put(entry_url, data=dict(
+            title="Changed", revision_n=1))
+        assert response.status_code == 404
+        # ...or followed up
+        response = post_json(elogy_client, entry_url, data=dict(
+            title="Followup to an archived entry", content="Followup",
+            content_type="text/plain"))
+        assert response.status_code == 409
+        assert decode_response(elogy_client.get(entry_url))["entry"][
+            "title"] == "Old entry"
+        response = post_json(
+            elogy_client, "/api/logbooks/{}/entries/".format(logbook["id"]),
+            data=dict(title="Followup", content="Followup",
+                      content_type="text/plain", follows_id=entry["id"]))
+        assert response.status_code == 409
+        response = post_json(
+            elogy_client, "/api/logbooks/{}/entries/1234567/".format(
+                logbook["id"]),
+            data=dict(title="Followup", content="Followup",
+                      content_type="text/plain"))
+        assert response.status_code == 404
+    finally:
+        sqlite_db.archive_folder = None
+
+
+def test_archived_ids_not_reused(elogy_client, tmpdir):
+    from elogy.archive import archive_entries
+    from elogy.db import Entry, Logbook, sqlite_db
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    assert entry["id"] == Entry.select().order_by(Entry.id.desc()).get().id
+    Logbook.update(archived=True).where(
+        Logbook.id == logbook["id"]).execute()
+    try:
+        sqlite_db.archive_folder = str(tmpdir)
+        assert archive_entries(str(tmpdir)) == (1, 1)
+        # the newest entry was archived, but its id is not given out again
+        in_new, new = make_entry(elogy_client, logbook)
+        assert new["id"] > entry["id"]
+        archived = decode_response(elogy_client.get(
+            "/api/entries/{}/".format(entry["id"])))["entry"]
+        assert archived["title"] == entry["title"]
+        assert archive_entries(str(tmpdir)) == (1, 1)
+        ids = []
+        for path in tmpdir.listdir("elogy-archive-*.db"):
+            conn = sqlite3.connect(str(path))
+            ids.extend(row[0] for row in conn.execute("SELECT id FROM entry"))
+            conn.close()
+        assert sorted(ids) == [entry["id"], new["id"]]
+    finally:
+        sqlite_db.archive_folder = None
+
+
+def test_archive_entries_changed_meanwhile(elogy_client, tmpdir,
+                                           monkeypatch):
+    from datetime import datetime
+    from elogy import archive
+    from elogy.db import Entry
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    entry_url = "/api/logbooks/{}/entries/{}/".format(logbook["id"],
+                                                      entry["id"])
+    long_ago = datetime(2010, 1, 1)
+    Entry.update(created_at=long_ago, sort_ts=long_ago).where(
+        Entry.thread_id == entry["id"]).execute()
+
+    copy_threads = archive._copy_threads
+
+    def copy_and_change(schema, thread_ids):
+        copy_threads(schema, thread_ids)
+        response = elogy_client.put(entry_url, data=dict(
+            title="Changed while archiving", revision_n=entry["revision_n"]))
+        assert response.status_code == 200
+        # still old enough, but no longer as copied
+        Entry.update(sort_ts=long_ago).where(
+            Entry.id == entry["id"]).execute()
+
+    def copy_and_bump(schema, thread_ids):
+        copy_threads(schema, thread_ids)
+        Entry.update(sort_ts=datetime.utcnow()).where(
+            Entry.id == entry["id"]).execute()
+
+    def archived_entries():
+        conn = sqlite3.connect(str(tmpdir.join("elogy-archive-2010.db")))
+        try:
+            return conn.execute("SELECT count(*) FROM entry").fetchone()[0]
+        finally:
+            conn.close()
+
+    monkeypatch.setattr(archive, "_copy_threads", copy_and_change)
+    assert archive.archive_entries(str(tmpdir), days=365) == (0, 0)
+    # the change is kept, and the copy removed from the archive
+    assert Entry.get(Entry.id == entry["id"]).title == "Changed while archiving"
+    assert archived_entries() == 0
+
+    # no longer old enough by the time it would be deleted
+    monkeypatch.setattr(archive, "_copy_threads", copy_and_bump)
+    Entry.update(sort_ts=long_ago).where(
+        Entry.id == entry["id"]).execute()
+    assert archive.archive_entries(str(tmpdir), days=365) == (0, 0)
+    assert archived_entries() == 0
+
+    monkeypatch.setattr(archive, "_copy_threads", copy_threads)
+    Entry.update(sort_ts=long_ago).where(
+        Entry.id == entry["id"]).execute()
+    assert archive.archive_entries(str(tmpdir), days=365) == (1, 1)
+    assert archived_entries() == 1
+
+
+def test_get_attachment_offload(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    DATA = b"0123456789"
+    URL = ("/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/"
+           .format(logbook=logbook, entry=entry))
+    att = decode_response(
+        elogy_client.post(
+            URL,
+            content_type='multipart/form-data',
+            data={"attachment": [(BytesIO(DATA), "data.txt")]}))
+
+    # by default, we send the file ourselves
+    response = elogy_client.get(att["location"],
+                                headers={"Range": "bytes=2-5"})
+    assert response.status_code == 206
+    assert response.get_data() == b"2345"
+    assert "immutable" in response.headers["Cache-Control"]
+
+    # ...but can leave it to the web server
+    config = elogy_client.application.config
+    try:
+        config["ATTACHMENT_OFFLOAD"] = "x-accel-redirect"
+        response = elogy_client.get(att["location"])
+        assert response.get_data() == b""
+        assert response.mimetype == "text/plain"
+        assert response.headers["X-Accel-Redirect"].startswith(
+            "/protected-attachments/blobs/")
+        assert "immutable" in response.headers["Cache-Control"]
+    finally:
+        config["ATTACHMENT_OFFLOAD"] = ""
+
+
 @mark.xfail(reason="See https://github.com/pallets/werkzeug/issues/1091")
 def test_create_attachment_with_single_quotes(elogy_client):
     in_logbook, logbook = make_logbook(elogy_client)
@@ -461,6 +975,115 @@ def test_create_attachment_with_single_quotes(elogy_client):
     assert att["filename"] == FILENAME
 
 
+def test_create_entry_inline_image(elogy_client):
+    from base64 import b64encode
+    from PIL import Image
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    image_data = BytesIO()
+    Image.new("RGB", (10, 10), (0, 255, 0)).save(image_data, "PNG")
+    src = "data:image/png;base64," + b64encode(
+        image_data.getvalue()).decode("ascii")
+    in_entry, entry = make_entry(elogy_client, logbook, dict(
+        title="Inline image",
+        content=('<p>Look at <b>this</b>:</p><img src="{}">'
+                 '<script>alert("hi")</script>'.format(src)),
+        content_type="text/html"))
+
+    # the image is saved as an attachment, and linked instead
+    assert "data:" not in entry["content"]
+    assert "<script>" not in entry["content"]
+    attachment, = entry["attachments"]
+    assert attachment["embedded"]
+    assert '<a href="{}">'.format(attachment["link"]) in entry["content"]
+    assert '<img src="{}"/>'.format(attachment["link"]) in entry["content"]
+
+    # the preview in entry lists is plain text
+    result = decode_response(elogy_client.get(
+        "/api/logbooks/{logbook[id]}/entries/".format(logbook=logbook)))
+    assert result["entries"][0]["content"] == "Look at this:"
+
+    # things found in the content are kept in the metadata
+    assert entry["metadata"]["links"] == [attachment["link"]] * 2
+    assert entry["metadata"]["word_count"] == 3
+
+
+def test_process_content():
+    from elogy.content import process_content, STAGES
+
+    # plain text is not parsed
+    result = process_content("Just some\ntext", "text/html")
+    assert result.tree is None
+    assert result.timings == {}
+    assert result.preview == "Just some text"
+    assert result.word_count == 3
+
+    result = process_content(
+        '<p>Some <a href="/a">text</a></p>\n<script>alert("hi")</script>'
+        + "<p>{}</p>".format("word " * 100))
+    assert "<script>" not in result.content
+    assert "alert" not in result.text
+    assert result.preview.startswith("Some text word word")
+    assert len(result.preview) <= 200
+    assert result.links == ["/a"]
+    assert result.word_count == 102
+    assert result.metadata == {"links": ["/a"], "word_count": 102}
+    assert set(result.timings) == (
+        {"parse", "serialize"} | {stage.__name__ for stage in STAGES})
+    assert all(t >= 0 for t in result.timings.values())
+
+
+def test_inline_images_staged(elogy_client):
+    import os
+    from base64 import b64encode
+    from hashlib import sha256
+    from PIL import Image
+    from elogy.app import app
+    from elogy.db import Blob
+    from elogy.storage import get_blob_path
+
+    def image(color):
+        data = BytesIO()
+        Image.new("RGB", (10, 10), color).save(data, "PNG")
+        data = data.getvalue()
+        src = "data:image/png;base64," + b64encode(data).decode("ascii")
+        return sha256(data).hexdigest(), '<img src="{}">'.format(src)
+
+    upload_folder = app.config["UPLOAD_FOLDER"]
+    tmp_dir = os.path.join(upload_folder, "blobs", "tmp")
+
+    def staged_files():
+        # unfinished uploads are kept here as well
+        return [name for name in os.listdir(tmp_dir)
+                if not name.endswith(".part")]
+    in_logbook, logbook = make_logbook(elogy_client)
+    digest1, img1 = image((1, 2, 3))
+    digest2, img2 = image((4, 5, 6))
+    in_entry, entry = make_entry(elogy_client, logbook, dict(
+        title="Images", content=img1 + img1 + img2,
+        content_type="text/html"))
+    assert len(entry["attachments"]) == 3
+    assert Blob.get(Blob.digest == digest1).refs == 2
+    assert Blob.get(Blob.digest == digest2).refs == 1
+    for digest in digest1, digest2:
+        assert os.path.exists(
+            os.path.join(upload_folder, get_blob_path(digest)))
+    assert not staged_files()
+
+    # a failed edit leaves nothing behind
+    digest3, img3 = image((7, 8, 9))
+    URL = "/api/logbooks/{logbook[id]}/entries/{entry[id]}/".format(
+        logbook=logbook, entry=entry)
+    response = elogy_client.put(URL, data=dict(
+        content=img3, content_type="text/html",
+        revision_n=entry["revision_n"] + 1))
+    assert response.status_code == 409
+    assert not Blob.select().where(Blob.digest == digest3).exists()
+    assert not os.path.exists(
+        os.path.join(upload_folder, get_blob_path(digest3)))
+    assert not staged_files()
+
+
 def test_entry_search(elogy_client):
 
     # TODO: expand to cover all ways to search
@@ -497,3 +1120,380 @@ def test_entry_search(elogy_client):
     URL = ("/api/logbooks/0/entries/?content=more")
     result = decode_response(elogy_client.get(URL))
     assert set([entry12["id"], entry13["id"], entry22["id"]]) == set(e["id"] for e in result["entries"])
+
+
+def test_resumable_upload(elogy_client):
+    from elogy import storage
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    DATA = b"a large file, sent in several pieces"
+    upload = decode_response(
+        post_json(elogy_client, "/api/uploads/",
+                  {"filename": "large.txt", "size": len(DATA),
+                   "entry_id": entry["id"]}))["upload"]
+    URL = "/api/uploads/{}".format(upload["id"])
+    assert upload["offset"] == 0
+
+    def send(start, stop):
+        return elogy_client.put(
+            URL, data=DATA[start:stop],
+            headers={"Content-Range": "bytes {}-{}/{}".format(
+                start, stop - 1, len(DATA))})
+
+    assert decode_response(send(0, 10))["upload"]["offset"] == 10
+    # a chunk that does not continue where we left off is refused
+    response = send(20, 30)
+    assert response.status_code == 409
+    assert decode_response(response)["offset"] == 10
+    # can't finish before all the data is there
+    assert elogy_client.post(URL).status_code == 409
+    # resuming in a process that has not seen the start of the upload
+    storage._upload_hashes.clear()
+    assert decode_response(elogy_client.get(URL))["upload"]["offset"] == 10
+    assert decode_response(send(10, 20))["upload"]["offset"] == 20
+    # ...which does not read the start again, but leaves hashing to the end
+    assert upload["id"] not in storage._upload_hashes
+    assert decode_response(send(20, len(DATA)))["upload"]["offset"] == len(DATA)
+
+    att = decode_response(elogy_client.post(URL))
+    assert att["filename"] == "large.txt"
+    assert att["content_type"] == "text/plain"
+    assert elogy_client.get(att["location"]).get_data() == DATA
+    # the upload is gone now, also its data
+    assert elogy_client.get(URL).status_code == 404
+    from elogy.app import app
+    assert not os.path.exists(storage.get_partial_path(
+        app.config["UPLOAD_FOLDER"], upload["id"]))
+    # and the attachment belongs to the entry
+    entry = decode_response(elogy_client.get(
+        "/api/entries/{}/".format(entry["id"])))["entry"]
+    assert [a["id"] for a in entry["attachments"]] == [att["id"]]
+
+
+def test_expire_uploads(elogy_client):
+    import os
+    from datetime import datetime, timedelta
+    from time import time
+    from elogy.app import app
+    from elogy.db import Upload
+    from elogy.reconcile import expire_uploads
+    from elogy.storage import get_partial_path
+
+    uploads = [decode_response(post_json(
+        elogy_client, "/api/uploads/",
+        {"filename": "abandoned.txt", "size": 100}))["upload"]
+        for i in range(3)]
+    upload_folder = app.config["UPLOAD_FOLDER"]
+    long_ago = datetime.utcnow() - timedelta(days=10)
+    Upload.update(created_at=long_ago).where(
+        Upload.id << [upload["id"] for upload in uploads[:2]]).execute()
+    # data arrived recently for the second one
+    path = get_partial_path(upload_folder, uploads[0]["id"])
+    os.utime(path, (time() - 10 * 86400,) * 2)
+
+    assert expire_uploads(upload_folder, days=7) == 1
+    assert not os.path.exists(path)
+    assert elogy_client.get(
+        "/api/uploads/{}".format(uploads[0]["id"])).status_code == 404
+    for upload in uploads[1:]:
+        URL = "/api/uploads/{}".format(upload["id"])
+        assert elogy_client.get(URL).status_code == 200
+        elogy_client.delete(URL)
+
+
+def test_metrics(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    elogy_client.get("/api/logbooks/{logbook[id]}/".format(logbook=logbook))
+    elogy_client.get("/api/logbooks/1234567/")
+
+    metrics = elogy_client.get("/metrics").get_data().decode("utf-8")
+    lines = metrics.splitlines()
+    assert "# TYPE elogy_http_request_duration_seconds histogram" in lines
+    assert any(line.startswith(
+        'elogy_http_responses_total{endpoint="logbooksresource",'
+        'method="GET",status="404"}') for line in lines)
+    assert any(line.startswith(
+        'elogy_http_request_duration_seconds_bucket{'
+        'endpoint="logbooksresource",le="+Inf",method="GET"}')
+        for line in lines)
+    # the /metrics request itself is in progress
+    assert "elogy_http_requests_in_progress 1.0" in lines
+    sql_queries = [line for line in lines
+                   if line.startswith("elogy_sql_queries_total")]
+    assert float(sql_queries[0].split()[1]) > 0
+
+
+def test_sql_trace(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    URL = "/api/logbooks/{logbook[id]}/entries/{entry[id]}/".format(
+        logbook=logbook, entry=entry)
+
+    # no trace unless asked for
+    response = elogy_client.get(URL)
+    assert "sql_trace" not in decode_response(response)
+    assert "X-Elogy-SQL-Count" not in response.headers
+
+    response = elogy_client.get(URL + "?sql_trace=1")
+    trace = decode_response(response)["sql_trace"]
+    assert trace["count"] == len(trace["queries"]) > 0
+    assert int(response.headers["X-Elogy-SQL-Count"]) == trace["count"]
+    # the entry itself is fetched
+    assert any(q["sql"].startswith('SELECT') and '"entry"' in q["sql"] and
+               q["params"] == [entry["id"]] and q["rows"] == 1
+               for q in trace["queries"])
+
+
+def test_slow_query_log(elogy_client, caplog):
+    from elogy import profiler
+    in_logbook, logbook = make_logbook(elogy_client)
+    threshold = profiler.slow_query_threshold
+    profiler.slow_query_threshold = 0
+    try:
+        elogy_client.get("/api/logbooks/{logbook[id]}/".format(
+            logbook=logbook))
+    finally:
+        profiler.slow_query_threshold = threshold
+    messages = [r.getMessage() for r in caplog.records
+                if r.name == "elogy.profiler"]
+    assert any("Slow query" in m and '"logbook"' in m and
+               "SEARCH" in m for m in messages)
+
+
+def test_read_pool(elogy_client):
+    from elogy.db import db, Entry
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+
+    # a GET right after a write sees it, although on another connection
+    response = elogy_client.get("/api/logbooks/{logbook[id]}/entries/"
+                                .format(logbook=logbook))
+    assert len(decode_response(response)["entries"]) == 1
+    metrics = elogy_client.get("/metrics").get_data().decode("utf-8")
+    lines = metrics.splitlines()
+    acquired = [line for line in lines if line.startswith(
+        "elogy_db_read_connection_acquisitions_total")]
+    assert float(acquired[0].split()[1]) > 0
+    assert "elogy_db_read_connections_in_use 0.0" in lines
+
+    db.use_read_pool()
+    try:
+        # leave a read unfinished, so that it keeps its snapshot
+        entries = iter(Entry.select().where(Entry.logbook == logbook["id"]))
+        next(entries)
+        # a write in another thread is not blocked by the reader
+        writer = threading.Thread(target=Entry.create, kwargs=dict(
+            logbook=logbook["id"], title="Written while reading"))
+        writer.start()
+        writer.join(timeout=2)
+        assert not writer.is_alive()
+        # the read connection really is read only
+        with raises(sqlite3.OperationalError):
+            db._reading.conn.execute("DELETE FROM entry")
+    finally:
+        db.release_read_connection()
+    assert Entry.select().where(Entry.logbook == logbook["id"]).count() == 2
+
+
+def test_group_commit(elogy_client):
+    from elogy import writequeue
+    from elogy.db import db, Entry
+    in_logbook, logbook = make_logbook(elogy_client)
+    queue = writequeue.WriteQueue(db, window=0.1)
+
+    def create(title):
+        if title == "bad":
+            Entry.create(logbook=logbook["id"], title=title)
+            raise ValueError("Nope")
+        return Entry.create(logbook=logbook["id"], title=title)
+
+    futures = [queue.submit(create, title)
+               for title in ["first", "bad", "second"]]
+    assert futures[0].result(timeout=5).title == "first"
+    with raises(ValueError):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5).title == "second"
+    # the failed write was rolled back, but not the others
+    titles = [e.title for e in
+              Entry.select().where(Entry.logbook == logbook["id"])]
+    assert sorted(titles) == ["first", "second"]
+
+    # the API works the same way in group mode
+    writequeue._queue = queue
+    try:
+        in_entry, entry = make_entry(elogy_client, logbook)
+        URL = "/api/logbooks/{logbook[id]}/entries/{entry[id]}/".format(
+            logbook=logbook, entry=entry)
+        lock = decode_response(elogy_client.post(URL + "lock"))["lock"]
+        response = elogy_client.delete(URL + "lock?lock_id={}".format(
+            lock["id"]))
+        assert decode_response(response)["lock"]["cancelled_at"]
+        response = elogy_client.put(URL, data=json.dumps(
+            {"title": "New title", "revision_n": entry["revision_n"]}),
+            content_type="application/json")
+        assert decode_response(response)["entry"]["title"] == "New title"
+        # errors end up in the right request
+        response = elogy_client.put(URL, data=json.dumps(
+            {"title": "Stale", "revision_n": entry["revision_n"]}),
+            content_type="application/json")
+        assert response.status_code == 409
+    finally:
+        writequeue._queue = None
+
+
+def test_admin_loaded_lazily(elogy_client):
+    import sys
+    assert "flask_admin" not in sys.modules
+    response = elogy_client.get("/admin/")
+    assert response.status_code == 200
+    assert "flask_admin" in sys.modules
+    response = elogy_client.get("/admin/logbook/")
+    assert response.status_code == 200
+
+
+def test_admin_list_pages(elogy_client):
+    import html
+    import re
+    _, logbook = make_logbook(elogy_client)
+    for i in range(25):
+        make_entry(elogy_client, logbook,
+                   dict(title="Admin test {:02d}".format(i), content="hello"))
+
+    def follow(page, key):
+        url = re.search(r'href="([^"]*{}=\d+[^"]*)"'.format(key), page)
+        return elogy_client.get(html.unescape(url.group(1))).get_data(
+            as_text=True)
+
+    # newest first, with links to the next/previous page that seek by id
+    response = elogy_client.get("/admin/entry/?page_size=10")
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert "Admin test 24" in page and "Admin test 15" in page
+    assert "Admin test 14" not in page
+    page = follow(page, "after")
+    assert "Admin test 14" in page and "Admin test 05" in page
+    page = follow(page, "after")
+    assert "Admin test 04" in page and "Admin test 00" in page
+    assert "Admin test 05" not in page
+    page = follow(page, "before")
+    assert "Admin test 14" in page and "Admin test 05" in page
+    assert "Admin test 15" not in page and "Admin test 04" not in page
+
+    # jumping to a page by number also works
+    page = elogy_client.get("/admin/entry/?page=1").get_data(as_text=True)
+    assert "Admin test 04" in page and "Admin test 05" not in page
+
+    # search matches the beginning of the title, ignoring case
+    page = elogy_client.get("/admin/entry/?search=admin+TEST+1").get_data(
+        as_text=True)
+    assert "Admin test 10" in page and "Admin test 19" in page
+    assert "Admin test 20" not in page and "Admin test 01" not in page
+
+    response = elogy_client.get("/admin/entrychange/")
+    assert response.status_code == 200
+
+
+def test_entry_lock_heartbeat(elogy_client):
+    _, logbook = make_logbook(elogy_client)
+    _, entry = make_entry(elogy_client, logbook)
+    URL = "/api/entries/{}/lock".format(entry["id"])
+    IP, OTHER_IP = "1.2.3.4", "5.6.7.8"
+
+    lock = decode_response(elogy_client.post(
+        URL, environ_base={"REMOTE_ADDR": IP}))["lock"]
+    renewed = decode_response(elogy_client.put(
+        URL, data={"lock_id": lock["id"]},
+        environ_base={"REMOTE_ADDR": IP}))["lock"]
+    assert renewed["id"] == lock["id"]
+    assert renewed["expires_at"] >= lock["expires_at"]
+
+    # only the owner can renew
+    response = elogy_client.put(URL, data={"lock_id": lock["id"]},
+                                environ_base={"REMOTE_ADDR": OTHER_IP})
+    assert response.status_code == 409
+
+    # a stolen lock is lost
+    elogy_client.post(URL, data={"steal": True},
+                      environ_base={"REMOTE_ADDR": OTHER_IP})
+    response = elogy_client.put(URL, data={"lock_id": lock["id"]},
+                                environ_base={"REMOTE_ADDR": IP})
+    assert response.status_code == 409
+
+
+def test_entry_lock_cache(elogy_client):
+    from elogy.db import query_hooks
+    _, logbook = make_logbook(elogy_client)
+    _, entry = make_entry(elogy_client, logbook)
+    URL = "/api/entries/{}/".format(entry["id"])
+
+    lock_queries = []
+
+    def hook(sql, *args):
+        if "entrylock" in sql:
+            lock_queries.append(sql)
+
+    query_hooks.append(hook)
+    try:
+        assert decode_response(elogy_client.get(URL))["entry"]["lock"] is None
+        n_queries = len(lock_queries)
+        assert decode_response(elogy_client.get(URL))["entry"]["lock"] is None
+        assert len(lock_queries) == n_queries  # cached
+
+        # changing a lock clears the cache
+        lock = decode_response(elogy_client.post(URL + "lock"))["lock"]
+        result = decode_response(elogy_client.get(URL))["entry"]
+        assert result["lock"]["id"] == lock["id"]
+        elogy_client.delete(URL + "lock?lock_id={}".format(lock["id"]))
+        assert decode_response(elogy_client.get(URL))["entry"]["lock"] is None
+    finally:
+        query_hooks.remove(hook)
+
+
+def test_sweep_locks(elogy_client):
+    from datetime import datetime, timedelta
+    from elogy.db import EntryLock
+    from elogy.locks import sweep_locks
+    _, logbook = make_logbook(elogy_client)
+    _, entry = make_entry(elogy_client, logbook)
+    long_ago = datetime.utcnow() - timedelta(days=2)
+    old = EntryLock.create(entry=entry["id"], owned_by_ip="1.2.3.4",
+                           created_at=long_ago, expires_at=long_ago)
+    active = EntryLock.create(entry=entry["id"], owned_by_ip="1.2.3.4")
+    assert sweep_locks(retention=3600) >= 1
+    ids = [lock.id for lock in EntryLock.select()]
+    assert old.id not in ids and active.id in ids
+
+
+def test_shared_counter(tmpdir):
+    from multiprocessing import Process
+    from elogy.sharedmem import SharedCounter
+    counter = SharedCounter(str(tmpdir.join("test.count")))
+    counter.increase()
+    assert counter.total() == 1
+    # another process' increase is seen here
+    process = Process(target=counter.increase)
+    process.start()
+    process.join()
+    assert counter.total() == 2
+
+
+def test_process_values_of_exited_processes(tmpdir):
+    from multiprocessing import Process
+    from elogy.sharedmem import ProcessValues, SharedValues, read_file
+    retired = []
+    store = ProcessValues(str(tmpdir), "test",
+                          retire=lambda path: retired.append(read_file(path)))
+    # left by an earlier process with the same pid
+    old = SharedValues(str(tmpdir.join("test-{}.db".format(os.getpid()))))
+    old.add("a", 5)
+    store.values.add("a")
+    assert store.values.get("a") == 1
+    assert retired == [[("a", 5.0)]]
+
+    process = Process(target=lambda: store.values.add("a", 2))
+    process.start()
+    process.join()
+    # the file of the exited process is retired and removed
+    assert [pid for pid, _ in store.files()] == [os.getpid()]
+    assert retired[1] == [("a", 2.0)]
+    assert not tmpdir.join("test-{}.db".format(process.pid)).exists()
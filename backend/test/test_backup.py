@@ -0,0 +1,45 @@
+import hashlib
+from importlib.util import module_from_spec, spec_from_file_location
+import os
+import sqlite3
+
+
+def test_backup_round_trip(tmpdir):
+    spec = spec_from_file_location("backup_sqlite", os.path.join(
+        os.path.dirname(__file__), "..", "..", "scripts", "backup_sqlite.py"))
+    backup_sqlite = module_from_spec(spec)
+    spec.loader.exec_module(backup_sqlite)
+
+    DATA = b"an attachment that is backed up"
+    digest = hashlib.sha256(DATA).hexdigest()
+    blob_path = "blobs/{}/{}/{}".format(digest[:2], digest[2:4], digest)
+    uploads = tmpdir.mkdir("uploads")
+    uploads.join(blob_path).write_binary(DATA, ensure=True)
+    dbfile = str(tmpdir.join("elogy.db"))
+    conn = sqlite3.connect(dbfile)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("CREATE TABLE entry (id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE blob (digest TEXT PRIMARY KEY)")
+    conn.execute("CREATE TABLE attachment (path TEXT, blob_id TEXT)")
+    conn.execute("INSERT INTO entry VALUES (1)")
+    conn.execute("INSERT INTO blob VALUES (?)", (digest,))
+    conn.execute("INSERT INTO attachment VALUES (?, ?)",
+                 (blob_path + "/file.txt", digest))
+    conn.commit()
+
+    backups = tmpdir.mkdir("backups")
+    backup_file = backup_sqlite.sqlite3_backup(dbfile, str(backups))
+    backup_sqlite.backup_attachments(str(uploads), str(backups))
+    assert backup_sqlite.verify_backup(backup_file, rehash=True) == []
+
+    # the copy used with older Python and SQLite is the same
+    copy = str(tmpdir.join("dumped.db"))
+    backup_sqlite.dump_database(sqlite3.connect(dbfile), copy)
+    dumped = sqlite3.connect(copy)
+    assert list(dumped.iterdump()) == list(conn.iterdump())
+    dumped.close()
+    conn.close()
+
+    backups.join("attachments", blob_path).remove()
+    assert backup_sqlite.verify_backup(backup_file) == [
+        "Missing attachment file: " + blob_path]
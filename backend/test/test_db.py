@@ -1,7 +1,9 @@
+from datetime import datetime, timedelta
 from operator import attrgetter
 
-from .fixtures import db
-from elogy.db import Entry
+from .fixtures import db, postgresql_server
+from elogy.db import Entry, query_hooks, set_revisions, set_sort_ts
+from elogy.db import set_thread_ids
 from elogy.db import Logbook, LogbookRevision
 
 
@@ -620,3 +622,245 @@ def test_entry_content_search_child_logbooks(db):
 
     assert len(results) == 1
     set([results[0].title]) == "entry2"
+
+
+def test_postgresql_search_query():
+    # doesn't need a server, just checks that the query is put together
+    # with the right number of parameters
+    from elogy.dialects import PostgreSQLDialect
+    lb = Logbook(id=3, name="Logbook1")
+    query, params = PostgreSQLDialect().search_entries(
+        logbook=lb, child_logbooks=True, content_filter="some words",
+        title_filter="T.*e", author_filter="alpha", attachment_filter="png",
+        attribute_filter=[("a", 1)], metadata_filter=[("m", "x")], n=10)
+    assert query.count("%s") == len(params)
+    assert params[:2] == [3, 3]  # the recursive part comes first
+    assert "some:* & words:*" in params
+    assert "to_tsquery" in query and "T.*e" in params
+    assert query.count("to_tsquery") == 1  # not for a regexp
+
+
+def test_setup_database_skips_current_schema(tmpdir, monkeypatch):
+    from elogy.db import db, setup_database, schema_version
+    path = str(tmpdir.join("elogy.db"))
+    setup_database(path)
+    assert db.dialect.get_schema_version(db) == schema_version()
+
+    # e.g. a new worker process; nothing needs to be created
+    def fail(*args, **kwargs):
+        raise AssertionError("Should not create tables")
+    monkeypatch.setattr(Logbook, "create_table", fail)
+    setup_database(path)
+
+
+def test_setup_database_uses_autoincrement(tmpdir):
+    import sqlite3
+    from elogy.db import db, setup_database
+    path = str(tmpdir.join("elogy.db"))
+    setup_database(path, close=False)
+    lb = Logbook.create(name="Ids")
+    for i in range(3):
+        Entry.create(logbook=lb, title="Entry {}".format(i))
+    indexes = sorted(index.name for index in db.get_indexes("entry"))
+    db.close()
+    # as created by an older version
+    conn = sqlite3.connect(path)
+    sql, = conn.execute("SELECT sql FROM sqlite_master "
+                        "WHERE name = 'entry'").fetchone()
+    index_sql = [row[0] for row in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' "
+        "AND tbl_name = 'entry' AND sql IS NOT NULL")]
+    conn.executescript("""
+        {};
+        INSERT INTO entry_new SELECT * FROM entry;
+        DROP TABLE entry;
+        ALTER TABLE entry_new RENAME TO entry;
+        {};
+        DELETE FROM sqlite_sequence WHERE name = 'entry';
+        PRAGMA user_version = 0;
+    """.format(sql.replace(" AUTOINCREMENT", "").replace(
+        '"entry" (', '"entry_new" (', 1), ";\n".join(index_sql)))
+    conn.close()
+
+    setup_database(path, close=False)
+    sql, = db.execute_sql("SELECT sql FROM sqlite_master "
+                          "WHERE name = 'entry'").fetchone()
+    assert "AUTOINCREMENT" in sql
+    assert sorted(index.name for index in db.get_indexes("entry")) == indexes
+    assert Entry.select().count() == 3
+    # the last entry is deleted (e.g. archived), but its id not reused
+    Entry.delete().where(Entry.id == 3).execute()
+    assert Entry.create(logbook=lb, title="New").id == 4
+
+
+def test_after_fork(tmpdir):
+    from elogy.db import db, setup_database
+    setup_database(str(tmpdir.join("elogy.db")), close=False)
+    conn = db.get_conn()
+    db.after_fork()
+    assert db.get_conn() is not conn
+    conn.execute("SELECT 1")  # the parent's connection was left alone
+    Logbook.create(name="After fork")
+
+
+def test_maintenance(tmpdir):
+    from elogy.db import db, setup_database
+    from elogy.maintenance import (MaintenanceScheduler, next_daily,
+                                   run_maintenance)
+    setup_database(str(tmpdir.join("elogy.db")), close=False,
+                   journal_mode="WAL", wal_autocheckpoint=10000)
+    assert db.execute_sql("PRAGMA auto_vacuum").fetchone()[0] == 2  # incremental
+    assert db.execute_sql("PRAGMA wal_autocheckpoint").fetchone()[0] == 10000
+    lb = Logbook.create(name="Maintenance")
+    with db.atomic():
+        for i in range(100):
+            Entry.create(logbook=lb, title="Big", content="x" * 10000)
+    Entry.delete().execute()
+    assert db.execute_sql("PRAGMA freelist_count").fetchone()[0] > 0
+
+    stats = run_maintenance()
+    assert stats["vacuumed_bytes"] > 100 * 10000
+    assert stats["reclaimed_bytes"] > 0
+    assert stats["checkpointed_pages"] == stats["wal_pages"]
+    assert db.execute_sql("PRAGMA freelist_count").fetchone()[0] == 0
+    assert "sqlite_stat1" in db.get_tables()
+
+    assert (next_daily(datetime(2018, 1, 1, 12, 0), "03:30") ==
+            datetime(2018, 1, 2, 3, 30))
+    assert (next_daily(datetime(2018, 1, 1, 2, 0), "03:30") ==
+            datetime(2018, 1, 1, 3, 30))
+
+    # only one process does the scheduled maintenance
+    lock_path = str(tmpdir.join("maintenance.lock"))
+    scheduler = MaintenanceScheduler(lock_path)
+    assert scheduler._is_ours()
+    assert not MaintenanceScheduler(lock_path)._is_ours()
+    scheduler.run(daily=False)  # a passive checkpoint
+
+
+def test_entry_thread(db):
+    lb = Logbook.create(name="Logbook1")
+    first = Entry.create(logbook=lb, title="First")
+    second = Entry.create(logbook=lb, title="Second", follows=first)
+    third = Entry.create(logbook=lb, title="Third", follows=second)
+    fourth = Entry.create(logbook=lb, title="Fourth", follows=first)
+    other = Entry.create(logbook=lb, title="Other")
+
+    assert first.thread_id == first.id
+    assert [e.thread_id for e in (second, third, fourth)] == [first.id] * 3
+
+    # loaded with one query, at any depth
+    queries = []
+    query_hooks.append(lambda sql, *args: queries.append(sql))
+    try:
+        thread = third._thread
+        assert thread.id == first.id
+        assert [e.title for e in thread.followups] == ["Second", "Fourth"]
+        assert thread.followups[0].followups[0].title == "Third"
+        assert thread.followups[0].followups[0].follows.id == second.id
+        assert len(queries) == 1
+    finally:
+        query_hooks.pop()
+
+    # moving a followup moves its followups too
+    second.follows = other
+    second.save()
+    assert Entry.get(Entry.id == third.id).thread_id == other.id
+    assert Entry.get(Entry.id == fourth.id).thread_id == first.id
+    assert [e.title for e in other._thread.followups] == ["Second"]
+
+
+def test_set_thread_ids(db):
+    lb = Logbook.create(name="Logbook1")
+    first = Entry.create(logbook=lb, title="First")
+    second = Entry.create(logbook=lb, title="Second", follows=first)
+    third = Entry.create(logbook=lb, title="Third", follows=second)
+    Entry.update(thread_id=None, sort_ts=None).execute()
+    set_thread_ids()
+    set_sort_ts()
+    entries = list(Entry.select().order_by(Entry.id))
+    assert [e.thread_id for e in entries] == [first.id] * 3
+    assert entries[0].sort_ts == third.created_at
+    assert entries[2].sort_ts == third.created_at
+
+
+def test_entry_save_revision(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="First")
+    assert entry.revision_n == 0
+    stale = Entry.get(Entry.id == entry.id)
+    entry.make_change(title="Second").save()
+    entry.save(revision=0)
+    assert Entry.get(Entry.id == entry.id).revision_n == 1
+    # someone else loaded the entry before it was changed
+    stale.make_change(title="Third")
+    try:
+        stale.save(revision=0)
+    except Entry.Conflict:
+        pass
+    else:
+        assert False, "stale revision was saved"
+    entry = Entry.get(Entry.id == entry.id)
+    assert entry.title == "Second"
+    assert entry.revision_n == 1
+
+
+def test_set_revisions(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="First")
+    for revision, title in enumerate(["Second", "Third"]):
+        entry.make_change(title=title).save()
+        entry.save(revision=revision)
+    Entry.update(revision=None).execute()
+    set_revisions()
+    assert Entry.get(Entry.id == entry.id).revision_n == 2
+
+
+def test_set_storage_usage(db):
+    from elogy.db import Attachment, Blob, StorageUsage, set_storage_usage
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="Entry")
+    blob = Blob.create(digest="a" * 64, size=10, refs=2)
+    for filename in ["a.txt", "b.txt"]:
+        Attachment.create(entry=entry, path="blobs/" + filename, blob=blob,
+                          filename=filename)
+    StorageUsage.delete().execute()
+    set_storage_usage()
+    usage = StorageUsage.get(StorageUsage.logbook == lb)
+    assert (usage.files, usage.bytes) == (2, 20)
+
+
+def test_entry_next_previous(db):
+    parent = Logbook.create(name="Parent")
+    child = Logbook.create(name="Child", parent=parent)
+    time = datetime(2018, 1, 1)
+
+    def make(logbook, minutes, **kwargs):
+        return Entry.create(logbook=logbook, title="Entry {}".format(minutes),
+                            created_at=time + timedelta(minutes=minutes),
+                            **kwargs)
+
+    a = make(parent, 1)
+    b = make(child, 2)
+    c = make(parent, 3)
+    d = make(child, 4)
+    make(parent, 5, follows=a)  # a is now the most recent thread
+    important = make(parent, 0, priority=200)
+
+    # same order as the listing
+    listing = [e.id for e in Entry.search(logbook=parent, child_logbooks=True)]
+    assert listing == [important.id, a.id, d.id, c.id, b.id]
+    entry, navigated = Entry.get(Entry.id == important.id), [important.id]
+    while entry.get_neighbour(False, parent, True):
+        entry = entry.get_neighbour(False, parent, True)
+        navigated.append(entry.id)
+    assert navigated == listing
+    assert b.get_neighbour(True, parent, True).id == c.id
+
+    # only in the entry's own logbook by default
+    c = Entry.get(Entry.id == c.id)
+    assert c.next.id == a.id
+    assert c.previous is None
+    # important entries in ancestors are shown in child logbooks
+    assert d.get_neighbour(True, child, True).id == important.id
+    assert d.get_neighbour(True, child, False) is None
@@ -1,48 +1,297 @@
 """
-A simple script that backs a sqlite database up.
+Backs up a running elogy: the sqlite database, any archive databases
+(see backend/archive.py) and the attachment files.
 
-Properly locks the database while copying to prevent modifications.
+The database is copied with SQLite's online backup API, a number of
+pages at a time, pausing in between, so that writers are never held
+up for long. (On Python < 3.7, where the backup API is not available,
+"VACUUM INTO" is used instead, or with SQLite < 3.27 a dump of the
+database into a new one; in WAL mode both only need a read
+transaction, which does not block writers either.) The copy is made
+to a temporary file in the backup directory, since it needs to be a
+database, and then compressed with gzip into
 
-TODO
-* Support gzip?
+    <backup dir>/<database name>-<YYYYmmdd-HHMMSS>.gz
+
+The attachments are backed up incrementally, into
+
+    <backup dir>/attachments/<path in the upload folder>
+
+A manifest of the size, mtime and SHA-256 of each file backed up is
+kept in <backup dir>/attachments/manifest.json, and only files that
+are new or changed since the last backup are copied. Files are never
+removed from the backup, since an older database backup may still
+need them. Archive databases are handled the same way, since they
+rarely change once written.
+
+A backup can be checked by restoring it to a temporary file, running
+an integrity check on it and making sure that the files of all its
+attachments are in the backup, with the right contents:
+
+$ python backup_sqlite.py --verify backups/elogy.db-20181001-030000.gz
+
+Usage, e.g. every night:
+
+$ python backup_sqlite.py /path/to/elogy.db -u /path/to/attachments \\
+      -a /path/to/archives -b /path/to/backups -k 30
 """
 
+import gzip
+import hashlib
+import json
 import os
 import shutil
 import sqlite3
+import sys
+import tempfile
 import time
 
 
-def sqlite3_backup(dbfile, backupdir):
-    """Create timestamped database copy"""
+ATTACHMENTS_FOLDER = "attachments"
+MANIFEST = "manifest.json"
+
+# the parts of the upload folder that don't need backing up: files
+# moved away by garbage collection, and unfinished uploads and locks
+SKIPPED_FOLDERS = {"quarantine", os.path.join("blobs", "tmp"),
+                   os.path.join("blobs", "locks")}
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def dump_database(source, destination):
+    """Copy the database by dumping it as SQL into a new one, in a single
+    read transaction, so that the copy is consistent"""
+    source.isolation_level = None
+    target = sqlite3.connect(destination, isolation_level=None)
+    source.execute("BEGIN")
+    try:
+        # the dump is one transaction, BEGIN ... COMMIT
+        for statement in source.iterdump():
+            target.execute(statement)
+    finally:
+        source.execute("ROLLBACK")
+        target.close()
+
+
+def copy_database(dbfile, destination, pages=1024, pause=0.01):
+    """Make a consistent copy of a live sqlite database, 'pages' pages
+    at a time, sleeping 'pause' seconds in between."""
+    source = sqlite3.connect(dbfile, timeout=30)
+    try:
+        if hasattr(source, "backup"):
+            target = sqlite3.connect(destination)
+            try:
+                # if the database is written meanwhile, the backup
+                # picks up the changes (or starts over)
+                source.backup(target, pages=pages,
+                              progress=lambda *_: time.sleep(pause))
+            finally:
+                target.close()
+        elif sqlite3.sqlite_version_info >= (3, 27, 0):
+            source.execute("VACUUM INTO ?", (destination,))
+        else:
+            dump_database(source, destination)
+    finally:
+        source.close()
+
+
+def compress(path, destination):
+    "Gzip the file, writing to a temporary file first"
+    tmp_destination = destination + ".part"
+    with open(path, "rb") as f, gzip.open(tmp_destination, "wb") as out:
+        shutil.copyfileobj(f, out, CHUNK_SIZE)
+    os.replace(tmp_destination, destination)
+
+
+def decompress(path, destination):
+    with gzip.open(path, "rb") as f, open(destination, "wb") as out:
+        shutil.copyfileobj(f, out, CHUNK_SIZE)
+
+
+def sqlite3_backup(dbfile, backupdir, pages=1024, pause=0.01):
+    """Create a timestamped, compressed database copy. Returns its
+    path."""
 
     if not os.path.isdir(backupdir):
         raise Exception("Backup directory does not exist: {}".format(backupdir))
 
     backup_file = os.path.join(backupdir, os.path.basename(dbfile) +
-                               time.strftime("-%Y%m%d-%H%M%S"))
+                               time.strftime("-%Y%m%d-%H%M%S") + ".gz")
+    print("Creating {}...".format(backup_file))
+
+    # the uncompressed copy goes next to the backup, not to /tmp,
+    # which may be too small
+    with tempfile.TemporaryDirectory(dir=backupdir) as tmpdir:
+        copy = os.path.join(tmpdir, os.path.basename(dbfile))
+        copy_database(dbfile, copy, pages, pause)
+        compress(copy, backup_file)
+    return backup_file
+
+
+def load_manifest(folder):
+    try:
+        with open(os.path.join(folder, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(folder, manifest):
+    path = os.path.join(folder, MANIFEST)
+    with open(path + ".part", "w") as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(path + ".part", path)
+
+
+def walk_uploads(upload_folder):
+    "The files to back up, as paths relative to the upload folder"
+    for dirpath, dirnames, filenames in os.walk(upload_folder):
+        relpath = os.path.relpath(dirpath, upload_folder)
+        dirnames[:] = [d for d in dirnames
+                       if os.path.normpath(os.path.join(relpath, d))
+                       not in SKIPPED_FOLDERS]
+        for filename in filenames:
+            yield os.path.normpath(os.path.join(relpath, filename))
 
-    connection = sqlite3.connect(dbfile)
-    cursor = connection.cursor()
 
-    # Lock database before making a backup
-    cursor.execute('begin immediate')
-    # Make new backup file
-    shutil.copyfile(dbfile, backup_file)
-    print ("\nCreating {}...".format(backup_file))
-    # Unlock database
-    connection.rollback()
+def backup_files(source_folder, paths, folder, manifest, copy=None):
+    """Copy the files that are not in the manifest, or have changed
+    size or mtime, unless their contents turn out to be the same.
+    'copy' can be given to copy a file some other way than shutil.copy2.
+    Returns the number of files and bytes copied."""
+    copy = copy or shutil.copy2
+    n_files = n_bytes = 0
+    for path in paths:
+        source = os.path.join(source_folder, path)
+        try:
+            stat = os.stat(source)
+        except FileNotFoundError:
+            continue  # removed meanwhile
+        key = path.replace(os.sep, "/")
+        known = manifest.get(key)
+        if (known and known["size"] == stat.st_size and
+                known["mtime"] == stat.st_mtime):
+            continue
+        sha256 = hash_file(source)
+        destination = os.path.join(folder, path)
+        if not (known and known["sha256"] == sha256 and
+                os.path.exists(destination)):
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            if os.path.exists(destination + ".part"):
+                os.remove(destination + ".part")  # left by a crash
+            copy(source, destination + ".part")
+            os.replace(destination + ".part", destination)
+            n_files += 1
+            n_bytes += stat.st_size
+        manifest[key] = {"size": stat.st_size, "mtime": stat.st_mtime,
+                         "sha256": sha256}
+    return n_files, n_bytes
+
+
+def backup_attachments(upload_folder, backupdir):
+    "Copy new and changed attachment files"
+    folder = os.path.join(backupdir, ATTACHMENTS_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    manifest = load_manifest(folder)
+    try:
+        n_files, n_bytes = backup_files(upload_folder,
+                                        walk_uploads(upload_folder),
+                                        folder, manifest)
+    finally:
+        # keep track of what was done, also if interrupted
+        save_manifest(folder, manifest)
+    print("Copied {} new attachment files ({} bytes)".format(n_files, n_bytes))
+
+
+def backup_archives(archive_folder, backupdir):
+    "Copy the archive databases that have changed"
+    folder = os.path.join(backupdir, "archives")
+    os.makedirs(folder, exist_ok=True)
+    manifest = load_manifest(folder)
+    paths = sorted(name for name in os.listdir(archive_folder)
+                   if name.startswith("elogy-archive-") and
+                   name.endswith(".db"))
+    try:
+        n_files, n_bytes = backup_files(archive_folder, paths, folder,
+                                        manifest, copy_database)
+    finally:
+        save_manifest(folder, manifest)
+    print("Copied {} changed archive databases".format(n_files))
+
+
+def check_attachments(db, backupdir, rehash=False):
+    """Yield problems with the backed up files of the attachments in
+    the (restored) database"""
+    folder = os.path.join(backupdir, ATTACHMENTS_FOLDER)
+    manifest = load_manifest(folder)
+    tables = set(row[0] for row in db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    if "blob" in tables:
+        # content addressed, see backend/storage.py
+        query = """SELECT DISTINCT attachment.path, blob.digest
+                   FROM attachment
+                   LEFT JOIN blob ON blob.digest = attachment.blob_id"""
+    else:
+        query = "SELECT DISTINCT path, NULL FROM attachment"
+    for path, digest in db.execute(query):
+        if not path:
+            continue
+        if digest:
+            # the attachment path is a link, the file is the blob
+            path = "/".join(["blobs", digest[:2], digest[2:4], digest])
+        known = manifest.get(path)
+        if known is None or not os.path.exists(os.path.join(folder, path)):
+            yield "Missing attachment file: {}".format(path)
+            continue
+        if digest and known["sha256"] != digest:
+            yield "Wrong contents: {}".format(path)
+        elif rehash and hash_file(os.path.join(folder, path)) != known["sha256"]:
+            yield "Changed since backed up: {}".format(path)
+
+
+def verify_backup(backup_file, rehash=False):
+    """Restore the backup to a temporary file and check it. Returns a
+    list of problems found, empty if all is well."""
+    backupdir = os.path.dirname(os.path.abspath(backup_file))
+    with tempfile.TemporaryDirectory(dir=backupdir) as tmpdir:
+        restored = os.path.join(tmpdir, "restored.db")
+        try:
+            decompress(backup_file, restored)
+        except (OSError, EOFError) as e:
+            return ["Could not decompress: {}".format(e)]
+        db = sqlite3.connect(restored)
+        try:
+            result = [row[0] for row in
+                      db.execute("PRAGMA integrity_check")]
+            if result != ["ok"]:
+                return result
+            n_entries, = db.execute("SELECT count(*) FROM entry").fetchone()
+            print("{}: {} entries".format(backup_file, n_entries))
+            return list(check_attachments(db, backupdir, rehash))
+        except sqlite3.DatabaseError as e:
+            return ["Not a usable database: {}".format(e)]
+        finally:
+            db.close()
 
 
 def clean_data(backup_dir, no_of_days=7):
 
-    """Delete files older than NO_OF_DAYS days"""
+    """Delete database backups older than NO_OF_DAYS days"""
 
     print ("\n------------------------------")
     print ("Cleaning up old backups")
 
     for filename in os.listdir(backup_dir):
         backup_file = os.path.join(backup_dir, filename)
+        # the attachments and archives are kept, see above
         if os.stat(backup_file).st_ctime < (time.time() - no_of_days * 86400):
             if os.path.isfile(backup_file):
                 os.remove(backup_file)
@@ -53,16 +302,40 @@ if __name__ == "__main__":
 
     import argparse
 
-    parser = argparse.ArgumentParser(description='Fix internal links in imported Elog entries.')
+    parser = argparse.ArgumentParser(description='Back up an elogy database and its attachments.')
 
-    parser.add_argument("elogy_database", metavar="DB", type=str, help="The elogy database file")
+    parser.add_argument("elogy_database", metavar="DB", type=str, nargs="?",
+                        help="The elogy database file")
     parser.add_argument("-b", "--backup", metavar="DIR", default="backups",
                         help="Directory in which to store backups (defaults to './backups'")
+    parser.add_argument("-u", "--upload-folder", metavar="DIR",
+                        help="Also back up the attachments in this folder (incrementally)")
+    parser.add_argument("-a", "--archive-folder", metavar="DIR",
+                        help="Also back up the archive databases in this folder")
     parser.add_argument("-k", "--keep", type=int, default=0, metavar="DAYS",
                         help="Number of days of backups to keep (defaults to infinite)")
+    parser.add_argument("--pages", type=int, default=1024,
+                        help="Number of database pages to copy at a time")
+    parser.add_argument("--verify", metavar="BACKUP",
+                        help="Instead check that the given backup can be restored")
+    parser.add_argument("--rehash", action="store_true",
+                        help="When verifying, also check the contents of all the files")
 
     args = parser.parse_args()
 
-    sqlite3_backup(args.elogy_database, args.backup)
+    if args.verify:
+        problems = verify_backup(args.verify, args.rehash)
+        for problem in problems:
+            print(problem)
+        print("{} problems found".format(len(problems)))
+        sys.exit(1 if problems else 0)
+
+    if not args.elogy_database:
+        parser.error("the database file is required")
+    sqlite3_backup(args.elogy_database, args.backup, args.pages)
+    if args.upload_folder:
+        backup_attachments(args.upload_folder, args.backup)
+    if args.archive_folder:
+        backup_archives(args.archive_folder, args.backup)
     if args.keep > 0:
         clean_data(args.backup, args.keep)
@@ -20,6 +20,7 @@ $ python fix_elog_links.py elogy.db host.of.old.elog other.address.to/elog
 
 """
 
+import json
 import logging
 import os
 import re
@@ -29,13 +30,26 @@ from lxml import html, etree
 
 
 def replace_link(db, entry_id, old_url, new_url):
-    "Change matching href attributes in the given entry."
+    """Change matching href attributes in the given entry, and the
+    links stored in its metadata."""
     logging.info("Replacing: %s -> %s", old_url, new_url)
     old_href = 'href="{}"'.format(old_url)
     new_href = 'href="{}"'.format(new_url)
     db.execute_sql(
-        "UPDATE entry SET content = replace(content, ?, ?) WHERE id = ?",
-        [old_href, new_href, entry_id])
+        "UPDATE entry SET content = replace(content, ?, ?),"
+        " metadata = replace(metadata, ?, ?) WHERE id = ?",
+        [old_href, new_href, json.dumps(old_url), json.dumps(new_url),
+         entry_id])
+
+
+def get_links(content, metadata):
+    """The links in an entry. They are stored in the metadata when the
+    entry is written, only entries from older versions are parsed."""
+    links = json.loads(metadata or "{}").get("links")
+    if links is None:
+        doc = html.document_fromstring(content)
+        links = [element.attrib["href"] for element in doc.xpath("//*[@href]")]
+    return links
 
 
 def update_bad_links(db, url):
@@ -44,13 +58,12 @@ def update_bad_links(db, url):
     to point to the correct place in the Elogy installation. This is needed
     because the ids used in the old system are not the same as in the new.
     """
-    QUERY = "SELECT id, content FROM entry WHERE content LIKE ?"
-    for entry_id, content in db.execute_sql(QUERY, ["%{}%".format(url)]):
+    QUERY = "SELECT id, content, metadata FROM entry WHERE content LIKE ?"
+    for entry_id, content, metadata in db.execute_sql(QUERY,
+                                                      ["%{}%".format(url)]):
         logging.debug(" *** check entry ID %r for old links", entry_id)
-        doc = html.document_fromstring(content)
-        for element in doc.xpath("//*[@href]"):
-            results = re.search(os.path.join(url, '(.*)'),
-                                element.attrib["href"])
+        for link in get_links(content, metadata):
+            results = re.search(os.path.join(url, '(.*)'), link)
             if results:
                 elog_url, = results.groups()
                 logging.debug("elog_url %s", elog_url)
@@ -62,7 +75,7 @@ def update_bad_links(db, url):
                     result = rows.fetchone()
                     if result:
                         path, = result
-                        old_url = str(element.attrib["href"])
+                        old_url = link
                         new_url = "/attachments/{}".format(path)
                         logging.info("Replacing: %s -> %s", old_url, new_url)
                         replace_link(db, entry_id, old_url, new_url)
@@ -73,7 +86,7 @@ def update_bad_links(db, url):
                     result = rows.fetchone()
                     if result:
                         linked_entry_id, logbook_id = result
-                        old_url = str(element.attrib["href"])
+                        old_url = link
                         new_url = "/logbooks/{}/entries/{}/".format(logbook_id,
                                                                     linked_entry_id)
                         logging.info("Replacing: %s -> %s", old_url, new_url)
@@ -122,8 +135,11 @@ def update_attachment_links(db):
                         element.getparent().attrib["href"] = quoted_url
         # now write the updated content to the database
         new_content = etree.tostring(doc).decode("utf-8")
-        db.execute_sql("UPDATE entry SET content = ? WHERE id = ?",
-                       [new_content, entry_id])
+        links = [link for _, _, link, _ in doc.iterlinks()]
+        db.execute_sql("UPDATE entry SET content = ?,"
+                       " metadata = json_set(metadata, '$.links', json(?))"
+                       " WHERE id = ?",
+                       [new_content, json.dumps(links), entry_id])
 
 
 
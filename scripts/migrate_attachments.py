@@ -0,0 +1,114 @@
+"""
+Move attachments stored the old way (as "YYYY/MM/DD/<epoch>-<filename>"
+in the upload folder) into the content addressed storage (see
+backend/storage.py), where identical files are only stored once.
+
+Each file is hashed and hardlinked into the blob storage, and the
+attachment is updated to point to the blob. The old file is then
+replaced by a hardlink to the blob, so that duplicates stop taking
+up space while old links in entries keep working. Since nothing is
+ever missing, this can be run while elogy is up. It's also safe to
+run it several times, or interrupt it; it only acts on attachments
+that have not been converted.
+
+Usage:
+
+$ python migrate_attachments.py /path/to/elogy.db /path/to/attachments
+
+Back up the database before trying this!
+"""
+
+import logging
+import os
+
+from backend.db import setup_database, set_storage_usage, Attachment
+from backend.storage import (add_blob, get_attachment_path, get_blob_path,
+                             hash_file)
+
+
+def replace_with_link(source, path):
+    "Atomically replace the file at path with a hardlink to source."
+    tmp_path = path + ".migrating"
+    os.link(source, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def migrate_attachment(upload_folder, attachment):
+    old_path = os.path.join(upload_folder, attachment.path)
+    try:
+        with open(old_path, "rb") as f:
+            digest, size = hash_file(f)
+    except FileNotFoundError:
+        logging.warning("Attachment %d: missing file %s",
+                        attachment.id, old_path)
+        return None
+    add_blob(upload_folder, old_path, digest, size)
+    blob_path = os.path.join(upload_folder, get_blob_path(digest))
+    if os.path.exists(old_path + ".thumbnail"):
+        try:
+            os.link(old_path + ".thumbnail", blob_path + ".thumbnail")
+        except FileExistsError:
+            pass
+    filename = attachment.filename or os.path.basename(attachment.path)
+    (Attachment
+     .update(path=get_attachment_path(digest, filename),
+             blob=digest)
+     .where(Attachment.id == attachment.id)
+     .execute())
+    if not os.path.samefile(old_path, blob_path):
+        # a duplicate of an already stored file
+        replace_with_link(blob_path, old_path)
+        if os.path.exists(old_path + ".thumbnail"):
+            replace_with_link(blob_path + ".thumbnail",
+                              old_path + ".thumbnail")
+        return size
+    return 0
+
+
+def migrate_attachments(upload_folder, batch_size=1000):
+    n_migrated = 0
+    saved = 0
+    last_id = 0
+    while True:
+        # Go through the attachments in batches, so that we never have
+        # to keep all of them in memory.
+        batch = list(Attachment.select()
+                     .where((Attachment.blob >> None) &
+                            (Attachment.id > last_id))
+                     .order_by(Attachment.id)
+                     .limit(batch_size))
+        if not batch:
+            break
+        for attachment in batch:
+            result = migrate_attachment(upload_folder, attachment)
+            if result is not None:
+                n_migrated += 1
+                saved += result
+        last_id = batch[-1].id
+        logging.info("Migrated %d attachments, up to id %d",
+                     n_migrated, last_id)
+    # the attachments now have sizes
+    set_storage_usage()
+    logging.info("Done; %d attachments migrated, %d bytes of duplicates removed",
+                 n_migrated, saved)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Move attachments into content addressed storage.')
+    parser.add_argument("elogy_database", metavar="DB", type=str,
+                        help="The elogy database file")
+    parser.add_argument("upload_folder", metavar="DIR", type=str,
+                        help="The elogy upload folder")
+    parser.add_argument("-b", "--batch-size", type=int, default=1000,
+                        help="Number of attachments to process at a time")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    setup_database(args.elogy_database, close=False)
+    migrate_attachments(args.upload_folder, args.batch_size)